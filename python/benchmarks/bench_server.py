@@ -0,0 +1,252 @@
+""" load tests the sql_server stack (server.get_server) against the chinook test database and a scaled copy of it.
+
+    Each scenario is driven for a fixed duration at each requested concurrency, and latency percentiles and
+    throughput are reported as JSON. With --baseline the results are compared against a stored run and the
+    exit code is 1 if anything regressed by more than --tolerance.
+
+    e.g. (from the python folder)
+        python benchmarks/bench_server.py --concurrency 1,8 --duration 5 --output bench.json
+        python benchmarks/bench_server.py --baseline bench.json
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os.path
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sql_server.server import get_server  # noqa: E402
+from sql_server.sqlalchemy_dsl import Criterion  # noqa: E402
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslJSONEncoder  # noqa: E402
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+CHINOOK_DB = os.path.join(THIS_DIR, '..', 'tests', 'data', 'chinook.db')
+TABLES = ['albums', 'artists', 'customers', 'employees', 'genres', 'invoice_items',
+          'invoices', 'media_types', 'playlist_track', 'playlists', 'tracks']
+
+
+def make_scaled_copy(dst, invoice_items_rows, src=CHINOOK_DB):
+    """ copies the chinook database to dst, and grows invoice_items to at least invoice_items_rows rows by
+        repeatedly duplicating it; an existing dst that is already big enough is reused
+    """
+    if os.path.exists(dst):
+        with sqlite3.connect(dst) as conn:
+            if conn.execute('SELECT COUNT(*) FROM invoice_items;').fetchone()[0] >= invoice_items_rows:
+                return dst
+    shutil.copy(src, dst)
+    with sqlite3.connect(dst) as conn:
+        rows = conn.execute('SELECT COUNT(*) FROM invoice_items;').fetchone()[0]
+        while rows < invoice_items_rows:
+            conn.execute('INSERT INTO invoice_items (InvoiceId, TrackId, UnitPrice, Quantity) '
+                         'SELECT InvoiceId, TrackId, UnitPrice, Quantity FROM invoice_items LIMIT ?;',
+                         (invoice_items_rows - rows,))
+            rows = conn.execute('SELECT COUNT(*) FROM invoice_items;').fetchone()[0]
+        conn.execute('ANALYZE;')
+    return dst
+
+
+def _dsl_body(clause, row_limit=1000):
+    return json.dumps({'CLAUSE': clause, 'row_limit': row_limit}, cls=SqlAlchemyDslJSONEncoder)
+
+
+# scenario name -> function(random.Random) returning (method, path, body or None)
+SCENARIOS = {
+    'get_table_names': lambda rnd: ('GET', '/get_table_names', None),
+    'get_table_count': lambda rnd: ('POST', '/get_table_count',
+                                    json.dumps({'table_name': rnd.choice(TABLES)})),
+    'get_table_count_estimate': lambda rnd: ('POST', '/get_table_count',
+                                             json.dumps({'table_name': rnd.choice(TABLES), 'mode': 'estimate'})),
+    'query_point': lambda rnd: ('POST', '/query', _dsl_body(
+        {'SELECT': [Criterion('invoice_items', 'InvoiceLineId'), Criterion('invoice_items', 'TrackId'),
+                    Criterion('invoice_items', 'UnitPrice')],
+         'WHERE': {'AND': [Criterion('invoice_items', 'InvoiceId', comparison_operator='=',
+                                     field_value=[rnd.randint(1, 412)])]}})),
+    'query_group_by': lambda rnd: ('POST', '/query', _dsl_body(
+        {'SELECT': [Criterion('invoice_items', 'InvoiceId'),
+                    Criterion('invoice_items', 'InvoiceLineId', field_name_modifiers=['COUNT'])],
+         'WHERE': {'AND': [Criterion('invoice_items', 'TrackId', comparison_operator='<',
+                                     field_value=[rnd.randint(1, 3503)])]},
+         'GROUP BY': [Criterion('invoice_items', 'InvoiceId')]})),
+}
+
+
+def percentile(sorted_values, p):
+    """ nearest-rank percentile of an already sorted list; p in [0, 100] """
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarise(latencies, errors, elapsed):
+    """ latencies - list<float> - seconds per successful request """
+    latencies = sorted(latencies)
+    ms = lambda v: round(v * 1000.0, 3) if v is not None else None  # noqa: E731
+    return {'requests': len(latencies),
+            'errors': errors,
+            'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p90_ms': ms(percentile(latencies, 90)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'max_ms': ms(latencies[-1] if latencies else None),
+            'mean_ms': ms(sum(latencies) / len(latencies) if latencies else None)}
+
+
+def run_scenario(base_url, scenario, concurrency, duration, keepalive=False, seed=0):
+    """ drives scenario at the given concurrency for duration seconds; returns summarise() output
+        keepalive - bool - reuse each client's connection between requests rather than opening a new one
+    """
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker(i):
+        rnd = random.Random(seed * 1000 + i)
+        session = requests.Session()
+        mine, my_errors = [], 0
+        headers = {} if keepalive else {'Connection': 'close'}
+        while time.perf_counter() < deadline:
+            method, path, body = SCENARIOS[scenario](rnd)
+            start = time.perf_counter()
+            try:
+                rv = session.request(method, base_url + path, data=body,
+                                     headers=dict(headers, **({'Content-Type': 'application/json'} if body else {})))
+                rv.content  # read the whole (possibly streamed) body
+                ok = rv.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                mine.append(time.perf_counter() - start)
+            else:
+                my_errors += 1
+        session.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += my_errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarise(latencies, errors[0], time.perf_counter() - start)
+
+
+def start_server(db_file, port, server_args, log_file):
+    """ starts server.get_server for db_file on a background thread; returns the cheroot server """
+    _, server, _ = get_server(['--sql_source', 'sqlite:///' + db_file, '--port', str(port),
+                               '--log', log_file] + server_args)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if server.ready:
+            return server
+        time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def compare(results, baseline, tolerance):
+    """ returns a list of human readable regressions of results against baseline """
+    regressions = []
+    for key, current in sorted(results.items()):
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for stat in ['p50_ms', 'p99_ms']:
+            if current[stat] is not None and previous[stat] and current[stat] > previous[stat] * (1 + tolerance):
+                regressions.append('{} {}: {} > {} (baseline)'.format(key, stat, current[stat], previous[stat]))
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append('{} throughput_rps: {} < {} (baseline)'.format(
+                key, current['throughput_rps'], previous['throughput_rps']))
+        if current['errors'] > previous['errors']:
+            regressions.append('{} errors: {} > {} (baseline)'.format(key, current['errors'], previous['errors']))
+    return regressions
+
+
+def run_benchmarks(databases, scenarios, concurrencies, duration, port, server_args, log_file, keepalive=False):
+    """ databases - dict<str, str> - name -> sqlite file
+        port - int - port for the server under test; 0 for any free port
+        returns dict '<database>/<scenario>/c<concurrency>' -> summarise() output
+    """
+    results = {}
+    for db_name, db_file in databases.items():
+        server = start_server(db_file, port, server_args, log_file)
+        base_url = 'http://127.0.0.1:{}'.format(server.bind_addr[1])  # the port assigned, if port was 0
+        try:
+            for scenario in scenarios:
+                for concurrency in concurrencies:
+                    key = '{}/{}/c{}'.format(db_name, scenario, concurrency)
+                    results[key] = run_scenario(base_url, scenario, concurrency, duration, keepalive)
+                    print(key, json.dumps(results[key]), file=sys.stderr)
+        finally:
+            server.stop()
+    return results
+
+
+def _parse_args(cmd_line_args):
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--databases', default='chinook,scaled', help='comma separated; chinook and/or scaled')
+    parser.add_argument('--scaled_rows', default=2000000, type=int, help='invoice_items rows in the scaled copy')
+    parser.add_argument('--scaled_db', default=os.path.join(tempfile.gettempdir(), 'chinook_scaled.db'),
+                        help='file for the scaled copy; reused between runs if big enough')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenario names')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma separated client thread counts')
+    parser.add_argument('--duration', default=10.0, type=float, help='seconds per scenario and concurrency')
+    parser.add_argument('--keepalive', action='store_true',
+                        help='reuse client connections; note cheroot can add ~100ms to requests on a kept-alive '
+                             'connection, which then dominates the latencies')
+    parser.add_argument('--port', default=8099, type=int, help='port for the server under test')
+    parser.add_argument('--server_args', default='', help='extra command line args for server.get_server')
+    parser.add_argument('--log', default=os.path.join(tempfile.gettempdir(), 'bench_server.log'),
+                        help='server log file')
+    parser.add_argument('--output', default=None, help='write results JSON here as well as to stdout')
+    parser.add_argument('--baseline', default=None, help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='allowed relative regression, e.g. 0.2')
+    return vars(parser.parse_args(cmd_line_args))
+
+
+def main_function(cmd_line_args=[]):
+    args = _parse_args(cmd_line_args)
+    databases = {}
+    for name in args['databases'].split(','):
+        if name == 'chinook':
+            databases[name] = CHINOOK_DB
+        elif name == 'scaled':
+            databases[name] = make_scaled_copy(args['scaled_db'], args['scaled_rows'])
+        else:
+            raise ValueError('unknown database: '+name)
+    scenarios = args['scenarios'].split(',')
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        raise ValueError('unknown scenarios: '+', '.join(unknown))
+    results = run_benchmarks(databases, scenarios, [int(c) for c in args['concurrency'].split(',')],
+                             args['duration'], args['port'], args['server_args'].split(), args['log'],
+                             args['keepalive'])
+    output = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'duration': args['duration'],
+                       'keepalive': args['keepalive'],
+                       'server_args': args['server_args']},
+              'results': results}
+    print(json.dumps(output, indent=2, sort_keys=True))
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args['baseline']:
+        with open(args['baseline']) as f:
+            regressions = compare(results, json.load(f)['results'], args['tolerance'])
+        for r in regressions:
+            print('REGRESSION ' + r, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_function(sys.argv[1:]))
@@ -0,0 +1,197 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+import logging
+import sys
+import threading
+
+
+class AsgiAdapter:
+    """ serves a WSGI app (e.g. from flask_app.create_app) as an ASGI app on an asyncio event loop.
+        Connections, including idle keep-alive ones, are held by the event loop and cost no thread;
+        a thread from a bounded pool is only taken while a request is actually being run by the WSGI app.
+        Admission control: once max_workers requests are running and max_pending are waiting for a thread,
+        further requests are rejected straight away with 503.
+        Backpressure: a response body is passed from the worker thread to the event loop through a small
+        bounded queue, so a slow client holds back the thread producing its rows rather than letting them pile up.
+        If the client disconnects, the threading.Event in environ['sql_server.cancelled'] is set and the
+        body is no longer iterated.
+    """
+
+    def __init__(self, wsgi_app, max_workers=10, max_pending=100, queued_chunks=4):
+        """ wsgi_app - WSGI callable
+            max_workers - int - threads running WSGI requests
+            max_pending - int - requests allowed to wait for a thread before new requests get 503
+            queued_chunks - int - body chunks buffered between a worker thread and the event loop
+        """
+        self._wsgi_app = wsgi_app
+        self._max_workers = max_workers
+        self._max_in_flight = max_workers + max_pending
+        self._queued_chunks = queued_chunks
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sql_server_asgi')
+        self._in_flight = 0  # only touched on the event loop thread
+        self._rejected = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if self._in_flight >= self._max_in_flight:
+                self._rejected += 1
+                await self._send_simple(send, 503, b'server busy', [(b'retry-after', b'1')])
+                return
+            self._in_flight += 1
+            try:
+                await self._handle_http(scope, receive, send)
+            finally:
+                self._in_flight -= 1
+        else:
+            raise ValueError('unsupported ASGI scope type: '+str(scope['type']))
+
+    def get_stats(self):
+        return {'in_flight': self._in_flight,
+                'max_workers': self._max_workers,
+                'max_in_flight': self._max_in_flight,
+                'rejected': self._rejected}
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _send_simple(self, send, status, body, headers=[]):
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(b'content-type', b'text/plain'),
+                                (b'content-length', str(len(body)).encode('latin1'))] + headers})
+        await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+
+    async def _read_body(self, receive):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                return b''.join(body)
+
+    def _get_environ(self, scope, body, cancelled):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {'REQUEST_METHOD': scope['method'],
+                   'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+                   'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+                   'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+                   'SERVER_NAME': str(server[0]),
+                   'SERVER_PORT': str(server[1]),
+                   'SERVER_PROTOCOL': 'HTTP/'+scope.get('http_version', '1.1'),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.version': (1, 0),
+                   'wsgi.url_scheme': scope.get('scheme', 'http'),
+                   'wsgi.input': io.BytesIO(body),
+                   'wsgi.errors': sys.stderr,
+                   'wsgi.multithread': True,
+                   'wsgi.multiprocess': False,
+                   'wsgi.run_once': False,
+                   'sql_server.cancelled': cancelled}
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = str(scope['client'][0])
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = name if name == 'CONTENT_TYPE' else 'HTTP_'+name
+            value = value.decode('latin1')
+            environ[key] = environ[key]+','+value if key in environ else value
+        return environ
+
+    def _run_wsgi(self, environ, loop, queue):
+        """ runs on a worker thread; puts ('start', (status, headers)), ('body', bytes)... and finally
+            ('end', None) or ('error', (exception, started)) on queue, blocking while the queue is full
+        """
+        cancelled = environ['sql_server.cancelled']
+        response_start = []
+        started = False
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def emit(chunk):
+            nonlocal started
+            if not started:
+                put(('start', response_start[0]))
+                started = True
+            if chunk:
+                put(('body', chunk))
+
+        def start_response(status, headers, exc_info=None):
+            response_start[:] = [(int(status.split(' ', 1)[0]),
+                                  [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers])]
+            return emit
+
+        try:
+            iterable = self._wsgi_app(environ, start_response)
+            try:
+                for chunk in iterable:
+                    if cancelled.is_set():
+                        break
+                    if chunk:
+                        emit(chunk)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+            if not started:
+                emit(b'')
+            put(('end', None))
+        except Exception as e:
+            logging.exception('AsgiAdapter - error running WSGI app')
+            put(('error', (e, started)))
+
+    async def _watch_disconnect(self, receive, cancelled):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                cancelled.set()
+                return
+
+    async def _handle_http(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            return  # client went away before sending its request
+        cancelled = threading.Event()
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self._queued_chunks)
+        watcher = loop.create_task(self._watch_disconnect(receive, cancelled))
+        worker = loop.run_in_executor(self._executor, self._run_wsgi,
+                                      self._get_environ(scope, body, cancelled), loop, queue)
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == 'end':
+                    if not cancelled.is_set():
+                        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                    break
+                elif kind == 'error':
+                    e, started = value
+                    if not started and not cancelled.is_set():
+                        await self._send_simple(send, 500, b'internal server error')
+                    break
+                elif cancelled.is_set():
+                    continue  # keep draining so the worker thread can finish
+                elif kind == 'start':
+                    status, headers = value
+                    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                else:
+                    await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+        except OSError:
+            cancelled.set()
+            while (await queue.get())[0] not in ('end', 'error'):
+                pass
+        finally:
+            watcher.cancel()
+            await worker
@@ -0,0 +1,82 @@
+import importlib.util
+import zlib
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+ENCODINGS = (ZSTD, GZIP)  # in order of preference when the client accepts both equally
+
+# zstd is optional and needs the zstandard package; it is imported by the first response it compresses
+zstandard = None
+
+
+def _import_zstandard():
+    """ imports zstandard on first use; returns the module, or None if it is not installed """
+    global zstandard
+    if zstandard is None and importlib.util.find_spec('zstandard') is not None:
+        import zstandard as module
+        zstandard = module
+    return zstandard
+
+
+def get_available_encodings(encodings=ENCODINGS):
+    """ encodings - iterable<str> - content codings the server may use, in order of preference
+        returns those of them that can be used here, i.e. without zstd if zstandard is not installed
+    """
+    return [e for e in encodings if e == GZIP or (e == ZSTD and _import_zstandard() is not None)]
+
+
+def choose_encoding(accept_encodings, encodings=ENCODINGS):
+    """ accept_encodings - 'werkzeug.datastructures.Accept' - the request's Accept-Encoding header
+        encodings - iterable<str> - content codings the server may use, in order of preference
+        returns the coding the client rates highest, the server's preference breaking ties, or None to send
+        the response as it is
+    """
+    best, best_quality = None, 0
+    for encoding in get_available_encodings(encodings):
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class Compressor:
+    """ compresses one response body with a content coding, either all at once or chunk by chunk. Output
+        depends only on the input (gzip headers carry no timestamp), so a strong ETag can cover it.
+    """
+
+    def __init__(self, encoding, level=None):
+        """ encoding - str - GZIP or ZSTD
+            level - int or None - compression level; None for the coding's default
+        """
+        if encoding == GZIP:
+            # wbits 16 + 15 writes a gzip header and trailer around the deflate stream
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+                                                zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._flush_chunk = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        elif encoding == ZSTD and _import_zstandard() is not None:
+            kwargs = {} if level is None else {'level': level}
+            self._compressor = zstandard.ZstdCompressor(**kwargs).compressobj()
+            self._flush_chunk = lambda: self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        else:
+            raise ValueError('unsupported content coding: '+str(encoding))
+
+    def compress(self, data):
+        """ returns the whole of data compressed; the Compressor cannot be used again """
+        return self._compressor.compress(data) + self._compressor.flush()
+
+    def iter_compressed(self, chunks):
+        """ chunks - iterable<bytes or str> - the body piece by piece, e.g. a streamed response
+            generator; yields the compressed body, flushing after each chunk so that a streamed response
+            still reaches the client as it is produced. chunks is closed when the generator is.
+        """
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    yield self._compressor.compress(chunk) + self._flush_chunk()
+            yield self._compressor.flush()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
@@ -0,0 +1,55 @@
+import os
+import threading
+
+
+class DataVersionMonitor:
+    """ tracks whether the contents of a database may have changed, so that cached results can be invalidated.
+        For file backed SQLite a dedicated connection is held open and asked for 'PRAGMA data_version', which
+        changes whenever another connection (in this process or any other) commits to the file. The file's
+        mtime is included as well, which catches the file being replaced underneath the open connection.
+        On top of that a local change counter can be bumped by code that knows it has written to the database.
+        For other dialects no version is available and get_version returns None, meaning 'do not cache'.
+        The connection is opened by the first call to get_version, so creating a monitor costs nothing.
+    """
+
+    def __init__(self, engine):
+        """ engine - 'sqlalchemy.engine.Engine' - engine for the database to monitor """
+        self._lock = threading.Lock()
+        self._change_counter = 0
+        self._dialect = engine.dialect
+        self._connect_args = None  # (cargs, cparams) for the monitoring connection, if the dialect has one
+        self._conn = None
+        self._path = None
+        url = engine.url
+        if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:':
+            cargs, cparams = engine.dialect.create_connect_args(url)
+            cparams['check_same_thread'] = False  # access is serialised by self._lock
+            self._connect_args = (cargs, cparams)
+            self._path = cargs[0] if cargs and os.path.exists(str(cargs[0])) else None
+
+    def is_supported(self):
+        return self._connect_args is not None
+
+    def get_version(self):
+        """ returns a hashable token that changes when the database contents change, or None if unknown """
+        with self._lock:
+            if self._conn is None:
+                if self._connect_args is None:
+                    return None
+                cargs, cparams = self._connect_args
+                self._conn = self._dialect.connect(*cargs, **cparams)
+            data_version = self._conn.execute('PRAGMA data_version;').fetchone()[0]
+            mtime = os.stat(self._path).st_mtime_ns if self._path is not None else None
+            return (data_version, self._change_counter, mtime)
+
+    def bump(self):
+        """ records a change made through this process """
+        with self._lock:
+            self._change_counter += 1
+
+    def close(self):
+        with self._lock:
+            self._connect_args = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import re
+
+_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+class UnknownDatabaseError(ValueError):
+    pass
+
+
+class DatabaseRegistry:
+    """ the databases a server serves, by name, each behind its own SqlWrapper (with its own engines, caches and
+        replicas). Requests pick a database by name, and get the default one, the first added, if they do not.
+    """
+
+    def __init__(self):
+        self._sql_wrappers = OrderedDict()  # name -> SqlWrapper
+
+    def add(self, name, sql_wrapper):
+        """ name - str - letters, digits, '_', '.' and '-'
+            sql_wrapper - SqlWrapper - serves the database
+        """
+        if not isinstance(name, str) or not _NAME.match(name):
+            raise ValueError('invalid database name: '+repr(name))
+        if name in self._sql_wrappers:
+            raise ValueError('database already registered: '+name)
+        self._sql_wrappers[name] = sql_wrapper
+
+    def get(self, name=None):
+        """ returns the SqlWrapper for the database called name, or for the default database if name is None """
+        if name is None:
+            name = self.get_default_name()
+        sql_wrapper = self._sql_wrappers.get(name)
+        if sql_wrapper is None:
+            raise UnknownDatabaseError('unknown database: '+str(name))
+        return sql_wrapper
+
+    def get_default_name(self):
+        return next(iter(self._sql_wrappers), None)
+
+    def get_names(self):
+        return list(self._sql_wrappers)
+
+    def items(self):
+        """ returns a list of (name, SqlWrapper), the default database first """
+        return list(self._sql_wrappers.items())
+
+    def set_query_guard(self, guard):
+        """ applies guard to the statements this thread runs on any of the databases (see SqlWrapper) """
+        for sql_wrapper in self._sql_wrappers.values():
+            sql_wrapper.set_query_guard(guard)
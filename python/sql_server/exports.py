@@ -0,0 +1,251 @@
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import csv
+import gzip
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from sql_server.query_limits import LimitExceededError
+from sql_server.query_limits import QueryGuard
+from sql_server.query_limits import QueryInterruptedError
+from sql_server.serialization import get_arrow_schema
+from sql_server.serialization import iter_record_batches
+from sql_server.serialization import is_arrow_available
+
+# format -> (file name extension, mimetype of the file)
+FORMATS = {'csv': ('.csv.gz', 'application/gzip'),
+           'parquet': ('.parquet', 'application/vnd.apache.parquet')}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def _csv_value(v):
+    if isinstance(v, bytes):
+        return base64.b64encode(v).decode('ascii')
+    return v
+
+
+class ExportJob:
+    """ one export of a DSL clause to a file; its state changes from 'queued' to 'running' and then to one of
+        'done', 'failed' or 'cancelled'
+    """
+
+    def __init__(self, job_id, database, clause, fmt, row_limit, path):
+        self.job_id = job_id
+        self.database = database
+        self.clause = clause
+        self.format = fmt
+        self.row_limit = row_limit
+        self.path = path
+        self.state = 'queued'
+        self.error = None
+        self.rows = 0
+        self.bytes = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def to_dict(self):
+        end = self.finished if self.finished is not None else time.time()
+        return {'job_id': self.job_id, 'database': self.database, 'format': self.format, 'state': self.state,
+                'error': self.error, 'rows': self.rows, 'bytes': self.bytes, 'row_limit': self.row_limit,
+                'created': self.created, 'started': self.started, 'finished': self.finished,
+                'seconds': round(end - self.started, 3) if self.started is not None else None}
+
+
+class ExportManager:
+    """ runs exports of DSL clauses to compressed CSV (gzip) or Parquet files on a small pool of background threads,
+        so that large extracts neither hold server threads for their duration nor take more than max_workers
+        connections from the pool. Rows are streamed from the cursor to the file batch by batch, so memory use
+        does not grow with the size of the export, and the job reports its progress as it goes.
+        Jobs and their files are kept for ttl seconds after they finish.
+    """
+
+    def __init__(self, directory=None, max_workers=2, batch_size=10000, max_pending=16, ttl=3600.0, timeout=None):
+        """ directory - str or None - where export files are written; None for a new temporary directory
+            max_workers - int - exports run at once
+            batch_size - int - rows fetched and written at a time
+            max_pending - int - most exports queued or running; more are rejected with LimitExceededError
+            ttl - float - seconds a finished job, and its file, are kept
+            timeout - float or None - seconds an export's statement may run for
+        """
+        self._directory = directory
+        self._max_workers = max_workers
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._ttl = ttl
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._jobs = {}  # job id -> ExportJob
+        self._executor = None  # created by the first submit, so that no threads exist before a fork
+
+    def _get_directory(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='sql_server_exports_')
+        os.makedirs(self._directory, exist_ok=True)
+        return self._directory
+
+    def submit(self, sql_wrapper, clause, fmt='csv', row_limit=None, database=None):
+        """ sql_wrapper - SqlWrapper - database to export from
+            clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            fmt - str - 'csv' or 'parquet'
+            row_limit - int or None - most rows to export
+            database - str or None - name of the database, for the job's status
+            returns the status of the new job (see get_status)
+        """
+        if fmt not in FORMATS:
+            raise ExportError('unknown export format: '+str(fmt))
+        if fmt == 'parquet' and not is_arrow_available():
+            raise ExportError('parquet exports need pyarrow, which is not installed')
+        # build the statement now, so that a bad clause is reported to the caller rather than in the job
+        sql_wrapper.get_statement(clause)
+        self._expire()
+        with self._lock:
+            if sum(job.state in ('queued', 'running') for job in self._jobs.values()) >= self._max_pending:
+                raise LimitExceededError('too many exports queued', 429)
+            job_id = uuid.uuid4().hex
+            job = ExportJob(job_id, database, clause, fmt, row_limit,
+                            os.path.join(self._get_directory(), job_id + FORMATS[fmt][0]))
+            self._jobs[job_id] = job
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._max_workers, thread_name_prefix='sql_server_export')
+            self._executor.submit(self._run, sql_wrapper, job)
+        logging.info('export '+job_id+' queued')
+        return job.to_dict()
+
+    def _run(self, sql_wrapper, job):
+        if job.cancelled.is_set():
+            return
+        job.state, job.started = 'running', time.time()
+        part = job.path + '.part'
+        sql_wrapper.set_query_guard(QueryGuard(self._timeout, job.cancelled))
+        try:
+            batches = sql_wrapper.iter_clause_rows(job.clause, job.row_limit, self._batch_size)
+            try:
+                columns = next(batches)
+                if job.format == 'csv':
+                    self._write_csv(job, part, columns, batches)
+                else:
+                    sql_types = sql_wrapper.get_result_types(job.clause, job.row_limit)
+                    self._write_parquet(job, part, columns, sql_types, batches)
+            finally:
+                batches.close()
+            if job.cancelled.is_set():
+                raise QueryInterruptedError('cancelled')
+            job.bytes = os.path.getsize(part)
+            os.replace(part, job.path)
+            job.state = 'done'
+        except QueryInterruptedError as e:
+            job.state, job.error = ('cancelled' if e.reason == 'cancelled' else 'failed'), str(e)
+        except Exception as e:
+            logging.exception('export '+job.job_id+' failed')
+            job.state, job.error = 'failed', str(e)
+        finally:
+            sql_wrapper.set_query_guard(None)
+            job.finished = time.time()
+            if os.path.exists(part):
+                os.remove(part)
+        logging.info('export '+job.job_id+' '+job.state+' with '+str(job.rows)+' rows')
+
+    def _count(self, job, rows, f):
+        job.rows += rows
+        job.bytes = f.tell()
+
+    def _write_csv(self, job, path, columns, batches):
+        with open(path, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+            text = io.TextIOWrapper(gz, encoding='utf-8', newline='')
+            try:
+                writer = csv.writer(text)
+                writer.writerow(columns)
+                for batch in batches:
+                    if job.cancelled.is_set():
+                        return
+                    writer.writerows([_csv_value(v) for v in row] for row in batch)
+                    text.flush()
+                    self._count(job, len(batch), f)
+            finally:
+                text.flush()
+                text.detach()  # leaves closing the gzip stream to its with statement
+
+    def _write_parquet(self, job, path, columns, sql_types, batches):
+        import pyarrow.parquet
+        with open(path, 'wb') as f:
+            writer = None
+            try:
+                for record_batch in iter_record_batches(columns, batches, sql_types):
+                    if job.cancelled.is_set():
+                        return
+                    if writer is None:
+                        writer = pyarrow.parquet.ParquetWriter(f, record_batch.schema)
+                    writer.write_table(pyarrow.Table.from_batches([record_batch]))
+                    self._count(job, record_batch.num_rows, f)
+                if writer is None:  # no rows; the file still has the columns
+                    writer = pyarrow.parquet.ParquetWriter(f, get_arrow_schema(columns, sql_types))
+            finally:
+                if writer is not None:
+                    writer.close()
+
+    def _expire(self):
+        """ forgets the jobs that finished more than ttl seconds ago, and removes their files """
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.finished is not None and now - job.finished > self._ttl]
+            for job in expired:
+                del self._jobs[job.job_id]
+        for job in expired:
+            if os.path.exists(job.path):
+                os.remove(job.path)
+
+    def _get_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    def get_status(self, job_id):
+        """ returns {'job_id', 'state', 'rows', 'bytes', ...} for the job; raises KeyError if there is none """
+        return self._get_job(job_id).to_dict()
+
+    def list_jobs(self):
+        """ returns the status of every job, oldest first """
+        self._expire()
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job.created)
+        return [job.to_dict() for job in jobs]
+
+    def get_file(self, job_id):
+        """ returns (path, mimetype, download name) of a job's file, or None if the job is not done """
+        job = self._get_job(job_id)
+        if job.state != 'done':
+            return None
+        extension, mimetype = FORMATS[job.format]
+        return job.path, mimetype, 'export-' + job_id + extension
+
+    def remove(self, job_id):
+        """ cancels the job if it has not finished, and otherwise forgets it and removes its file """
+        job = self._get_job(job_id)
+        job.cancelled.set()
+        if job.state == 'queued':
+            job.state, job.error, job.finished = 'cancelled', 'statement cancelled', time.time()
+        if job.finished is not None and job.state != 'running':
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            if os.path.exists(job.path):
+                os.remove(job.path)
+
+    def shutdown(self):
+        """ cancels all jobs and waits for the running ones to stop """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancelled.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -1,18 +1,269 @@
 from sql_server.sql_wrapper import SqlWrapper
 from sql_server.sql_wrapper import SqlWrapperException
+from sql_server.databases import DatabaseRegistry
+from sql_server.databases import UnknownDatabaseError
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
+from sql_server.sqlalchemy_dsl import get_clause_from_json
+from sql_server.serialization import SerializationError
+from sql_server.serialization import ARROW_STREAM_MIMETYPE
+from sql_server.serialization import get_response_mimetype
+from sql_server.serialization import iter_arrow_stream
+from sql_server.serialization import get_arrow_bytes
+from sql_server.metrics import ServerMetrics
+from sql_server.metrics import PROMETHEUS_MIMETYPE
+from sql_server.query_limits import ConcurrencyLimiter
+from sql_server.query_limits import LimitExceededError
+from sql_server.query_limits import QueryGuard
+from sql_server.query_limits import QueryInterruptedError
+from sql_server.exports import ExportError
+from sql_server.exports import ExportManager
+from sql_server.summaries import SummaryError
+from sql_server.compression import Compressor
+from sql_server.compression import choose_encoding
 import flask
+import hashlib
 import logging
 from os import getenv
 
 
-def create_app(sql_engine_args_list, sql_engine_kwargs_dict):
+def _stream_json_rows(app, columns, batches, get_trailer=None):
+    """ yields a JSON document {"columns": [...], "rows": [[...], ...]} piece by piece, one chunk per batch
+        get_trailer - callable or None - returns a dict of further keys to end the document with,
+                                         called once all batches have been sent
+    """
+    yield '{"columns": ' + app.json.dumps(columns) + ', "rows": ['
+    separator = ''
+    for batch in batches:
+        yield separator + ', '.join(app.json.dumps(row) for row in batch)
+        separator = ', '
+    trailer = get_trailer() if get_trailer is not None else {}
+    yield ']' + ''.join(', ' + app.json.dumps(k) + ': ' + app.json.dumps(v) for k, v in trailer.items()) + '}'
+
+
+def _split_page(items, page):
+    """ items - generator from SqlWrapper.iter_clause_page, past its columns
+        yields the row batches, and stores the final next page token in page['next_page_token']
+    """
+    for item in items:
+        if isinstance(item, list):
+            yield item
+        else:
+            page['next_page_token'] = item
+
+
+# endpoints that do database work, and so are subject to the concurrency limits and statement timeout
+_LIMITED_ENDPOINTS = {'get_table_count', 'get_table_names', 'query', 'batch', 'explain', 'index_advice',
+                      'refresh_summaries'}
+
+
+# read-only endpoints whose responses carry an ETag; the POST ones take their query in the body but change nothing
+_CONDITIONAL_ENDPOINTS = {'get_table_count', 'get_table_names', 'query', 'batch'}
+
+
+def _get_database_name(app):
+    """ the database named by the request's X-Database header or 'database' query argument, or the default one """
+    return flask.request.headers.get('X-Database') or flask.request.args.get('database') or \
+        app.config['databases'].get_default_name()
+
+
+def _get_sql_wrapper(app):
+    """ the SqlWrapper of the database the request is for (see _get_database_name) """
+    return app.config['databases'].get(_get_database_name(app))
+
+
+def _get_encoding(app):
+    """ the content coding to compress this request's response with, or None """
+    if not app.config['COMPRESSION_ENCODINGS']:
+        return None
+    return choose_encoding(flask.request.accept_encodings, app.config['COMPRESSION_ENCODINGS'])
+
+
+def _conditional_requests(app):
+    """ registers request hooks that give the responses of the read-only endpoints a strong ETag, made from the
+        data version (see SqlWrapper.get_data_version) and everything the response depends on: the endpoint, its
+        query string and body, the Accept header and the content coding. A request whose If-None-Match holds the
+        current ETag is answered 304 Not Modified before any query runs or a concurrency slot is taken. The POST
+        endpoints are answered the same way as GET ones, since their bodies only describe what to read.
+    """
+    @app.before_request
+    def check_etag():
+        if not app.config['ETAGS'] or flask.request.endpoint not in _CONDITIONAL_ENDPOINTS:
+            return
+        version = _get_sql_wrapper(app).get_data_version()
+        if version is None:
+            return
+        request = flask.request
+        key = repr((version, request.endpoint, request.query_string, request.get_data(),
+                    request.headers.get('Accept'), _get_encoding(app)))
+        flask.g.sql_server_etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        if request.if_none_match.contains_weak(flask.g.sql_server_etag):
+            response = flask.Response(status=304)
+            response.set_etag(flask.g.sql_server_etag)
+            response.vary.update(['Accept', 'Accept-Encoding'])
+            return response
+
+    @app.after_request
+    def set_etag(response):
+        if flask.g.get('sql_server_etag') is not None and response.status_code == 200:
+            response.set_etag(flask.g.sql_server_etag)
+            response.vary.update(['Accept', 'Accept-Encoding'])
+        return response
+
+
+def _compress_responses(app):
+    """ registers a hook that compresses responses with the content coding the client prefers. Responses of
+        known length under COMPRESSION_MIN_BYTES are sent as they are; streamed responses, whose length is not
+        known when the headers go out, are always compressed, a chunk at a time.
+    """
+    @app.after_request
+    def compress(response):
+        if not app.config['COMPRESSION_ENCODINGS']:
+            return response
+        response.vary.add('Accept-Encoding')
+        if flask.request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 304) or \
+                'Content-Encoding' in response.headers or response.direct_passthrough:
+            return response
+        encoding = _get_encoding(app)
+        if encoding is None:
+            return response
+        compressor = Compressor(encoding, app.config['COMPRESSION_LEVEL'])
+        if response.is_streamed:
+            response.response = compressor.iter_compressed(response.response)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESSION_MIN_BYTES']:
+                return response
+            response.set_data(compressor.compress(data))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def _limit_requests(app, databases, limiter):
+    """ registers request hooks that apply the concurrency limits and a QueryGuard to the database endpoints.
+        Clients are told apart by their X-Client-Id header, or failing that their address, and may ask for a
+        shorter statement timeout than the server's with an X-Statement-Timeout header (seconds).
+    """
+    @app.before_request
+    def acquire():
+        if flask.request.endpoint not in _LIMITED_ENDPOINTS:
+            return
+        timeout = app.config['STATEMENT_TIMEOUT']
+        requested = flask.request.headers.get('X-Statement-Timeout')
+        if requested is not None:
+            try:
+                requested = float(requested)
+            except ValueError:
+                raise SqlAlchemyDslError('malformed X-Statement-Timeout: '+requested)
+            timeout = requested if timeout is None else min(timeout, requested)
+        client = flask.request.headers.get('X-Client-Id') or flask.request.remote_addr
+        limiter.acquire(client)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                limiter.release(client)
+
+        flask.g.sql_server_release = release
+        databases.set_query_guard(QueryGuard(timeout, flask.request.environ.get('sql_server.cancelled')))
+
+    @app.after_request
+    def release_streamed(response):
+        release = flask.g.get('sql_server_release')
+        if release is not None and response.is_streamed:
+            # the body is produced after this request handler returns; hold the slot until the response is closed
+            flask.g.sql_server_release_deferred = True
+            response.call_on_close(release)
+        return response
+
+    @app.teardown_request
+    def release(exc):
+        databases.set_query_guard(None)
+        if flask.g.get('sql_server_release') is not None and not flask.g.get('sql_server_release_deferred'):
+            flask.g.sql_server_release()
+
+
+def create_app(sql_engine_args_list, sql_engine_kwargs_dict, sql_wrapper_kwargs_dict={}, app_config_dict={},
+               databases={}):
+    """ sql_engine_args_list, sql_engine_kwargs_dict - args and kwargs for sqlalchemy.create_engine
+        sql_wrapper_kwargs_dict - dict - further kwargs for SqlWrapper
+        app_config_dict - dict - overrides for the flask app config, e.g. {'QUERY_ROW_LIMIT': 1000}
+        databases - dict<str, dict> - further databases to serve, by name, as SqlWrapper kwargs that override those
+                                      of the default database (which is named 'default'), e.g.
+                                      {'sales': {'engine_args_list': ['sqlite:///sales.db']}}.
+                                      Requests choose one with an X-Database header or a 'database' query argument.
+    """
     app = flask.Flask(__name__)
-    app.config['sql_wrapper'] = SqlWrapper(sql_engine_args_list, sql_engine_kwargs_dict)
+    app.config['QUERY_ROW_LIMIT'] = 100000  # most rows /query will return
+    app.config['QUERY_BATCH_SIZE'] = 1000  # rows fetched and sent per chunk by /query
+    app.config['ALLOW_ADMIN'] = False  # whether endpoints may change the database, e.g. to create indexes
+    app.config['STATEMENT_TIMEOUT'] = None  # seconds a request's statements may run for (SQLite only)
+    app.config['MAX_CONCURRENT_QUERIES'] = None  # most requests doing database work at once
+    app.config['MAX_CLIENT_QUERIES'] = None  # most requests doing database work at once for any one client
+    app.config['QUERY_QUEUE_TIMEOUT'] = 0.0  # seconds a request may wait for a MAX_CONCURRENT_QUERIES slot
+    app.config['COMPRESSION_ENCODINGS'] = ['zstd', 'gzip']  # content codings offered, preferred first; [] for none
+    app.config['COMPRESSION_MIN_BYTES'] = 1024  # smaller responses are sent uncompressed
+    app.config['COMPRESSION_LEVEL'] = None  # None for each coding's default level
+    app.config['ETAGS'] = True  # whether read-only endpoints send ETags and answer If-None-Match with 304
+    app.config['EXPORT_DIR'] = None  # where export files are written; None for a temporary directory
+    app.config['EXPORT_WORKERS'] = 2  # exports run at once, each on a background thread
+    app.config['EXPORT_BATCH_SIZE'] = 10000  # rows fetched and written at a time by an export
+    app.config['EXPORT_MAX_PENDING'] = 16  # most exports queued or running
+    app.config['EXPORT_TTL'] = 3600.0  # seconds finished exports are kept for download
+    app.config['EXPORT_TIMEOUT'] = None  # seconds an export's statement may run for
+    app.config.update(app_config_dict)
+    app.config['sql_wrapper'] = SqlWrapper(sql_engine_args_list, sql_engine_kwargs_dict, **sql_wrapper_kwargs_dict)
+    app.config['metrics'] = ServerMetrics(app, app.config['sql_wrapper'])
+    app.config['databases'] = DatabaseRegistry()
+    app.config['databases'].add('default', app.config['sql_wrapper'])
+    for name, kwargs in databases.items():
+        sql_wrapper_kwargs = dict(sql_wrapper_kwargs_dict, engine_kwargs_dict=sql_engine_kwargs_dict,
+                                  replica_args_lists=[], summaries=[])
+        sql_wrapper_kwargs.update(kwargs)
+        app.config['databases'].add(name, SqlWrapper(**sql_wrapper_kwargs))
+        app.config['metrics'].add_sql_wrapper(app.config['databases'].get(name), name)
+    app.config['limiter'] = ConcurrencyLimiter(app.config['MAX_CONCURRENT_QUERIES'], app.config['MAX_CLIENT_QUERIES'],
+                                               app.config['QUERY_QUEUE_TIMEOUT'])
+    app.config['exports'] = ExportManager(app.config['EXPORT_DIR'], app.config['EXPORT_WORKERS'],
+                                          app.config['EXPORT_BATCH_SIZE'], app.config['EXPORT_MAX_PENDING'],
+                                          app.config['EXPORT_TTL'], app.config['EXPORT_TIMEOUT'])
+    _conditional_requests(app)
+    _limit_requests(app, app.config['databases'], app.config['limiter'])
+    _compress_responses(app)
 
     @app.errorhandler(SqlWrapperException)
     def handle_sql_wrapper_exception(e):
         return flask.jsonify(error=str(e)), 500
 
+    @app.errorhandler(UnknownDatabaseError)
+    def handle_unknown_database_error(e):
+        return flask.jsonify(error=str(e)), 404
+
+    @app.errorhandler(SqlAlchemyDslError)
+    def handle_sql_alchemy_dsl_error(e):
+        return flask.jsonify(error=str(e)), 400
+
+    @app.errorhandler(ExportError)
+    def handle_export_error(e):
+        return flask.jsonify(error=str(e)), 400
+
+    @app.errorhandler(SummaryError)
+    def handle_summary_error(e):
+        return flask.jsonify(error=str(e)), 400
+
+    @app.errorhandler(LimitExceededError)
+    def handle_limit_exceeded_error(e):
+        return flask.jsonify(error=str(e)), e.status_code, {'Retry-After': '1'}
+
+    @app.errorhandler(QueryInterruptedError)
+    def handle_query_interrupted_error(e):
+        return flask.jsonify(error=str(e)), 504 if e.reason == 'timeout' else 503
+
+    @app.errorhandler(SerializationError)
+    def handle_serialization_error(e):
+        return flask.jsonify(error=str(e)), 406
+
     @app.route('/debug_message')
     def debug_message():
         logging.info('SqlWrapper - debug_message')
@@ -22,17 +273,179 @@ def create_app(sql_engine_args_list, sql_engine_kwargs_dict):
     def get_table_count():
         content = flask.request.get_json()
         table_name = content['table_name']
-        logging.info('SqlWrapper - get_table_count with table_name = '+table_name)
+        mode = content.get('mode', 'exact')
+        logging.info('SqlWrapper - get_table_count with table_name = '+table_name+', mode = '+str(mode))
+        mimetype = get_response_mimetype(flask.request.accept_mimetypes)
+        count, source = _get_sql_wrapper(app).get_table_count_with_source(table_name, mode)
+        if mimetype == ARROW_STREAM_MIMETYPE:
+            return flask.Response(get_arrow_bytes(['table_name', 'count', 'mode', 'source'],
+                                                  [(table_name, count, mode, source)]),
+                                  mimetype=mimetype)
         return flask.jsonify({
             'table_name': table_name,
-            'count': app.config['sql_wrapper'].get_table_count(table_name)
+            'count': count,
+            'mode': mode,
+            'source': source
         })
 
     @app.route('/get_table_names')
     def get_table_names():
         logging.info('SqlWrapper - get_table_names')
+        mimetype = get_response_mimetype(flask.request.accept_mimetypes)
+        table_names = _get_sql_wrapper(app).get_table_names()
+        if mimetype == ARROW_STREAM_MIMETYPE:
+            return flask.Response(get_arrow_bytes(['table_names'], [(t,) for t in table_names]), mimetype=mimetype)
+        return flask.jsonify({
+            'table_names': table_names
+        })
+
+    @app.route('/query', methods=['POST'])
+    def query():
+        try:
+            content = get_clause_from_json(flask.request.get_data(as_text=True))
+            clause = content['CLAUSE']
+            row_limit = min(int(content.get('row_limit', app.config['QUERY_ROW_LIMIT'])),
+                            app.config['QUERY_ROW_LIMIT'])
+            batch_size = max(int(content.get('batch_size', app.config['QUERY_BATCH_SIZE'])), 1)
+            page_size = content.get('page_size')
+            page_size = min(max(int(page_size), 1), row_limit) if page_size is not None else None
+            page_token = content.get('page_token')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise SqlAlchemyDslError('malformed query: '+str(e))
+        logging.info('SqlWrapper - query with row_limit = '+str(row_limit)+', batch_size = '+str(batch_size))
+        mimetype = get_response_mimetype(flask.request.accept_mimetypes)
+        if page_size is not None:
+            return query_page(clause, page_size, page_token, batch_size, mimetype)
+        batches = _get_sql_wrapper(app).iter_clause_rows(clause, row_limit, batch_size)
+        columns = next(batches)  # runs the statement, so errors are reported before streaming starts
+        if mimetype == ARROW_STREAM_MIMETYPE:
+            chunks = iter_arrow_stream(columns, batches, _get_sql_wrapper(app).get_result_types(clause, row_limit))
+        else:
+            chunks = _stream_json_rows(app, columns, batches)
+        return flask.Response(flask.stream_with_context(chunks), mimetype=mimetype)
+
+    def query_page(clause, page_size, page_token, batch_size, mimetype):
+        """ one page of a /query with 'page_size' (and 'page_token' after the first page). JSON responses carry
+            "next_page_token" after the rows; Arrow responses, which hold at most page_size rows, are
+            gathered first and carry it in the X-Next-Page-Token header (absent on the last page)
+        """
+        logging.info('SqlWrapper - query page with page_size = '+str(page_size))
+        items = _get_sql_wrapper(app).iter_clause_page(clause, page_size, page_token, batch_size)
+        columns = next(items)
+        page = {'next_page_token': None}
+        batches = _split_page(items, page)
+        if mimetype == ARROW_STREAM_MIMETYPE:
+            sql_types = _get_sql_wrapper(app).get_result_types(clause)
+            body = b''.join(iter_arrow_stream(columns, list(batches), sql_types))
+            headers = {'X-Next-Page-Token': page['next_page_token']} if page['next_page_token'] else {}
+            return flask.Response(body, mimetype=mimetype, headers=headers)
+        chunks = _stream_json_rows(app, columns, batches, lambda: page)
+        return flask.Response(flask.stream_with_context(chunks), mimetype=mimetype)
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        try:
+            content = get_clause_from_json(flask.request.get_data(as_text=True))
+            operations = content['operations']
+        except (ValueError, KeyError, TypeError) as e:
+            raise SqlAlchemyDslError('malformed batch: '+str(e))
+        if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+            raise SqlAlchemyDslError('malformed batch: operations must be a list of objects')
+        logging.info('SqlWrapper - batch with '+str(len(operations))+' operations')
         return flask.jsonify({
-            'table_names': app.config['sql_wrapper'].get_table_names()
+            'results': _get_sql_wrapper(app).run_batch(operations, app.config['QUERY_ROW_LIMIT'])
         })
 
+    @app.route('/explain', methods=['POST'])
+    def explain():
+        try:
+            content = get_clause_from_json(flask.request.get_data(as_text=True))
+            clause = content['CLAUSE']
+        except (ValueError, KeyError, TypeError) as e:
+            raise SqlAlchemyDslError('malformed query: '+str(e))
+        logging.info('SqlWrapper - explain')
+        return flask.jsonify(_get_sql_wrapper(app).explain_clause(clause, app.config['QUERY_ROW_LIMIT']))
+
+    @app.route('/index_advice', methods=['GET', 'POST'])
+    def index_advice():
+        content = flask.request.get_json(silent=True) or {}
+        apply = bool(content.get('apply', False))
+        logging.info('SqlWrapper - index_advice with apply = '+str(apply))
+        if not apply:
+            return flask.jsonify({'recommendations': _get_sql_wrapper(app).get_index_advice(), 'applied': False})
+        if not app.config['ALLOW_ADMIN']:
+            return flask.jsonify(error='applying indexes requires the server to allow admin changes'), 403
+        return flask.jsonify({'recommendations': _get_sql_wrapper(app).apply_index_advice(), 'applied': True})
+
+    @app.route('/exports', methods=['POST'])
+    def submit_export():
+        try:
+            content = get_clause_from_json(flask.request.get_data(as_text=True))
+            clause = content['CLAUSE']
+            fmt = content.get('format', 'csv')
+            row_limit = content.get('row_limit')
+            row_limit = int(row_limit) if row_limit is not None else None
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise SqlAlchemyDslError('malformed export: '+str(e))
+        logging.info('SqlWrapper - export with format = '+str(fmt))
+        status = app.config['exports'].submit(_get_sql_wrapper(app), clause, fmt, row_limit, _get_database_name(app))
+        return flask.jsonify(status), 202, {'Location': flask.url_for('get_export', job_id=status['job_id'])}
+
+    @app.route('/exports')
+    def list_exports():
+        return flask.jsonify({'exports': app.config['exports'].list_jobs()})
+
+    @app.route('/exports/<job_id>', methods=['GET', 'DELETE'])
+    def get_export(job_id):
+        try:
+            if flask.request.method == 'DELETE':
+                app.config['exports'].remove(job_id)
+                return flask.jsonify({'job_id': job_id, 'removed': True})
+            return flask.jsonify(app.config['exports'].get_status(job_id))
+        except KeyError:
+            return flask.jsonify(error='unknown export: '+job_id), 404
+
+    @app.route('/exports/<job_id>/download')
+    def download_export(job_id):
+        try:
+            export = app.config['exports'].get_file(job_id)
+        except KeyError:
+            return flask.jsonify(error='unknown export: '+job_id), 404
+        if export is None:
+            return flask.jsonify(error='export is not done: '+job_id), 409
+        path, mimetype, name = export
+        return flask.send_file(path, mimetype=mimetype, as_attachment=True, download_name=name)
+
+    @app.route('/databases')
+    def get_databases():
+        logging.info('SqlWrapper - get_databases')
+        default = app.config['databases'].get_default_name()
+        return flask.jsonify({'databases': [{'name': name, 'default': name == default,
+                                             'replicas': sql_wrapper.get_replica_stats()}
+                                            for name, sql_wrapper in app.config['databases'].items()]})
+
+    @app.route('/summaries')
+    def get_summaries():
+        logging.info('SqlWrapper - get_summaries')
+        return flask.jsonify({'summaries': _get_sql_wrapper(app).get_summary_stats()})
+
+    @app.route('/summaries/refresh', methods=['POST'])
+    def refresh_summaries():
+        content = flask.request.get_json(silent=True) or {}
+        names = content.get('names')
+        force = bool(content.get('force', False))
+        logging.info('SqlWrapper - refresh_summaries with force = '+str(force))
+        if force and not app.config['ALLOW_ADMIN']:
+            return flask.jsonify(error='forcing refreshes requires the server to allow admin changes'), 403
+        return flask.jsonify({'refreshed': _get_sql_wrapper(app).refresh_summaries(names, force)})
+
+    @app.route('/metrics')
+    def metrics():
+        return flask.Response(app.config['metrics'].render(), mimetype=PROMETHEUS_MIMETYPE)
+
+    @app.route('/get_cache_stats')
+    def get_cache_stats():
+        logging.info('SqlWrapper - get_cache_stats')
+        return flask.jsonify(_get_sql_wrapper(app).get_cache_stats())
+
     return app
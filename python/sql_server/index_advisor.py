@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import re
+import threading
+import sqlalchemy.exc
+from sql_server.sqlalchemy_dsl import Criterion
+
+# a plain table scan in an SQLite query plan; scans using an index or the rowid are not matched
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?(?: AS \w+)?$')
+_SORT = re.compile(r'^USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY$')
+_EQUALITY = ('=', '==', 'IN')
+_RANGE = ('>', '>=', '<', '<=', 'BETWEEN')
+
+
+def get_plan_tree(rows):
+    """ rows - list of (id, parent, notused, detail) rows from EXPLAIN QUERY PLAN
+        returns the plan as a list of nodes {'id': int, 'detail': str, 'children': [nodes]}
+    """
+    nodes = {}
+    roots = []
+    for row in rows:
+        node_id, parent, detail = row[0], row[1], row[-1]
+        node = nodes[node_id] = {'id': node_id, 'detail': detail, 'children': []}
+        if parent in nodes:
+            nodes[parent]['children'].append(node)
+        else:
+            roots.append(node)
+    return roots
+
+
+def _iter_plan(nodes):
+    for node in nodes:
+        yield node
+        for child in _iter_plan(node['children']):
+            yield child
+
+
+def get_full_scans(plan):
+    """ plan - list - from get_plan_tree
+        returns the names of the tables the plan reads in full, in plan order
+    """
+    return [m.group(1) for m in (_FULL_SCAN.match(node['detail']) for node in _iter_plan(plan)) if m]
+
+
+def _get_conjunctive_criteria(where):
+    """ Criterion of a WHERE dict that every row must satisfy, i.e. not under an OR of several terms """
+    criteria = []
+    for conjunction, items in where.items():
+        if conjunction == 'AND' or len(items) == 1:
+            for x in items:
+                if isinstance(x, Criterion):
+                    criteria.append(x)
+                elif isinstance(x, dict):
+                    criteria.extend(_get_conjunctive_criteria(x))
+    return criteria
+
+
+class IndexAdvisor:
+    """ keeps a log of recently run DSL clauses (one entry per clause shape) and looks through their query plans
+        for tables that are read in full although the clause filters them, or sorts that have no index to
+        follow, and recommends CREATE INDEX statements for them: equality columns first, then one range
+        column, or the ORDER BY columns where there is nothing to filter on.
+    """
+
+    def __init__(self, max_clauses=200):
+        """ max_clauses - int - most distinct clause shapes kept in the log """
+        self._max_clauses = max_clauses
+        self._lock = threading.Lock()
+        self._log = OrderedDict()  # shape -> [shape, parametrized clause, params, times run]
+
+    def record(self, shape, parametrized_clause, params):
+        """ logs a clause that has been run; arguments as returned by parametrize_clause """
+        with self._lock:
+            entry = self._log.get(shape)
+            if entry is None:
+                entry = self._log[shape] = [shape, parametrized_clause, params, 0]
+            entry[2] = params  # keep the latest values, to explain the clause with
+            entry[3] += 1
+            self._log.move_to_end(shape)
+            while len(self._log) > self._max_clauses:
+                self._log.popitem(last=False)
+
+    def get_logged_clauses(self):
+        """ returns a list of (shape, parametrized clause, params, times run), most recent last """
+        with self._lock:
+            return [tuple(entry) for entry in self._log.values()]
+
+    def get_recommendations(self, metadata, explain, quote):
+        """ metadata - 'sqlalchemy.sql.schema.MetaData' - metadata for the database, with its indexes
+            explain - callable(shape, parametrized clause, params) returning a plan from get_plan_tree
+            quote - callable quoting an identifier for the database
+            returns a list of {'table', 'columns', 'sql', 'reason', 'clauses', 'runs'}, most run first;
+            'clauses' and 'runs' count the logged clauses that would use the index and how often they ran
+        """
+        recommendations = OrderedDict()  # (table, columns) -> recommendation
+        for shape, clause, params, runs in self.get_logged_clauses():
+            try:
+                plan = explain(shape, clause, params)
+            except (ValueError, sqlalchemy.exc.SQLAlchemyError):
+                continue  # e.g. the schema has changed since the clause was logged
+            for table, columns, reason in self._get_candidates(metadata, clause, plan):
+                if self._is_indexed(metadata.tables[table], columns):
+                    continue
+                key = (table, tuple(columns))
+                if key not in recommendations:
+                    name = re.sub(r'\W', '_', 'ix_' + table + '_' + '_'.join(columns))
+                    sql = 'CREATE INDEX IF NOT EXISTS {} ON {} ({});'.format(
+                        quote(name), quote(table), ', '.join(quote(c) for c in columns))
+                    recommendations[key] = {'table': table, 'columns': list(columns), 'sql': sql,
+                                            'reason': reason, 'clauses': 0, 'runs': 0}
+                recommendations[key]['clauses'] += 1
+                recommendations[key]['runs'] += runs
+        return sorted(recommendations.values(), key=lambda r: -r['runs'])
+
+    def _get_candidates(self, metadata, clause, plan):
+        """ yields (table, columns, reason) for the indexes that would help one clause """
+        scanned = [t for t in get_full_scans(plan) if t in metadata.tables]
+        where = _get_conjunctive_criteria(clause.get('WHERE', {}))
+        # with a full scan in the plan, an index on any filtered table helps: on the scanned table itself, or
+        # on another table of a join, which can then drive the join instead
+        filtered = []
+        for x in where:
+            if x._table_name not in filtered and x._table_name in metadata.tables:
+                filtered.append(x._table_name)
+        for table in (filtered if scanned else []):
+            equalities, ranges = [], []
+            for x in where:
+                if x._table_name != table or x._field_name_modifiers or x._field_name not in metadata.tables[table].c:
+                    continue
+                if x._comparison_operator in _EQUALITY and x._field_name not in equalities:
+                    equalities.append(x._field_name)
+                elif x._comparison_operator in _RANGE and x._field_name not in ranges:
+                    ranges.append(x._field_name)
+            columns = equalities + [c for c in ranges if c not in equalities][:1]
+            if columns:
+                yield table, columns, 'full scan of '+', '.join(scanned)+'; '+table+' filtered on '+', '.join(columns)
+
+        if any(_SORT.match(node['detail']) for node in _iter_plan(plan)) and not where and \
+                'GROUP BY' not in clause:
+            order_bys = clause.get('ORDER BY', [])
+            tables = {x._table_name for x in order_bys}
+            if order_bys and len(tables) == 1 and all(x._field_name_modifiers in ([], ['ASC']) for x in order_bys):
+                table = tables.pop()
+                if table in metadata.tables:
+                    yield table, [x._field_name for x in order_bys], 'sort of '+table+' for ORDER BY'
+
+    def _is_indexed(self, table, columns):
+        """ True if an existing index (or the primary key) starts with columns """
+        existing = [[c.name for c in table.primary_key.columns]] + [[c.name for c in i.columns] for i in table.indexes]
+        return any(e[:len(columns)] == list(columns) for e in existing)
@@ -0,0 +1,230 @@
+from sqlalchemy import event
+import flask
+import threading
+import time
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in pairs) + '}'
+
+
+def _format_value(v):
+    return repr(float(v)) if not isinstance(v, int) else str(v)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, labelvalues=()):
+        with self._lock:
+            self._values[tuple(labelvalues)] = self._values.get(tuple(labelvalues), 0) + amount
+
+    def get(self, labelvalues=()):
+        return self._values.get(tuple(labelvalues), 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(self.name + _format_labels(self._labelnames, labelvalues) + ' ' + _format_value(value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, labelvalues=()):
+        with self._lock:
+            v = self._values.setdefault(tuple(labelvalues), [0] * len(self._buckets) + [0.0, 0])
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    def get_count(self, labelvalues=()):
+        v = self._values.get(tuple(labelvalues))
+        return v[-1] if v else 0
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for labelvalues, v in sorted(self._values.items()):
+                for bound, count in zip(self._buckets, v):
+                    lines.append(self.name + '_bucket' +
+                                 _format_labels(self._labelnames, labelvalues, [('le', repr(float(bound)))]) +
+                                 ' ' + str(count))
+                lines.append(self.name + '_bucket' + _format_labels(self._labelnames, labelvalues, [('le', '+Inf')]) +
+                             ' ' + str(v[-1]))
+                lines.append(self.name + '_sum' + _format_labels(self._labelnames, labelvalues) + ' ' + repr(v[-2]))
+                lines.append(self.name + '_count' + _format_labels(self._labelnames, labelvalues) + ' ' + str(v[-1]))
+        return lines
+
+
+class Gauge:
+    """ a gauge whose samples are read from a callback at render time """
+
+    def __init__(self, name, documentation, labelnames, callback):
+        """ callback - callable returning a list of (labelvalues tuple, value) """
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._callback = callback
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} gauge'.format(self.name)]
+        for labelvalues, value in self._callback():
+            lines.append(self.name + _format_labels(self._labelnames, labelvalues) + ' ' + _format_value(value))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ returns all metrics in the Prometheus text exposition format """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _current_route():
+    if flask.has_request_context() and flask.request.url_rule is not None:
+        return flask.request.url_rule.rule
+    return 'none'
+
+
+class ServerMetrics:
+    """ per request timing for the flask app and its SqlWrapper.
+        request latency comes from before/teardown request handlers, so streamed responses are timed to the last byte;
+        DB time comes from SQLAlchemy cursor events plus the row fetches timed by SqlWrapper;
+        serialization time is the rest of the request: request latency less DB time.
+    """
+
+    def __init__(self, app, sql_wrapper):
+        self.registry = MetricsRegistry()
+        r = self.registry
+        self.request_seconds = r.register(Histogram('sql_server_request_seconds', 'request latency',
+                                                    ['route', 'method', 'status']))
+        self.db_seconds = r.register(Histogram('sql_server_db_seconds',
+                                               'time executing statements and fetching rows, per request',
+                                               ['route']))
+        self.serialization_seconds = r.register(Histogram('sql_server_serialization_seconds',
+                                                          'request time outside the database, per request',
+                                                          ['route']))
+        self.pool_checkout_seconds = r.register(Histogram('sql_server_pool_checkout_seconds',
+                                                          'wait for a pooled connection'))
+        self.statements = r.register(Counter('sql_server_statements_total', 'statements executed', ['route']))
+        self.rows = r.register(Counter('sql_server_rows_total', 'rows fetched from the database', ['route']))
+        self._sql_wrappers = []  # list of (cache label prefix, SqlWrapper)
+        r.register(Gauge('sql_server_cache', 'cache statistics from SqlWrapper', ['cache', 'stat'],
+                         lambda: [((prefix + cache, stat), value)
+                                  for prefix, w in self._sql_wrappers
+                                  for cache, stats in sorted(w.get_cache_stats().items())
+                                  for stat, value in sorted(stats.items())
+                                  if isinstance(value, (int, float)) and not isinstance(value, bool)]))
+        self._instrument_app(app)
+        self.add_sql_wrapper(sql_wrapper)
+
+    def add_sql_wrapper(self, sql_wrapper, database=None):
+        """ instruments the engines of a further SqlWrapper, e.g. for another database the server serves;
+            its caches are reported with the cache label prefixed by database + ':'
+        """
+        self._sql_wrappers.append(('' if database is None else database + ':', sql_wrapper))
+        for engine in sql_wrapper.get_engines():
+            self._instrument_engine(engine)
+        sql_wrapper.set_observer(self)
+
+    def _add_db_time(self, seconds):
+        if flask.has_request_context():
+            flask.g.sql_server_db_seconds = flask.g.get('sql_server_db_seconds', 0.0) + seconds
+
+    def _instrument_app(self, app):
+        @app.before_request
+        def start_timer():
+            flask.g.sql_server_request_start = time.perf_counter()
+            flask.g.sql_server_db_seconds = 0.0
+
+        @app.after_request
+        def record_status(response):
+            flask.g.sql_server_status = response.status_code
+            if response.is_streamed:
+                # the body is produced after this request handler returns; time it to when the response is closed
+                g = flask.g._get_current_object()
+                labels = (_current_route(), flask.request.method, response.status_code)
+                g.sql_server_deferred = True
+                response.call_on_close(lambda: self._record_request(g, labels))
+            return response
+
+        @app.teardown_request
+        def record_request(exc):
+            if not flask.g.get('sql_server_deferred'):
+                self._record_request(flask.g, (_current_route(), flask.request.method,
+                                               flask.g.get('sql_server_status', 500)))
+
+    def _record_request(self, g, labels):
+        start = g.get('sql_server_request_start')
+        if start is None:
+            return
+        g.sql_server_request_start = None
+        total = time.perf_counter() - start
+        db = g.get('sql_server_db_seconds', 0.0)
+        self.request_seconds.observe(total, labels)
+        self.db_seconds.observe(db, labels[:1])
+        self.serialization_seconds.observe(max(total - db, 0.0), labels[:1])
+
+    def _instrument_engine(self, engine):
+        # the start time is kept on the execution context, which goes away with the statement whether it
+        # succeeds or raises
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context._sql_server_start = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            start = getattr(context, '_sql_server_start', None)
+            if start is not None:
+                self._add_db_time(time.perf_counter() - start)
+            self.statements.inc(1, (_current_route(),))
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(exception_context):
+            start = getattr(exception_context.execution_context, '_sql_server_start', None)
+            if start is not None:  # a failed statement still took database time
+                self._add_db_time(time.perf_counter() - start)
+
+    # observer interface used by SqlWrapper
+    def checkout_wait(self, seconds):
+        self.pool_checkout_seconds.observe(seconds)
+
+    def rows_fetched(self, seconds, rows):
+        self._add_db_time(seconds)
+        self.rows.inc(rows, (_current_route(),))
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,156 @@
+import sqlalchemy as sa
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+from sql_server.sqlalchemy_dsl import Criterion
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
+
+
+def _encode_value(v):
+    """ returns a JSON friendly version of a sort key value """
+    if isinstance(v, datetime.datetime):
+        return {'datetime': v.isoformat()}
+    if isinstance(v, datetime.date):
+        return {'date': v.isoformat()}
+    if isinstance(v, decimal.Decimal):
+        return {'decimal': str(v)}
+    if isinstance(v, bytes):
+        return {'bytes': base64.b64encode(v).decode('ascii')}
+    return v
+
+
+def _decode_value(v):
+    if isinstance(v, dict) and len(v) == 1:
+        (kind, s), = v.items()
+        if kind == 'datetime':
+            return datetime.datetime.fromisoformat(s)
+        if kind == 'date':
+            return datetime.date.fromisoformat(s)
+        if kind == 'decimal':
+            return decimal.Decimal(s)
+        if kind == 'bytes':
+            return base64.b64decode(s)
+    return v
+
+
+class KeysetPagination:
+    """ pages through the rows of a DSL clause by seeking past the sort key of the previous page's last row
+        (keyset pagination), rather than with OFFSET, so every page costs about the same as the first one.
+        The clause's 'ORDER BY' (plain columns of the selected table, optionally 'ASC' or 'DESC') is completed
+        with the table's primary key so that the order is total, and the leading sort column must be the primary
+        key or the first column of an index, so that seeking is an index lookup rather than a sort of the table.
+        Page tokens are opaque strings that carry the last sort key and a fingerprint of the clause.
+    """
+
+    def __init__(self, metadata, clause, shape):
+        """ metadata - 'sqlalchemy.sql.schema.MetaData' - metadata for the SQL database
+            clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            shape - hashable - shape of the clause (see parametrize_clause), fingerprinted into page tokens
+        """
+        for k in ['GROUP BY', 'HAVING', 'LIMIT']:
+            if k in clause:
+                raise SqlAlchemyDslError('pagination does not support '+k)
+        selects = clause.get('SELECT', [])
+        tables = {x._table_name for x in selects if isinstance(x, Criterion)}
+        if len(tables) != 1:
+            raise SqlAlchemyDslError('pagination requires a SELECT from exactly one table')
+        table_name = tables.pop()
+        if table_name not in metadata.tables:
+            raise SqlAlchemyDslError('nonexistant table: '+str(table_name))
+        table = metadata.tables[table_name]
+
+        self._keys = []  # list of (column, descending)
+        for x in clause.get('ORDER BY', []):
+            direction = x._field_name_modifiers
+            if x._table_name != table_name or list(direction) not in ([], ['ASC'], ['DESC']):
+                raise SqlAlchemyDslError('pagination can only ORDER BY columns of '+table_name+', with ASC or DESC')
+            x.get_sqlalchemy_statement(metadata)  # validates the field
+            self._keys.append((table.columns[x._field_name], direction == ['DESC']))
+        if not table.primary_key.columns:
+            raise SqlAlchemyDslError('pagination requires a primary key on '+table_name)
+        for column in table.primary_key.columns:
+            if all(column is not c for c, _ in self._keys):
+                self._keys.append((column, False))
+
+        leading = self._keys[0][0]
+        leading_columns = [list(table.primary_key.columns)[0]] + [list(i.columns)[0] for i in table.indexes]
+        if all(leading is not c for c in leading_columns):
+            raise SqlAlchemyDslError('pagination requires the first ORDER BY column to be indexed: '+leading.name)
+        self._fingerprint = hashlib.sha1(repr(shape).encode('utf-8')).hexdigest()[:16]
+
+    def get_key_count(self):
+        """ number of sort key columns appended (after the selected columns) to the page statement """
+        return len(self._keys)
+
+    def make_token(self, key_values):
+        """ key_values - list - sort key of the last row on a page
+            returns the page token for the page after it
+        """
+        d = {'f': self._fingerprint, 'k': [_encode_value(v) for v in key_values]}
+        return base64.urlsafe_b64encode(json.dumps(d).encode('utf-8')).decode('ascii')
+
+    def read_token(self, token):
+        """ returns the sort key values held in token; raises SqlAlchemyDslError if token is not for this clause """
+        try:
+            d = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+            values = [_decode_value(v) for v in d['k']]
+            fingerprint = d['f']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise SqlAlchemyDslError('malformed page token')
+        if fingerprint != self._fingerprint or len(values) != len(self._keys):
+            raise SqlAlchemyDslError('page token does not belong to this query')
+        return values
+
+    def get_null_mask(self, key_values):
+        """ the seek predicate differs for NULL key values, so this is part of the statement's shape """
+        return None if key_values is None else tuple(v is None for v in key_values)
+
+    def get_statement(self, statement, null_mask, page_size):
+        """ statement - SQLAlchemy select built from the clause
+            null_mask - tuple<bool> or None - from get_null_mask; None for the first page
+            page_size - int - rows per page
+            returns the statement for one page: the sort key columns are appended as extra columns, and
+            page_size + 1 rows are asked for so the caller can tell whether another page follows.
+            Bind parameters k0, k1, ... take the values from read_token.
+        """
+        for i, (column, _) in enumerate(self._keys):
+            statement = statement.column(column.label('_key'+str(i)))
+        if null_mask is not None:
+            statement = statement.where(self._get_seek_predicate(null_mask))
+        order_bys = [sa.desc(c) if descending else sa.asc(c) for c, descending in self._keys]
+        return statement.order_by(None).order_by(*order_bys).limit(page_size + 1)
+
+    def _get_seek_predicate(self, null_mask):
+        """ rows strictly after the bound key in sort order; SQLite sorts NULL first ascending and last descending """
+        def bound(i):
+            return sa.bindparam('k'+str(i), type_=self._keys[i][0].type)
+
+        def equal(i):
+            column = self._keys[i][0]
+            return column.is_(None) if null_mask[i] else column == bound(i)
+
+        def after(i):
+            column, descending = self._keys[i]
+            if not descending:
+                return column.isnot(None) if null_mask[i] else column > bound(i)
+            if null_mask[i]:
+                return None  # nothing sorts after NULL descending
+            return sa.or_(column < bound(i), column.is_(None)) if column.nullable else column < bound(i)
+
+        terms = []
+        for i in range(len(self._keys)):
+            term = after(i)
+            if term is not None:
+                terms.append(sa.and_(*([equal(j) for j in range(i)] + [term])))
+        predicate = sa.or_(*terms) if terms else sa.false()
+        # a plain range on the leading column as well lets SQLite seek on its index
+        column, descending = self._keys[0]
+        if not null_mask[0] and not descending:
+            predicate = sa.and_(column >= bound(0), predicate)
+        elif not null_mask[0] and not column.nullable:
+            predicate = sa.and_(column <= bound(0), predicate)
+        elif null_mask[0] and descending:
+            predicate = sa.and_(column.is_(None), predicate)
+        return predicate
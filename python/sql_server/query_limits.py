@@ -0,0 +1,95 @@
+import threading
+import time
+
+
+class QueryInterruptedError(Exception):
+    """ raised when a statement is stopped by its QueryGuard; reason is 'timeout' or 'cancelled' """
+
+    def __init__(self, reason):
+        Exception.__init__(self, 'statement timeout' if reason == 'timeout' else 'statement cancelled')
+        self.reason = reason
+
+
+class LimitExceededError(Exception):
+    """ raised by ConcurrencyLimiter when a request may not start; status_code is 429 or 503 """
+
+    def __init__(self, message, status_code):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+class QueryGuard:
+    """ deadline and cancellation flag for the statements of one request. SqlWrapper installs check() as the
+        SQLite progress handler of the connections the request uses, so a statement that runs past the deadline,
+        or whose client has gone away, is interrupted between steps of the SQLite virtual machine.
+    """
+    # SQLite virtual machine instructions between calls to check()
+    PROGRESS_INTERVAL = 10000
+
+    def __init__(self, timeout=None, cancelled=None):
+        """ timeout - float or None - seconds from now after which statements are interrupted
+            cancelled - threading.Event or None - set when the request's client disconnects
+        """
+        self._deadline = time.monotonic() + timeout if timeout is not None else None
+        self._cancelled = cancelled
+        self.reason = None  # why check() asked to interrupt, once it has
+
+    def check(self):
+        """ returns True (interrupt) once the deadline has passed or the request is cancelled """
+        if self._cancelled is not None and self._cancelled.is_set():
+            self.reason = 'cancelled'
+        elif self._deadline is not None and time.monotonic() > self._deadline:
+            self.reason = 'timeout'
+        return self.reason is not None
+
+
+class ConcurrencyLimiter:
+    """ bounds the requests doing database work at once, overall and per client. A request over its client's
+        limit is rejected straight away (429); one over the overall limit waits at most queue_timeout for a
+        slot before it is rejected (503), so overload shows up as quick rejections rather than long queues.
+    """
+
+    def __init__(self, max_concurrent=None, max_per_client=None, queue_timeout=0.0):
+        """ max_concurrent - int or None - most requests at once over all clients; None for no limit
+            max_per_client - int or None - most requests at once from any one client; None for no limit
+            queue_timeout - float - seconds a request may wait for one of the max_concurrent slots
+        """
+        self._semaphore = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self._max_per_client = max_per_client
+        self._queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._clients = {}  # client -> requests in flight
+        self._rejected = {429: 0, 503: 0}
+
+    def acquire(self, client):
+        """ client - hashable - identifies who the request is from
+            raises LimitExceededError if the request may not start; otherwise release(client) must follow
+        """
+        with self._lock:
+            if self._max_per_client is not None and self._clients.get(client, 0) >= self._max_per_client:
+                self._rejected[429] += 1
+                raise LimitExceededError('too many concurrent requests from this client', 429)
+            self._clients[client] = self._clients.get(client, 0) + 1
+        if self._semaphore is not None and not self._semaphore.acquire(timeout=self._queue_timeout):
+            self._release_client(client)
+            with self._lock:
+                self._rejected[503] += 1
+            raise LimitExceededError('server is at its concurrent request limit', 503)
+
+    def _release_client(self, client):
+        with self._lock:
+            self._clients[client] -= 1
+            if not self._clients[client]:
+                del self._clients[client]
+
+    def release(self, client):
+        if self._semaphore is not None:
+            self._semaphore.release()
+        self._release_client(client)
+
+    def get_stats(self):
+        with self._lock:
+            return {'in_flight': sum(self._clients.values()),
+                    'clients': len(self._clients),
+                    'rejected_429': self._rejected[429],
+                    'rejected_503': self._rejected[503]}
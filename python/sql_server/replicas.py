@@ -0,0 +1,116 @@
+from sqlalchemy import event
+from sqlalchemy import exc
+import logging
+import threading
+
+
+class ReplicaSet:
+    """ read replicas of one database, each an engine with its own connection pool. connect() hands out a connection
+        from the healthy replica with the fewest connections in use, taking turns between equals, so reads spread
+        over all of them. A replica that fails to connect is left out of turn until it passes a health check
+        ('SELECT 1'), which a background thread runs on every replica each check_interval seconds.
+        Replicas must hold the same schema as the primary (e.g. the same SQLite file opened read-only, or copies of
+        it kept in sync); reads from a replica that lags the primary see its older data.
+    """
+
+    def __init__(self, engines, check_interval=5.0):
+        """ engines - list<'sqlalchemy.engine.Engine'> - one engine per replica
+            check_interval - float or None - seconds between health checks; None for no background checks
+        """
+        self._engines = list(engines)
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._healthy = [True] * len(self._engines)
+        self._in_use = [0] * len(self._engines)
+        self._connections = [0] * len(self._engines)
+        self._failures = [0] * len(self._engines)
+        self._turn = 0
+        self._checker = None
+        self._stopped = threading.Event()
+        for i, engine in enumerate(self._engines):
+            event.listen(engine, 'checkout', lambda *args, i=i: self._count_in_use(i, 1))
+            event.listen(engine, 'checkin', lambda *args, i=i: self._count_in_use(i, -1))
+
+    def _count_in_use(self, i, n):
+        with self._lock:
+            self._in_use[i] += n
+
+    def get_engines(self):
+        return list(self._engines)
+
+    def _choose(self, tried):
+        """ index of the healthy replica not in tried with the fewest connections in use, or None """
+        with self._lock:
+            n = len(self._engines)
+            candidates = [i for i in range(n) if self._healthy[i] and i not in tried]
+            if not candidates:
+                return None
+            i = min(candidates, key=lambda i: (self._in_use[i], (i - self._turn) % n))
+            self._turn = (i + 1) % n
+            return i
+
+    def _set_healthy(self, i, healthy):
+        with self._lock:
+            if self._healthy[i] != healthy:
+                logging.warning('replica '+repr(self._engines[i].url)+(' is back' if healthy else ' is down'))
+            self._healthy[i] = healthy
+            if not healthy:
+                self._failures[i] += 1
+
+    def connect(self):
+        """ returns a connection from a healthy replica, or None if no replica can be connected to """
+        self._start_checker()
+        tried = set()
+        while True:
+            i = self._choose(tried)
+            if i is None:
+                return None
+            tried.add(i)
+            try:
+                conn = self._engines[i].connect()
+            except exc.DBAPIError:
+                self._set_healthy(i, False)
+                continue
+            with self._lock:
+                self._connections[i] += 1
+            return conn
+
+    def check(self):
+        """ runs the health check on every replica now; returns the list of which ones are healthy """
+        for i, engine in enumerate(self._engines):
+            try:
+                with engine.connect() as conn:
+                    conn.execute('SELECT 1;').scalar()
+                healthy = True
+            except exc.DBAPIError:
+                healthy = False
+            self._set_healthy(i, healthy)
+        with self._lock:
+            return list(self._healthy)
+
+    def _run_checks(self):
+        while not self._stopped.wait(self._check_interval):
+            self.check()
+
+    def _start_checker(self):
+        # started by the first connect rather than in the constructor, so that no thread exists before a fork
+        if self._check_interval is None or self._checker is not None:
+            return
+        with self._lock:
+            if self._checker is None:
+                self._checker = threading.Thread(target=self._run_checks, name='sql_server_replica_check',
+                                                 daemon=True)
+                self._checker.start()
+
+    def close(self):
+        """ stops the health checks and closes the replicas' pooled connections """
+        self._stopped.set()
+        for engine in self._engines:
+            engine.dispose()
+
+    def get_stats(self):
+        """ returns a list with {'url', 'healthy', 'in_use', 'connections', 'failures'} for each replica """
+        with self._lock:
+            return [{'url': repr(engine.url), 'healthy': self._healthy[i], 'in_use': self._in_use[i],
+                     'connections': self._connections[i], 'failures': self._failures[i]}
+                    for i, engine in enumerate(self._engines)]
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+import sys
+import threading
+import time
+from sql_server.query_limits import QueryInterruptedError
+
+
+def _freeze(x):
+    """ returns a hashable version of bind parameter values """
+    if isinstance(x, (list, tuple)):
+        return tuple(_freeze(v) for v in x)
+    if isinstance(x, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in x.items()))
+    return x
+
+
+def estimate_bytes(value):
+    """ rough size in bytes of a (columns, rows) result, or of nested lists/tuples of plain values """
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_bytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class _Pending:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """ LRU cache of query results, keyed on normalised SQL plus bind parameters.
+        The cache has a byte budget (sizes are estimated), an optional TTL, and is emptied whenever the
+        version token from version_fn changes (see DataVersionMonitor); with no version token nothing is stored.
+        Concurrent misses for the same key are coalesced: one caller runs the query, the others wait for its result.
+        If the query is stopped by the running caller's own timeout or cancellation, the others run it themselves.
+    """
+
+    def __init__(self, version_fn, max_bytes=64 * 1024 * 1024, ttl=None):
+        """ version_fn - callable returning a hashable token that changes with the data, or None if unknown
+            max_bytes - int - budget for all cached results; a single result may use at most a quarter of it.
+                              0 disables caching (identical concurrent requests are still coalesced)
+            ttl - float or None - seconds a result may be served for, regardless of the data version
+        """
+        self._version_fn = version_fn
+        self._max_bytes = max_bytes
+        self._max_entry_bytes = max_bytes // 4
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, nbytes, stored at)
+        self._pending = {}  # key -> _Pending
+        self._version = None
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def make_key(self, compiled, params):
+        """ compiled - compiled SQLAlchemy statement
+            params - dict - bind parameter values to execute it with
+        """
+        sql = ' '.join(str(compiled).split())
+        return sql, _freeze(dict(compiled.params, **params))
+
+    def _check_version(self, version):
+        """ drops everything if the data version has moved; call with the lock held """
+        if version != self._version:
+            if self._entries:
+                self._invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def lookup(self, key):
+        """ returns (hit, value, version); pass version on to store() once a missed result has been computed """
+        version = self._version_fn()
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and self._ttl is not None and time.monotonic() - entry[2] > self._ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return False, None, version
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return True, entry[0], version
+
+    def _drop(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def store(self, key, value, version, nbytes=None):
+        """ caches value for key, unless the data has changed since version was read from lookup() """
+        if version is None or self._max_bytes <= 0:
+            return
+        nbytes = estimate_bytes(value) if nbytes is None else nbytes
+        if nbytes > self._max_entry_bytes:
+            return
+        with self._lock:
+            self._check_version(self._version_fn())
+            if version != self._version:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, nbytes, time.monotonic())
+            self._bytes += nbytes
+            while self._bytes > self._max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._evictions += 1
+
+    def get_max_entry_bytes(self):
+        return self._max_entry_bytes
+
+    def get_or_compute(self, key, compute):
+        """ compute - callable returning the result for key
+            returns (result, source) where source is 'cache', 'coalesced' (computed by a concurrent caller) or 'computed'
+        """
+        while True:
+            hit, value, version = self.lookup(key)
+            if hit:
+                return value, 'cache'
+            with self._lock:
+                pending = self._pending.get(key)
+                leader = pending is None
+                if leader:
+                    pending = self._pending[key] = _Pending()
+            if leader:
+                break
+            pending.event.wait()
+            if isinstance(pending.error, QueryInterruptedError):
+                continue  # the limit was the other caller's, not this one's; run the query again
+            if pending.error is not None:
+                raise pending.error
+            with self._lock:
+                self._coalesced += 1
+            return pending.value, 'coalesced'
+        try:
+            pending.value = compute()
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+        self.store(key, pending.value, version)
+        return pending.value, 'computed'
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'coalesced': self._coalesced,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes}
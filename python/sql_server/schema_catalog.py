@@ -0,0 +1,94 @@
+import sqlalchemy as sa
+import threading
+import time
+
+
+class SchemaCatalog:
+    """ caches the table names, columns and reflected MetaData of a database, so that requests do not
+        go back to the database catalog on every call.
+        Once the ttl has expired the catalog is revalidated; for SQLite this is a single 'PRAGMA schema_version',
+        and the schema is only reflected again if the version has moved. Other dialects reflect again on expiry.
+    """
+
+    def __init__(self, engine, ttl=30.0):
+        """ engine - 'sqlalchemy.engine.Engine' - engine for the database to catalog
+            ttl - float or None - seconds for which the catalog is trusted without revalidation;
+                                  None means never revalidate (refresh() can still be called)
+        """
+        self._engine = engine
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._metadata = None
+        self._table_names = []
+        self._columns = {}
+        self._schema_version = None
+        self._checked_at = None
+        self._hits = 0
+        self._misses = 0
+        self._refreshes = 0
+
+    def _get_schema_version(self, connectable):
+        """ returns the SQLite schema cookie, or None for dialects without one """
+        if self._engine.dialect.name == 'sqlite':
+            return connectable.execute('PRAGMA schema_version;').scalar()
+        return None
+
+    def _load(self, schema_version, connectable):
+        metadata = sa.MetaData()
+        metadata.reflect(connectable)
+        self._metadata = metadata
+        self._table_names = sorted(metadata.tables.keys())
+        self._columns = {name: [c.name for c in table.columns] for name, table in metadata.tables.items()}
+        self._schema_version = schema_version
+        self._refreshes += 1
+
+    def _ensure_current(self, connectable=None):
+        """ connectable - engine or connection to revalidate on; defaults to the engine. Callers that hold a
+                          pooled connection pass it, rather than take a second one from the pool
+        """
+        connectable = connectable if connectable is not None else self._engine
+        with self._lock:
+            now = time.monotonic()
+            if self._metadata is not None and (self._ttl is None or now - self._checked_at < self._ttl):
+                self._hits += 1
+                return
+            self._misses += 1
+            schema_version = self._get_schema_version(connectable)
+            if self._metadata is None or schema_version is None or schema_version != self._schema_version:
+                self._load(schema_version, connectable)
+            self._checked_at = now
+
+    def refresh(self):
+        """ unconditionally reflects the schema again """
+        with self._lock:
+            self._load(self._get_schema_version(self._engine), self._engine)
+            self._checked_at = time.monotonic()
+
+    def get_table_names(self):
+        self._ensure_current()
+        return list(self._table_names)
+
+    def has_table(self, table, connectable=None):
+        self._ensure_current(connectable)
+        return table in self._columns
+
+    def get_columns(self, table):
+        """ returns the list of column names for table, or None if the table does not exist """
+        self._ensure_current()
+        columns = self._columns.get(table)
+        return list(columns) if columns is not None else None
+
+    def get_metadata(self):
+        """ returns the reflected 'sqlalchemy.MetaData'; treat as read only, it is shared between requests """
+        self._ensure_current()
+        return self._metadata
+
+    def get_generation(self):
+        """ returns a number that changes every time the schema is reflected again """
+        return self._refreshes
+
+    def get_stats(self):
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'refreshes': self._refreshes,
+                'schema_version': self._schema_version}
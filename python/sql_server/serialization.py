@@ -0,0 +1,158 @@
+import datetime
+import decimal
+import importlib.util
+import logging
+
+# Arrow output is optional; JSON is always available. pyarrow is slow to import, so it is only imported
+# by the first response that is sent as Arrow (see _import_pyarrow)
+pyarrow = None
+
+JSON_MIMETYPE = 'application/json'
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+_ARROW_END_OF_STREAM = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+
+class SerializationError(ValueError):
+    pass
+
+
+def _import_pyarrow():
+    """ imports pyarrow on first use; returns the module, or None if it is not installed """
+    global pyarrow
+    if pyarrow is None and importlib.util.find_spec('pyarrow') is not None:
+        import pyarrow as module
+        pyarrow = module
+    return pyarrow
+
+
+def is_arrow_available():
+    return _import_pyarrow() is not None
+
+
+def get_response_mimetype(accept_mimetypes):
+    """ accept_mimetypes - 'werkzeug.datastructures.MIMEAccept' - the request's Accept header
+        returns the mimetype to respond with; JSON unless the client prefers Arrow.
+        Raises SerializationError if the client only accepts Arrow and pyarrow is not installed.
+    """
+    best = accept_mimetypes.best_match([JSON_MIMETYPE, ARROW_STREAM_MIMETYPE], default=JSON_MIMETYPE)
+    if best == ARROW_STREAM_MIMETYPE and _import_pyarrow() is None:
+        if accept_mimetypes.quality(JSON_MIMETYPE):
+            return JSON_MIMETYPE
+        raise SerializationError(ARROW_STREAM_MIMETYPE+' requested, but pyarrow is not installed')
+    return best
+
+
+def _get_arrow_type(sql_type):
+    """ sql_type - 'sqlalchemy.types.TypeEngine' or None - type of a result column
+        returns the Arrow type for the column, or None if the SQL type says nothing about its values
+    """
+    try:
+        python_type = sql_type.python_type
+    except (AttributeError, NotImplementedError):  # e.g. NullType, for expressions of unknown type
+        return None
+    arrow_types = {bool: pyarrow.bool_(), int: pyarrow.int64(), float: pyarrow.float64(),
+                   decimal.Decimal: pyarrow.float64(), str: pyarrow.string(), bytes: pyarrow.binary(),
+                   datetime.datetime: pyarrow.timestamp('us'), datetime.date: pyarrow.date32(),
+                   datetime.time: pyarrow.time64('us')}
+    return arrow_types.get(python_type)
+
+
+def _infer_arrow_type(values):
+    """ picks the Arrow type for a column of unknown SQL type from its first batch of values """
+    arrow_type = pyarrow.array(values).type
+    if pyarrow.types.is_null(arrow_type):
+        return pyarrow.string()  # nothing to go on; SQLite values with no type are most often text
+    if pyarrow.types.is_decimal(arrow_type):
+        return pyarrow.float64()  # the precision seen in one batch need not hold for the next
+    return arrow_type
+
+
+def _cast_value(value, arrow_type):
+    """ converts a value that does not fit its column's Arrow type, as SQLite allows any value in any column;
+        returns None if there is no faithful conversion
+    """
+    if value is None:
+        return None
+    if pyarrow.types.is_string(arrow_type):
+        return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+    try:
+        if pyarrow.types.is_integer(arrow_type):
+            number = decimal.Decimal(str(value))
+            if number == number.to_integral_value() and -2 ** 63 <= number < 2 ** 63:
+                return int(number)
+            return None
+        if pyarrow.types.is_floating(arrow_type):
+            return float(value)
+    except (ArithmeticError, ValueError, TypeError):
+        pass
+    return None
+
+
+def _to_arrow_array(values, arrow_type, name):
+    if pyarrow.types.is_floating(arrow_type):
+        values = [float(v) if isinstance(v, decimal.Decimal) else v for v in values]
+    try:
+        return pyarrow.array(values, type=arrow_type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+        # the schema has been sent already, so the values are made to fit it
+        cast = [_cast_value(v, arrow_type) for v in values]
+        lost = sum(v is not None and c is None for v, c in zip(values, cast))
+        if lost:
+            logging.warning('arrow - '+str(lost)+' values of column '+name+' do not fit '+str(arrow_type)+
+                            ' and are sent as null')
+        return pyarrow.array(cast, type=arrow_type)
+
+
+def get_arrow_schema(columns, sql_types=None):
+    """ columns - list<str> - column names
+        sql_types - list<'sqlalchemy.types.TypeEngine'> or None - SQL type of each column, e.g. from
+                    SqlWrapper.get_result_types
+        the Arrow schema for columns when there are no rows to infer types from; string where the type is unknown
+    """
+    _import_pyarrow()
+    arrow_types = [_get_arrow_type(t) for t in sql_types] if sql_types is not None else [None] * len(columns)
+    return pyarrow.schema([(name, t if t is not None else pyarrow.string()) for name, t in zip(columns, arrow_types)])
+
+
+def iter_record_batches(columns, batches, sql_types=None):
+    """ columns - list<str> - column names
+        batches - iterable<list<tuple>> - batches of rows, e.g. from SqlWrapper.iter_clause_rows
+        sql_types - list<'sqlalchemy.types.TypeEngine'> or None - SQL type of each column, e.g. from
+                    SqlWrapper.get_result_types
+        generator; yields a 'pyarrow.RecordBatch' for each batch of rows, converted column-wise without building
+        per-row objects. The schema is fixed before the first batch: from sql_types where they are known, and
+        inferred from the first batch otherwise. Values in later batches that do not fit it are cast to it.
+        Nothing is yielded if there are no batches.
+    """
+    _import_pyarrow()
+    arrow_types = [_get_arrow_type(t) for t in sql_types] if sql_types is not None else [None] * len(columns)
+    schema = None
+    for batch in batches:
+        column_values = [list(c) for c in zip(*batch)] if batch else [[] for _ in columns]
+        if schema is None:
+            schema = pyarrow.schema([(name, t if t is not None else _infer_arrow_type(values))
+                                     for name, t, values in zip(columns, arrow_types, column_values)])
+        arrays = [_to_arrow_array(values, field.type, field.name) for values, field in zip(column_values, schema)]
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_arrow_stream(columns, batches, sql_types=None):
+    """ columns - list<str> - column names
+        batches - iterable<list<tuple>> - batches of rows, e.g. from SqlWrapper.iter_clause_rows
+        sql_types - list<'sqlalchemy.types.TypeEngine'> or None - SQL type of each column (see iter_record_batches)
+        generator; yields bytes of an Arrow IPC stream, one record batch per batch of rows (see iter_record_batches)
+    """
+    schema = None
+    for record_batch in iter_record_batches(columns, batches, sql_types):
+        if schema is None:
+            schema = record_batch.schema
+            yield schema.serialize().to_pybytes()
+        yield record_batch.serialize().to_pybytes()
+    if schema is None:  # no rows at all; still send a schema so the client sees the columns
+        yield get_arrow_schema(columns, sql_types).serialize().to_pybytes()
+    yield _ARROW_END_OF_STREAM
+
+
+def get_arrow_bytes(columns, rows, sql_types=None):
+    """ returns an Arrow IPC stream holding rows as a single record batch """
+    return b''.join(iter_arrow_stream(columns, [rows], sql_types))
@@ -1,13 +1,60 @@
-from cheroot.wsgi import Server as WSGIServer
-from cheroot.wsgi import PathInfoDispatcher
-from sql_server.flask_app import create_app
 import os.path
 import os
 from argparse import ArgumentParser
+from contextlib import contextmanager
+from urllib.parse import quote
+import json
 import logging
+import re
+import signal
+import threading
 import time
 import sys
 
+# cheroot, flask, SQLAlchemy and the app modules are slow to import, so the functions that need them import them:
+# a process only loads what its mode uses, and the supervisor of --workers loads them once, before it forks
+_MODULE_LOADED = time.perf_counter()
+
+
+class StartupProfile:
+    """ times the phases of starting the server (--startup_profile): each phase is reported as it ends, as a line
+        of JSON in the log, with its duration and the seconds since this module was imported
+    """
+
+    def __init__(self, enabled=False):
+        """ enabled - bool - if False nothing is recorded """
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._phases = []  # list of {'phase', 'seconds', 'since_start'}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def mark(self, name):
+        """ records that name happened now, the first time only, e.g. the first request """
+        self._record(name, 0.0, once=True)
+
+    def _record(self, name, seconds, once=False):
+        if not self._enabled:
+            return
+        with self._lock:
+            if once and any(p['phase'] == name for p in self._phases):
+                return
+            p = {'phase': name, 'seconds': round(seconds, 6),
+                 'since_start': round(time.perf_counter() - _MODULE_LOADED, 6)}
+            self._phases.append(p)
+        line = 'startup profile: ' + json.dumps(p)
+        logging.info(line)
+
+    def get_phases(self):
+        with self._lock:
+            return [dict(p) for p in self._phases]
+
 
 def _parse_args(cmd_line_args):
     this_dir = os.path.abspath(os.path.dirname(__file__))
@@ -15,8 +62,98 @@ def _parse_args(cmd_line_args):
     parser.add_argument('--sql_source',
                         default='sqlite:///'+os.path.join(this_dir, '..', 'tests', 'data', 'chinook.db'),
                         help='SQL data source as a string; used to create SQLAlchemy engine')
+    parser.add_argument('--database', default=[], action='append', metavar='NAME=URL',
+                        help='a further database to serve as NAME, for requests that name it in an X-Database header '
+                             'or a database query argument; may be repeated')
+    parser.add_argument('--replica', default=[], action='append', metavar='[NAME=]URL',
+                        help='a read replica of database NAME (of --sql_source without a NAME) to spread its reads '
+                             'over; SQLite files are opened read-only; may be repeated')
+    parser.add_argument('--health_check_interval', default=5.0, type=float,
+                        help='seconds between health checks of the replicas')
+    parser.add_argument('--mode', default='wsgi', choices=['wsgi', 'asgi'],
+                        help='wsgi: cheroot thread per request; asgi: uvicorn event loop with a bounded worker pool')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='number of worker processes serving the port, each with its own app and connections; '
+                             'with a writable SQLite file, also give --journal_mode')
+    parser.add_argument('--read_only', action='store_true', help='open an SQLite database read-only')
     parser.add_argument('--url', default='127.0.0.1', help='URL of server')
     parser.add_argument('--port', default=8000, type=int, help='port number of server')
+    parser.add_argument('--threads', default=None, type=int,
+                        help='number of server worker threads; defaults to pool_size, so that the overflow '
+                             'connections are left for background work')
+    parser.add_argument('--max_pending', default=100, type=int,
+                        help='asgi mode: requests waiting for a worker thread before new requests get 503')
+    parser.add_argument('--pool_class', default='QueuePool',
+                        choices=['default', 'QueuePool', 'SingletonThreadPool', 'StaticPool', 'NullPool'],
+                        help="SQLAlchemy pool class for the engine; 'default' lets SQLAlchemy choose")
+    parser.add_argument('--pool_size', default=10, type=int,
+                        help='number of pooled connections (QueuePool), one for each server thread')
+    parser.add_argument('--max_overflow', default=None, type=int,
+                        help='connections allowed beyond pool_size (QueuePool), for work off the server threads: '
+                             'exports, summary refreshes and the warm-up. Defaults to export_workers + 2, so that '
+                             'background work never waits on busy request threads; with --threads above pool_size '
+                             'raise it by as much')
+    parser.add_argument('--check_same_thread', action='store_true',
+                        help='keep the sqlite3 check that a connection is only used on the thread that made it; '
+                             'off by default so pooled connections can move between server threads')
+    parser.add_argument('--journal_mode', default=None, choices=['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'],
+                        help='SQLite journal_mode pragma, e.g. WAL so readers do not block on a writer; note that '
+                             'the mode is stored in the database file')
+    parser.add_argument('--busy_timeout', default=5000, type=int,
+                        help='SQLite busy_timeout pragma in ms; how long to wait on a locked database')
+    parser.add_argument('--mmap_size', default=None, type=int, help='SQLite mmap_size pragma in bytes')
+    parser.add_argument('--cache_size', default=None, type=int,
+                        help='SQLite cache_size pragma; pages if positive, KiB if negative')
+    parser.add_argument('--schema_ttl', default=30.0, type=float,
+                        help='seconds the cached schema catalog is trusted before checking for schema changes')
+    parser.add_argument('--query_row_limit', default=100000, type=int, help='most rows returned by /query')
+    parser.add_argument('--query_batch_size', default=1000, type=int,
+                        help='rows fetched from the cursor and sent per chunk by /query')
+    parser.add_argument('--statement_cache_size', default=256, type=int,
+                        help='most compiled DSL statements cached for reuse; 0 disables the cache')
+    parser.add_argument('--result_cache_mb', default=64, type=int,
+                        help='memory budget in MiB for cached query results; 0 disables the cache')
+    parser.add_argument('--result_cache_ttl', default=None, type=float,
+                        help='seconds a cached query result may be served for; by default until the data changes')
+    parser.add_argument('--statement_timeout', default=None, type=float,
+                        help='seconds the statements of a request may run for before they are interrupted')
+    parser.add_argument('--max_concurrent_queries', default=None, type=int,
+                        help='most requests doing database work at once; more are rejected with 503')
+    parser.add_argument('--max_client_queries', default=None, type=int,
+                        help='most requests doing database work at once per client; more are rejected with 429')
+    parser.add_argument('--queue_timeout', default=0.0, type=float,
+                        help='seconds a request may wait for one of the --max_concurrent_queries slots')
+    parser.add_argument('--compression', default='zstd,gzip',
+                        help="content codings offered to clients, preferred first, e.g. 'gzip'; 'none' to disable; "
+                             "zstd needs the zstandard package")
+    parser.add_argument('--compression_min_bytes', default=1024, type=int,
+                        help='bytes under which responses are sent uncompressed; streamed ones are always compressed')
+    parser.add_argument('--compression_level', default=None, type=int,
+                        help="compression level; defaults to each coding's own default")
+    parser.add_argument('--no_etags', action='store_true',
+                        help='do not send ETags, nor answer If-None-Match requests with 304 Not Modified')
+    parser.add_argument('--export_dir', default=None,
+                        help='directory for the files written by /exports; defaults to a new temporary directory')
+    parser.add_argument('--export_workers', default=2, type=int,
+                        help='exports run at once, on background threads apart from the server threads')
+    parser.add_argument('--export_ttl', default=3600.0, type=float,
+                        help='seconds finished exports, and their files, are kept for download')
+    parser.add_argument('--export_timeout', default=None, type=float,
+                        help="seconds an export's statement may run for")
+    parser.add_argument('--summaries', default=None, metavar='FILE',
+                        help='JSON file listing summary tables to keep for grouped queries, each {"name": ..., '
+                             '"CLAUSE": ..., "refresh": "full" or "incremental", "interval": seconds, '
+                             '"database": NAME} (all but name and CLAUSE optional); SQLite only')
+    parser.add_argument('--summary_check_interval', default=10.0, type=float,
+                        help='seconds between checks for summary tables to refresh')
+    parser.add_argument('--allow_admin', action='store_true',
+                        help='allow endpoints that change the database, e.g. /index_advice applying indexes')
+    parser.add_argument('--no_warm_up', action='store_true',
+                        help='leave connecting and reflecting the schema to the first request, rather than doing '
+                             'it on a background thread as the server starts')
+    parser.add_argument('--startup_profile', '--startup-profile', action='store_true',
+                        help='report how long importing and initializing each part of the server takes, '
+                             'in the log')
     parser.add_argument('--log', default='sql_server.log', help='file name and path for output log file')
     args = vars(parser.parse_args(cmd_line_args))
     return args
@@ -32,20 +169,286 @@ def _get_logger(args):
     return logger
 
 
-def get_server(cmd_line_args):
+def _get_engine_kwargs(args, sql_source=None):
+    """ returns the kwargs for sqlalchemy.create_engine from the parsed command line args
+        sql_source - str or None - URL of the database the engine is for; defaults to --sql_source
+    """
+    import sqlalchemy.pool
+    from sqlalchemy.engine.url import make_url
+    kwargs = {}
+    if args['pool_class'] != 'default':
+        kwargs['poolclass'] = getattr(sqlalchemy.pool, args['pool_class'])
+        if args['pool_class'] == 'QueuePool':
+            kwargs['pool_size'] = args['pool_size']
+            kwargs['max_overflow'] = _get_max_overflow(args)
+    if make_url(sql_source or args['sql_source']).get_backend_name() == 'sqlite':
+        kwargs['connect_args'] = {'check_same_thread': args['check_same_thread']}
+    return kwargs
+
+
+def _is_sqlite_file(sql_source):
+    from sqlalchemy.engine.url import make_url
+    url = make_url(sql_source)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def _to_read_only(sql_source):
+    """ returns an SQLite file URL as a read-only URI; other URLs, and URIs already, are returned as they are """
+    from sqlalchemy.engine.url import make_url
+    if not _is_sqlite_file(sql_source) or make_url(sql_source).query.get('uri'):
+        return sql_source
+    return 'sqlite:///file:' + quote(make_url(sql_source).database) + '?mode=ro&uri=true'
+
+
+def _get_sql_source(args, sql_source=None):
+    """ returns the database URL (--sql_source by default), turned into a read-only SQLite URI if --read_only
+        was given
+    """
+    sql_source = sql_source or args['sql_source']
+    return _to_read_only(sql_source) if args['read_only'] else sql_source
+
+
+def _split_name(value):
+    """ splits 'NAME=URL' into (NAME, URL); returns (None, value) if value does not start with a database name """
+    name, sep, url = value.partition('=')
+    if sep and re.match(r'^[A-Za-z0-9_.-]+$', name):
+        return name, url
+    return None, value
+
+
+def _get_databases(args):
+    """ returns (the replica args for --sql_source, the further databases as create_app takes them), from the
+        --database and --replica args
+    """
+    databases = {}
+    for value in args['database']:
+        name, url = _split_name(value)
+        if name is None or name == 'default' or name in databases:
+            raise ValueError('--database needs NAME=URL with a NAME of its own: '+value)
+        databases[name] = {'engine_args_list': [_get_sql_source(args, url)],
+                           'engine_kwargs_dict': _get_engine_kwargs(args, url), 'replica_args_lists': []}
+    replicas = []
+    for value in args['replica']:
+        name, url = _split_name(value)
+        if name not in (None, 'default') and name not in databases:
+            raise ValueError('--replica of a database that is not served: '+value)
+        # nothing is written to a replica
+        replica_args = [_to_read_only(url)]
+        if name in (None, 'default'):
+            replicas.append(replica_args)
+        else:
+            databases[name]['replica_args_lists'].append(replica_args)
+    return replicas, databases
+
+
+def _get_summaries(args, databases):
+    """ returns the summaries of the default database from the --summaries file, adding those of the further
+        databases to their kwargs in databases
+    """
+    if args['summaries'] is None:
+        return []
+    from sql_server.sqlalchemy_dsl import get_clause_from_json
+    with open(args['summaries']) as f:
+        summaries = get_clause_from_json(f.read())
+    if not isinstance(summaries, list):
+        raise ValueError('--summaries needs a JSON list of summaries')
+    default = []
+    for summary in summaries:
+        name = summary.pop('database', 'default') if isinstance(summary, dict) else 'default'
+        if name == 'default':
+            default.append(summary)
+        elif name in databases:
+            databases[name].setdefault('summaries', []).append(summary)
+        else:
+            raise ValueError('summary of a database that is not served: '+str(name))
+    return default
+
+
+def _get_sqlite_pragmas(args):
+    from sql_server.sql_wrapper import SqlWrapper
+    pragmas = {k: args[k] for k in SqlWrapper.SQLITE_PRAGMAS}
+    if args['workers'] > 1 and not args['read_only'] and pragmas['journal_mode'] is None and \
+            _is_sqlite_file(args['sql_source']):
+        # the journal mode is stored in the database file, so it is not changed without being asked for
+        raise ValueError('--workers > 1 share the SQLite file: choose its --journal_mode (WAL lets readers '
+                         'neither block nor be blocked by a writer), or open it --read_only')
+    return pragmas
+
+
+def _get_max_overflow(args):
+    """ connections beyond pool_size default to one for each export worker, plus one each for the summary
+        refresher and the warm-up, which hold connections while every server thread may hold one of its own
+    """
+    if args['max_overflow'] is not None:
+        return args['max_overflow']
+    return args['export_workers'] + 2
+
+
+def _get_num_threads(args):
+    """ server threads default to pool_size, so that requests neither queue on the pool nor leave connections
+        idle, while the overflow connections stay free for background work
+    """
+    if args['threads'] is not None:
+        return args['threads']
+    if args['pool_class'] == 'QueuePool':
+        return args['pool_size']
+    return 10  # cheroot default
+
+
+def _get_compression_encodings(args):
+    encodings = [e.strip() for e in args['compression'].split(',') if e.strip() and e.strip() != 'none']
+    unknown = set(encodings) - {'zstd', 'gzip'}
+    if unknown:
+        raise ValueError('unsupported --compression: '+', '.join(sorted(unknown)))
+    return encodings
+
+
+def _warm_up(databases, profile):
+    with profile.phase('warm_up'):
+        for name, sql_wrapper in databases.items():
+            try:
+                sql_wrapper.warm_up()
+            except Exception:
+                logging.exception('warm up of database '+name+' failed; the first requests will connect instead')
+
+
+def _get_app(args, profile):
+    """ creates the flask app and, unless --no_warm_up, starts warming it up on a background thread """
+    with profile.phase('import_app'):
+        from sql_server.flask_app import create_app
+    replicas, databases = _get_databases(args)
+    summaries = _get_summaries(args, databases)
+    with profile.phase('create_app'):
+        a = create_app([_get_sql_source(args)], _get_engine_kwargs(args),
+                       {'schema_ttl': args['schema_ttl'], 'sqlite_pragmas': _get_sqlite_pragmas(args),
+                        'statement_cache_size': args['statement_cache_size'],
+                        'result_cache_bytes': args['result_cache_mb'] * 1024 * 1024,
+                        'result_cache_ttl': args['result_cache_ttl'], 'replica_args_lists': replicas,
+                        'health_check_interval': args['health_check_interval'], 'summaries': summaries,
+                        'summary_check_interval': args['summary_check_interval']},
+                       {'QUERY_ROW_LIMIT': args['query_row_limit'], 'QUERY_BATCH_SIZE': args['query_batch_size'],
+                        'ALLOW_ADMIN': args['allow_admin'], 'STATEMENT_TIMEOUT': args['statement_timeout'],
+                        'MAX_CONCURRENT_QUERIES': args['max_concurrent_queries'],
+                        'MAX_CLIENT_QUERIES': args['max_client_queries'],
+                        'QUERY_QUEUE_TIMEOUT': args['queue_timeout'],
+                        'COMPRESSION_ENCODINGS': _get_compression_encodings(args),
+                        'COMPRESSION_MIN_BYTES': args['compression_min_bytes'],
+                        'COMPRESSION_LEVEL': args['compression_level'], 'ETAGS': not args['no_etags'],
+                        'EXPORT_DIR': args['export_dir'], 'EXPORT_WORKERS': args['export_workers'],
+                        'EXPORT_TTL': args['export_ttl'], 'EXPORT_TIMEOUT': args['export_timeout']},
+                       databases)
+    a.config['startup_profile'] = profile
+    if args['startup_profile']:
+        a.before_request(lambda: profile.mark('first_request'))
+    if not args['no_warm_up']:
+        threading.Thread(target=_warm_up, args=(a.config['databases'], profile), name='sql_server_warm_up',
+                         daemon=True).start()
+    return a
+
+
+def _import_server_modules(args):
+    """ imports what serving in args['mode'] needs, ahead of use; the supervisor of --workers calls this before
+        forking so that workers, including the ones that replace workers that exit, start with it loaded
+    """
+    import sql_server.flask_app
+    if args['mode'] == 'asgi':
+        import sql_server.asgi_app
+        import uvicorn
+    else:
+        import cheroot.wsgi
+
+
+def get_server(cmd_line_args, listen_socket=None):
+    """ returns (logger, cheroot server, flask app)
+        listen_socket - socket.socket or None - already bound socket to serve on (see WorkerSupervisor)
+    """
     args = _parse_args(cmd_line_args)
     logger = _get_logger(args)
-    a = create_app([args['sql_source']], {})
+    profile = StartupProfile(args['startup_profile'])
+    with profile.phase('import_server'):
+        from cheroot.wsgi import Server as WSGIServer
+        from cheroot.wsgi import PathInfoDispatcher
+        from sql_server.workers import SharedSocketServer
+    a = _get_app(args, profile)
     d = PathInfoDispatcher({'/': a})
-    server = WSGIServer((args['url'], args['port']), d)
+    if listen_socket is not None:
+        server = SharedSocketServer(listen_socket, (args['url'], args['port']), d, numthreads=_get_num_threads(args))
+    else:
+        server = WSGIServer((args['url'], args['port']), d, numthreads=_get_num_threads(args))
     return logger, server, a
 
 
+def get_asgi_app(cmd_line_args):
+    """ returns (logger, ASGI app, flask app); the ASGI app runs the flask app's routes on a bounded
+        thread pool sized like the cheroot server, for serving with e.g. uvicorn
+    """
+    args = _parse_args(cmd_line_args)
+    logger = _get_logger(args)
+    profile = StartupProfile(args['startup_profile'])
+    with profile.phase('import_server'):
+        from sql_server.asgi_app import AsgiAdapter
+    a = _get_app(args, profile)
+    asgi_app = AsgiAdapter(a, max_workers=_get_num_threads(args), max_pending=args['max_pending'])
+    return logger, asgi_app, a
+
+
+def _run_asgi(cmd_line_args, args):
+    import uvicorn  # only needed for asgi mode
+    logger, asgi_app, _ = get_asgi_app(cmd_line_args)
+    logging.info('asgi server started')
+    uvicorn.run(asgi_app, host=args['url'], port=args['port'], log_level='warning')
+    logging.info('asgi server stopped')
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def _serve(server, a):
+    """ runs the cheroot server, like server.start(), noting in the startup profile when it is listening """
+    server.prepare()
+    a.config['startup_profile'].mark('listening')
+    server.serve()
+
+
+def _run_worker(cmd_line_args, args, listen_socket):
+    """ serves on listen_socket in a worker process forked by WorkerSupervisor, until SIGTERM """
+    if args['mode'] == 'asgi':
+        import uvicorn  # only needed for asgi mode
+        _, asgi_app, _ = get_asgi_app(cmd_line_args)
+        logging.info('asgi worker started')
+        uvicorn.Server(uvicorn.Config(asgi_app, log_level='warning')).run(sockets=[listen_socket])
+        return
+    _, server, a = get_server(cmd_line_args, listen_socket)
+    signal.signal(signal.SIGTERM, _raise_system_exit)
+    try:
+        logging.info('worker started')
+        _serve(server, a)
+    except (KeyboardInterrupt, SystemExit):
+        server.stop()
+        logging.info('worker stopped')
+
+
 def main_function(cmd_line_args=[]):
-    logger, server, _ = get_server(cmd_line_args)
+    args = _parse_args(cmd_line_args)
+    if args['workers'] > 1:
+        if not hasattr(os, 'fork'):
+            raise ValueError('--workers needs a platform with os.fork')
+        _get_sqlite_pragmas(args)  # fails here, rather than in each worker the supervisor would restart
+        from sql_server.workers import WorkerSupervisor
+        _get_logger(args)
+        _import_server_modules(args)
+        supervisor = WorkerSupervisor(lambda listen_socket: _run_worker(cmd_line_args, args, listen_socket),
+                                      args['workers'], (args['url'], args['port']))
+        supervisor.run()
+        return
+    if args['mode'] == 'asgi':
+        _run_asgi(cmd_line_args, args)
+        return
+    logger, server, a = get_server(cmd_line_args)
     try:
         logging.info('server started')
-        server.start()
+        _serve(server, a)
     except KeyboardInterrupt:
         server.stop()
         logging.info('server stopped')
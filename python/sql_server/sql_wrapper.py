@@ -1,4 +1,27 @@
 from sqlalchemy.engine import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy import event
+import os
+import threading
+import time
+from sql_server.schema_catalog import SchemaCatalog
+from sql_server.data_version import DataVersionMonitor
+from sql_server.table_counts import TableCounter
+from sql_server.statement_cache import StatementCache
+from sql_server.result_cache import ResultCache
+from sql_server.result_cache import estimate_bytes
+from sql_server.pagination import KeysetPagination
+from sql_server.index_advisor import IndexAdvisor
+from sql_server.index_advisor import get_plan_tree
+from sql_server.index_advisor import get_full_scans
+from sql_server.query_limits import QueryGuard
+from sql_server.query_limits import QueryInterruptedError
+from sql_server.replicas import ReplicaSet
+from sql_server.summaries import SummaryManager
+from sql_server.summaries import SummaryTable
+from sql_server.sqlalchemy_dsl import ClauseDictionaryToStatement
+from sql_server.sqlalchemy_dsl import parametrize_clause
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
 
 
 class SqlWrapperException(ValueError):
@@ -6,14 +29,483 @@ class SqlWrapperException(ValueError):
 
 
 class SqlWrapper:
-    def __init__(self, engine_args_list, engine_kwargs_dict):
-        self._engine = create_engine(*engine_args_list, **engine_kwargs_dict)
+    # pragmas that may be set on each new SQLite connection, in the order they are applied
+    SQLITE_PRAGMAS = ('busy_timeout', 'journal_mode', 'mmap_size', 'cache_size')
 
-    def get_table_count(self, table):
-        if table in self._engine.table_names():
-            return self._engine.execute("SELECT COUNT(*) FROM " + table + ";").fetchone()[0]
+    def __init__(self, engine_args_list, engine_kwargs_dict, schema_ttl=30.0, sqlite_pragmas={},
+                 statement_cache_size=256, result_cache_bytes=64 * 1024 * 1024, result_cache_ttl=None,
+                 replica_args_lists=[], health_check_interval=5.0, summaries=[], summary_check_interval=10.0):
+        """ engine_args_list - list - args passed on to sqlalchemy.create_engine
+            engine_kwargs_dict - dict - kwargs passed on to sqlalchemy.create_engine
+            schema_ttl - float or None - seconds the cached schema catalog is trusted before revalidation
+            sqlite_pragmas - dict<str, value> - pragmas (from SQLITE_PRAGMAS) set whenever the pool opens
+                                                a new SQLite connection, e.g. {'journal_mode': 'WAL'}
+            statement_cache_size - int - most compiled DSL statements kept for reuse; 0 disables the cache
+            result_cache_bytes - int - memory budget for cached DSL query results; 0 disables the cache
+            result_cache_ttl - float or None - seconds a cached result may be served for
+            replica_args_lists - list<list> - args for sqlalchemy.create_engine for each read replica of the
+                                              database; replicas share engine_kwargs_dict and sqlite_pragmas,
+                                              and take all reads, leaving the primary for writes (see ReplicaSet)
+            health_check_interval - float or None - seconds between health checks of the replicas
+            summaries - list<dict> - summary tables to keep in the database for grouped clauses, each
+                                     {'name': str, 'CLAUSE': dict, 'refresh': 'full' or 'incremental' (optional),
+                                      'interval': float (optional)}; queries that a summary table can answer
+                                     are read from it while it is up to date (see SummaryManager); SQLite only
+            summary_check_interval - float or None - seconds between checks for summary tables to refresh
+        """
+        pragmas = self._get_sqlite_pragmas(sqlite_pragmas)
+        self._engine = self._create_engine(engine_args_list, engine_kwargs_dict, pragmas)
+        self._replicas = None
+        if replica_args_lists:
+            if any(make_url(args[0]).get_backend_name() != self._engine.dialect.name for args in replica_args_lists):
+                raise SqlWrapperException('replicas must use the same kind of database as the primary')
+            self._replicas = ReplicaSet([self._create_engine(args, engine_kwargs_dict, pragmas)
+                                         for args in replica_args_lists], health_check_interval)
+        self._schema_catalog = SchemaCatalog(self._engine, schema_ttl)
+        self._version_monitor = DataVersionMonitor(self._engine)
+        self._table_counter = TableCounter(self._engine, self._schema_catalog, self._version_monitor)
+        self._statement_cache = StatementCache(statement_cache_size)
+        self._result_cache = ResultCache(self._version_monitor.get_version, result_cache_bytes, result_cache_ttl)
+        self._index_advisor = IndexAdvisor()
+        if summaries and self._engine.dialect.name != 'sqlite':
+            raise SqlWrapperException('summary tables are only available for SQLite')
+        self._summaries = SummaryManager(self._engine, self._schema_catalog, self._version_monitor,
+                                         [SummaryTable.from_dict(d) for d in summaries], summary_check_interval)
+        self._observer = None
+        self._local = threading.local()
+        self._instance = os.urandom(8).hex()  # data versions are only comparable within one SqlWrapper
+
+    def _create_engine(self, engine_args_list, engine_kwargs_dict, sqlite_pragmas):
+        """ creates an engine for the primary or a replica, with the event listeners the wrapper relies on """
+        engine = create_engine(*engine_args_list, **engine_kwargs_dict)
+        event.listen(engine, 'before_cursor_execute', self._explain_query_plan, retval=True)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'checkin', self._remove_query_guard)
+            event.listen(engine, 'handle_error', self._raise_query_interrupted)
+            if sqlite_pragmas:
+                def set_pragmas(dbapi_connection, connection_record):
+                    cursor = dbapi_connection.cursor()
+                    for k, v in sqlite_pragmas:
+                        cursor.execute('PRAGMA {} = {};'.format(k, v))
+                    cursor.close()
+
+                event.listen(engine, 'connect', set_pragmas)
+        return engine
+
+    @staticmethod
+    def _explain_query_plan(conn, cursor, statement, parameters, context, executemany):
+        """ runs statements executed with the sql_server_explain execution option as EXPLAIN QUERY PLAN """
+        if context is not None and context.execution_options.get('sql_server_explain'):
+            statement = 'EXPLAIN QUERY PLAN ' + statement
+        return statement, parameters
+
+    def _get_sqlite_pragmas(self, sqlite_pragmas):
+        """ validates sqlite_pragmas; returns the list of (pragma, value) to set, in the order to set them """
+        unknown = set(sqlite_pragmas.keys()) - set(self.SQLITE_PRAGMAS)
+        if unknown:
+            raise SqlWrapperException('unsupported sqlite pragmas: '+', '.join(sorted(unknown)))
+        pragmas = [(k, sqlite_pragmas[k]) for k in self.SQLITE_PRAGMAS if sqlite_pragmas.get(k) is not None]
+        for k, v in pragmas:
+            if not isinstance(v, int) and not str(v).isalpha():
+                raise SqlWrapperException('invalid value for sqlite pragma '+k+': '+str(v))
+        return pragmas
+
+    @staticmethod
+    def _remove_query_guard(dbapi_connection, connection_record):
+        if connection_record is not None and connection_record.info.pop('sql_server_guard', None) is not None:
+            dbapi_connection.set_progress_handler(None, 0)
+
+    @staticmethod
+    def _raise_query_interrupted(context):
+        """ turns the error from a statement stopped by its QueryGuard into QueryInterruptedError """
+        if context.connection is None or context.connection.closed:
+            return
+        guard = context.connection.connection.info.get('sql_server_guard')
+        if guard is not None and guard.reason is not None:
+            raise QueryInterruptedError(guard.reason) from context.original_exception
+
+    def set_query_guard(self, guard):
+        """ guard - QueryGuard or None - applied to the statements run from this thread until replaced,
+                                         e.g. for the duration of a request; SQLite only
+        """
+        self._local.guard = guard
+
+    def get_engine(self):
+        """ returns the engine of the primary database """
+        return self._engine
+
+    def get_engines(self):
+        """ returns the engines of the primary and of any replicas """
+        return [self._engine] + (self._replicas.get_engines() if self._replicas is not None else [])
+
+    def get_replica_stats(self):
+        """ returns the state of each replica (see ReplicaSet.get_stats); empty without replicas """
+        return self._replicas.get_stats() if self._replicas is not None else []
+
+    def warm_up(self):
+        """ does the work that would otherwise fall on the first requests: opens a pooled connection (setting its
+            pragmas), reflects the schema and opens the data version connection. The engine itself connects
+            lazily, so this can run on a background thread while the server starts, alongside any requests.
+        """
+        self._engine.connect().close()
+        self._schema_catalog.get_metadata()
+        self._version_monitor.get_version()
+        if self._replicas is not None:
+            self._replicas.check()
+        if self._summaries.get_summaries():
+            self._summaries.refresh()
+
+    def set_observer(self, observer):
+        """ observer - object with methods checkout_wait(seconds) and rows_fetched(seconds, rows),
+                         called as connections are taken from the pool and rows are fetched (see metrics)
+        """
+        self._observer = observer
+
+    def _connect(self, write=False):
+        """ returns a pooled connection, reporting the wait to the observer and applying this thread's QueryGuard
+            (if any) until the connection is returned. Reads go to a replica when there are healthy ones.
+            write - bool - True for a connection to the primary, which is the only one to write to
+        """
+        start = time.perf_counter()
+        conn = self._replicas.connect() if self._replicas is not None and not write else None
+        if conn is None:
+            conn = self._engine.connect()
+        guard = getattr(self._local, 'guard', None)
+        if guard is not None and self._engine.dialect.name == 'sqlite':
+            conn.connection.info['sql_server_guard'] = guard
+            conn.connection.set_progress_handler(guard.check, QueryGuard.PROGRESS_INTERVAL)
+        if self._observer is not None:
+            self._observer.checkout_wait(time.perf_counter() - start)
+        return conn
+
+    def _on_primary(self, conn):
+        """ whether conn, from _connect, is to the primary. Results read from a replica are not cached, as the
+            replica may lag the primary, whose data version the caches are keyed on
+        """
+        return conn.engine is self._engine
+
+    def _fetch(self, result, batch_size=None):
+        """ fetches batch_size rows from result (all rows if None), reporting the time to the observer;
+            for SQLite most of the work of a query happens while its rows are fetched
+        """
+        start = time.perf_counter()
+        rows = result.fetchall() if batch_size is None else result.fetchmany(batch_size)
+        if self._observer is not None:
+            self._observer.rows_fetched(time.perf_counter() - start, len(rows))
+        return rows
+
+    def get_table_count_with_source(self, table, mode='exact'):
+        """ table - str - name of the table to count
+            mode - str - 'exact' or 'estimate' (see TableCounter)
+            returns (count, source) where source names what answered, e.g. 'cache' or 'sqlite_stat1'
+        """
+        if mode not in TableCounter.MODES:
+            raise SqlWrapperException('unknown count mode: '+str(mode))
+        if self._schema_catalog.has_table(table):
+            with self._connect() as conn:
+                return self._table_counter.get_count(table, mode, conn, self._on_primary(conn))
         else:
             raise SqlWrapperException('nonexistant table: '+table)
 
+    def get_table_count(self, table, mode='exact'):
+        return self.get_table_count_with_source(table, mode)[0]
+
+    def notify_data_changed(self):
+        """ call after writing to the database through this process, to invalidate cached results """
+        self._version_monitor.bump()
+
+    def get_data_version(self):
+        """ returns a hashable token that changes whenever the data or the cached schema may have changed, or None
+            if changes cannot be detected (see DataVersionMonitor). Reading it does not run a query. Tokens from
+            different SqlWrappers (e.g. worker processes) never compare equal, as SQLite's data_version is only
+            meaningful to the connection that read it. None with replicas: reads are served from them, and the
+            primary's version says nothing about how far each replica has caught up.
+        """
+        if self._replicas is not None:
+            return None
+        version = self._version_monitor.get_version()
+        if version is None:
+            return None
+        self.get_metadata()  # brings the cached schema up to date, so that its generation is current
+        return (self._instance, version, self._schema_catalog.get_generation())
+
     def get_table_names(self):
-        return self._engine.table_names()
+        return self._schema_catalog.get_table_names()
+
+    def get_metadata(self):
+        return self._schema_catalog.get_metadata()
+
+    def get_statement(self, clause):
+        """ clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            returns an SQLAlchemy statement built against the cached schema, reading from a summary table if an up
+            to date one can answer the clause
+        """
+        return ClauseDictionaryToStatement(self.get_metadata(), self._summaries.get_fresh()).get_statement(clause)
+
+    def _get_summary(self, clause):
+        """ returns the up to date summary table that can answer clause, or None """
+        fresh = self._summaries.get_fresh()
+        if not fresh:
+            return None
+        return ClauseDictionaryToStatement(self.get_metadata(), fresh).get_summary(clause)
+
+    def refresh_summaries(self, names=None, force=False):
+        """ refreshes the summary tables that are out of date now, rather than at the next check
+            (see SummaryManager.refresh); returns the names of those refreshed
+        """
+        return self._summaries.refresh(names, force)
+
+    def get_summary_stats(self):
+        """ returns the state of each summary table (see SummaryManager.get_stats); empty without summaries """
+        return self._summaries.get_stats()
+
+    def get_compiled_statement(self, clause, row_limit=None):
+        """ clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            row_limit - int or None - LIMIT to apply to the statement, if lower than the clause's own 'LIMIT'
+            returns (compiled statement, params) ready for execution.
+            Literal values in the clause become bind parameters, and the compiled statement is cached on
+            the clause shape, so repeats of a clause with different values skip building and compiling.
+            A clause that an up to date summary table can answer is read from it.
+        """
+        shape, parametrized_clause, params = parametrize_clause(clause)
+        compiled = self._get_compiled(shape, parametrized_clause, row_limit, self._get_summary(clause))
+        self._index_advisor.record(shape, parametrized_clause, params)  # only clauses that compile
+        return compiled, params
+
+    def _get_compiled(self, shape, parametrized_clause, row_limit=None, summary=None):
+        """ compiled statement for a clause from parametrize_clause, from the statement cache if possible
+            summary - SummaryTable or None - summary table chosen for the clause, before it was parametrized
+        """
+        metadata = self.get_metadata()
+        key = (self._schema_catalog.get_generation(), shape, row_limit,
+               summary.get_name() if summary is not None else None)
+        compiled = self._statement_cache.get(key)
+        if compiled is None:
+            to_statement = ClauseDictionaryToStatement(metadata, [summary] if summary is not None else [])
+            statement = to_statement.get_statement(parametrized_clause)
+            limit = to_statement.get_limit(parametrized_clause)
+            if row_limit is not None and (limit is None or row_limit < limit):
+                statement = statement.limit(row_limit)
+            compiled = statement.compile(dialect=self._engine.dialect)
+            self._statement_cache.put(key, compiled)
+        return compiled
+
+    def get_result_types(self, clause, row_limit=None):
+        """ clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            row_limit - int or None - as for get_compiled_statement, so that the same compiled statement is used
+            returns the SQLAlchemy type of each column of the clause's result, in order; with SQLite these are
+            the declared types, which hold for the whole result where the values of a first batch may not
+        """
+        shape, parametrized_clause, _ = parametrize_clause(clause)
+        compiled = self._get_compiled(shape, parametrized_clause, row_limit, self._get_summary(clause))
+        return [column.type for column in compiled.statement.columns]
+
+    def get_compiled_page_statement(self, clause, page_size, page_token=None):
+        """ clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            page_size - int - rows per page
+            page_token - str or None - token returned with the previous page; None for the first page
+            returns (compiled statement, params, pagination) for one page, see KeysetPagination
+        """
+        shape, parametrized_clause, params = parametrize_clause(clause)
+        metadata = self.get_metadata()
+        ClauseDictionaryToStatement(metadata).check_clause(parametrized_clause)
+        pagination = KeysetPagination(metadata, parametrized_clause, shape)
+        key_values = pagination.read_token(page_token) if page_token is not None else None
+        null_mask = pagination.get_null_mask(key_values)
+        key = (self._schema_catalog.get_generation(), shape, 'page', page_size, null_mask)
+        compiled = self._statement_cache.get(key)
+        if compiled is None:
+            statement = ClauseDictionaryToStatement(metadata).get_statement(parametrized_clause)
+            statement = pagination.get_statement(statement, null_mask, page_size)
+            compiled = statement.compile(dialect=self._engine.dialect)
+            self._statement_cache.put(key, compiled)
+        self._index_advisor.record(shape, parametrized_clause, params)
+        for i, v in enumerate(key_values or []):
+            if v is not None:
+                params['k'+str(i)] = v
+        return compiled, params, pagination
+
+    def iter_clause_rows(self, clause, row_limit=None, batch_size=1000):
+        """ clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            row_limit - int or None - maximum number of rows to return
+            batch_size - int - number of rows fetched from the cursor at a time
+            generator; yields the list of column names first, then lists of at most batch_size row tuples.
+            Rows are fetched from a streaming cursor, so the result is never held in memory as a whole.
+            Closing the generator early releases the cursor and connection.
+        """
+        compiled, params = self.get_compiled_statement(clause, row_limit)
+        return self._iter_compiled_rows(compiled, params, batch_size)
+
+    def iter_clause_page(self, clause, page_size, page_token=None, batch_size=1000):
+        """ clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl); may include an 'ORDER BY'
+            page_size - int - rows per page
+            page_token - str or None - token returned with the previous page; None for the first page
+            batch_size - int - number of rows fetched from the cursor at a time
+            generator; yields the list of column names first, then lists of at most batch_size row tuples, and
+            last of all the token for the next page (None if this is the last page).
+            Pages are found by keyset pagination (see KeysetPagination), so a deep page costs the same as the
+            first one, and rows are streamed from the cursor as in iter_clause_rows.
+        """
+        compiled, params, pagination = self.get_compiled_page_statement(clause, page_size, page_token)
+        batches = self._iter_compiled_rows(compiled, params, batch_size)
+        columns = next(batches)
+        n = len(columns) - pagination.get_key_count()
+        yield columns[:n]
+        fetched, last_row = 0, None
+        for rows in batches:
+            page_rows = rows[:max(page_size - fetched, 0)]  # the row after the page only says there is more
+            fetched += len(rows)
+            if page_rows:
+                last_row = page_rows[-1]
+                yield [row[:n] for row in page_rows]
+        yield pagination.make_token(last_row[n:]) if fetched > page_size else None
+
+    def _iter_compiled_rows(self, compiled, params, batch_size):
+        """ generator behind iter_clause_rows, serving results from the result cache where possible """
+        key = self._result_cache.make_key(compiled, params)
+        hit, cached, version = self._result_cache.lookup(key)
+        if hit:
+            columns, rows = cached
+            yield columns
+            for i in range(0, len(rows), batch_size):
+                yield rows[i:i + batch_size]
+            return
+        # keep the rows for the result cache while they stay under its per result limit
+        kept, kept_bytes = [], 0
+        with self._connect() as conn:
+            if not self._on_primary(conn):
+                kept = None
+            result = conn.execution_options(stream_results=True).execute(compiled, params)
+            try:
+                columns = list(result.keys())
+                yield columns
+                while True:
+                    rows = [tuple(row) for row in self._fetch(result, batch_size)]
+                    if not rows:
+                        break
+                    if kept is not None:
+                        kept.extend(rows)
+                        kept_bytes += estimate_bytes(rows)
+                        if kept_bytes > self._result_cache.get_max_entry_bytes():
+                            kept = None
+                    yield rows
+            finally:
+                result.close()
+        if kept is not None:
+            self._result_cache.store(key, (columns, kept), version, kept_bytes)
+
+    def run_batch(self, operations, row_limit=None):
+        """ operations - list<dict> - each one of
+                {'op': 'count', 'table_name': str, 'mode': 'exact' or 'estimate' (optional)}
+                {'op': 'query', 'CLAUSE': dict, 'row_limit': int (optional)}
+            row_limit - int or None - most rows returned by any one query
+            returns a list with one result per operation, in order; counts are returned as from
+            /get_table_count, queries as {'columns': [...], 'rows': [[...], ...]}, and a failed operation as
+            {'error': str}. All operations run on one connection, and the exact counts not already cached
+            are fused into a single UNION ALL statement. Queries are compiled before the connection is taken,
+            as compiling may need a connection of its own (e.g. to revalidate the schema).
+        """
+        results = [None] * len(operations)
+        counts = {}  # mode -> list of (index, table name)
+        queries = []  # list of (index, (compiled statement, params))
+        for i, operation in enumerate(operations):
+            kind = operation.get('op')
+            if kind == 'count':
+                table, mode = operation.get('table_name'), operation.get('mode', 'exact')
+                if mode not in TableCounter.MODES:
+                    results[i] = {'error': 'unknown count mode: '+str(mode)}
+                elif not self._schema_catalog.has_table(table):
+                    results[i] = {'error': 'nonexistant table: '+str(table)}
+                else:
+                    counts.setdefault(mode, []).append((i, table))
+            elif kind == 'query':
+                try:
+                    if 'CLAUSE' not in operation:
+                        raise SqlAlchemyDslError('CLAUSE not found in query operation')
+                    limit = operation.get('row_limit', row_limit)
+                    if limit is not None and row_limit is not None:
+                        limit = min(int(limit), row_limit)
+                    queries.append((i, self.get_compiled_statement(operation['CLAUSE'], limit)))
+                except (SqlAlchemyDslError, ValueError, TypeError) as e:
+                    results[i] = {'error': str(e)}
+            else:
+                results[i] = {'error': 'unknown batch operation: '+str(kind)}
+
+        with self._connect() as conn:
+            for mode, items in counts.items():
+                answers = self._table_counter.get_counts([table for _, table in items], mode, conn,
+                                                         self._on_primary(conn))
+                for i, table in items:
+                    count, source = answers[table]
+                    results[i] = {'table_name': table, 'count': count, 'mode': mode, 'source': source}
+            for i, (compiled, params) in queries:
+                try:
+                    def run_query():
+                        result = conn.execute(compiled, params)
+                        return list(result.keys()), [tuple(row) for row in self._fetch(result)]
+
+                    if self._on_primary(conn):
+                        key = self._result_cache.make_key(compiled, params)
+                        (columns, rows), _ = self._result_cache.get_or_compute(key, run_query)
+                    else:
+                        columns, rows = run_query()
+                    results[i] = {'columns': columns, 'rows': [list(row) for row in rows]}
+                except (SqlAlchemyDslError, ValueError, TypeError) as e:
+                    results[i] = {'error': str(e)}
+        return results
+
+    def _explain(self, compiled, params):
+        if self._engine.dialect.name != 'sqlite':
+            raise SqlWrapperException('query plans are only available for SQLite')
+        with self._connect() as conn:
+            result = conn.execution_options(sql_server_explain=True).execute(compiled, params)
+            try:
+                rows = result.cursor.fetchall()
+            finally:
+                result.close()
+        return get_plan_tree(rows)
+
+    def explain_clause(self, clause, row_limit=None):
+        """ clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl)
+            row_limit - int or None - LIMIT to apply, as for iter_clause_rows
+            returns {'sql': str, 'plan': list} where plan is the EXPLAIN QUERY PLAN output as a tree of
+            {'id': int, 'detail': str, 'children': [...]}, and 'full_scans' lists the tables read in full
+        """
+        shape, parametrized_clause, params = parametrize_clause(clause)
+        compiled = self._get_compiled(shape, parametrized_clause, row_limit, self._get_summary(clause))
+        plan = self._explain(compiled, params)
+        return {'sql': str(compiled), 'plan': plan, 'full_scans': get_full_scans(plan)}
+
+    def get_index_advice(self):
+        """ returns the CREATE INDEX statements recommended for recently run clauses (see IndexAdvisor) """
+        def explain(shape, parametrized_clause, params):
+            return self._explain(self._get_compiled(shape, parametrized_clause), params)
+
+        return self._index_advisor.get_recommendations(self.get_metadata(), explain,
+                                                       self._engine.dialect.identifier_preparer.quote)
+
+    def apply_index_advice(self):
+        """ creates the indexes from get_index_advice, and re-analyzes their tables so the planner uses them
+            returns the list of recommendations applied
+        """
+        recommendations = self.get_index_advice()
+        quote = self._engine.dialect.identifier_preparer.quote
+        with self._connect(write=True) as conn:
+            for r in recommendations:
+                conn.execute(r['sql'])
+            for table in sorted({r['table'] for r in recommendations}):
+                conn.execute('ANALYZE {};'.format(quote(table)))
+        if recommendations:
+            self._schema_catalog.refresh()
+            self.notify_data_changed()
+            # SQLite never re-prepares a cached EXPLAIN statement, so pooled connections would go on showing
+            # the plans from before the indexes; start the pools afresh
+            for engine in self.get_engines():
+                engine.dispose()
+        return recommendations
+
+    def get_cache_stats(self):
+        return {'schema_catalog': self._schema_catalog.get_stats(),
+                'table_counts': self._table_counter.get_stats(),
+                'statement_cache': self._statement_cache.get_stats(),
+                'result_cache': self._result_cache.get_stats()}
@@ -30,39 +30,103 @@ def get_clause_from_json(j):
     return json.loads(j, cls=SqlAlchemyDslJSONDecoder)
 
 
+def parametrize_clause(clause):
+    """ clause - dict - SQL query dressed as a dictionary
+        returns (shape, parametrized_clause, params) where
+            shape - hashable - identifies the clause with its literal values left out
+            parametrized_clause - dict - copy of clause with each Criterion field_value replaced by bind parameters,
+                                         except None, which stays in the clause and the shape
+            params - dict<str, value> - values for the bind parameters
+        Clauses of the same shape build the same statement, so a compiled statement can be reused with new params.
+    """
+    params = {}
+
+    def _parametrize(x):
+        if isinstance(x, Criterion):
+            values = []
+            for v in x._field_value:
+                name = 'p' + str(len(params))
+                if v is None and x._comparison_operator != 'IN':
+                    values.append(None)  # kept literal, so that '=' and '!=' compile to IS NULL and IS NOT NULL
+                elif x._comparison_operator == 'IN':
+                    try:
+                        params[name] = list(v)
+                    except TypeError:
+                        raise SqlAlchemyDslError('IN requires a list of values, got: '+str(v))
+                    values.append(sa.bindparam(name, expanding=True))
+                else:
+                    params[name] = v
+                    values.append(sa.bindparam(name))
+            shape = ('Criterion', x._table_name, x._field_name, tuple(x._field_name_modifiers),
+                     x._comparison_operator, tuple(v is None for v in values))
+            return shape, Criterion(x._table_name, x._field_name, x._field_name_modifiers,
+                                    x._comparison_operator, values)
+        elif isinstance(x, dict):
+            items = [(k, _parametrize(v)) for k, v in x.items()]
+            return ('dict',) + tuple((k, v[0]) for k, v in items), {k: v[1] for k, v in items}
+        elif isinstance(x, (list, tuple)):
+            items = [_parametrize(v) for v in x]
+            return ('list',) + tuple(v[0] for v in items), [v[1] for v in items]
+        else:
+            return x, x  # scalars outside a Criterion are part of the shape
+
+    shape, parametrized_clause = _parametrize(clause)
+    return shape, parametrized_clause, params
+
+
 class Criterion:
-    """ represents a single attribute in an SQL query, e.g. a single variable in a SELECT, WHERE or GROUP BY statement """
+    """ represents a single attribute in an SQL query, e.g. a single variable in a SELECT, WHERE, GROUP BY, HAVING or
+        ORDER BY statement
+    """
+    # dictionary to map strings to sqlalchemy functions
+    _field_modifiers = {'COUNT': sa.func.count,
+                        'DISTINCT': sa.func.distinct,
+                        'SUM': sa.func.sum,
+                        'TOTAL': sa.func.total,
+                        'AVG': sa.func.avg,
+                        'MIN': sa.func.min,
+                        'MAX': sa.func.max,
+                        'GROUP_CONCAT': sa.func.group_concat,
+                        'ASC': sa.asc,
+                        'DESC': sa.desc}
+    # dictionary to map strings to sqlalchemy functions
+    _comparisons = {'=': lambda x, v: x == v,
+                    '==': lambda x, v: x == v,
+                    '>': lambda x, v: x > v,
+                    '>=': lambda x, v: x >= v,
+                    '<': lambda x, v: x < v,
+                    '<=': lambda x, v: x <= v,
+                    '!=': lambda x, v: x != v,
+                    'BETWEEN': sa.between,
+                    'CONTAINS': lambda x, s: x.contains(s),
+                    'LIKE': lambda x, s: x.like(s),
+                    'IN': lambda x, v_list: x.in_(v_list)}
 
     def __init__(self, table_name, field_name, field_name_modifiers=[], comparison_operator=None, field_value=[]):
         """ table_name - str - name of the table the field belongs to
             field_name - str
-            field_name_modifiers - list<str> - list of modifiers (e.g. 'COUNT' or 'DISTINCT') to apply onto field.
+            field_name_modifiers - list<str> - list of modifiers (e.g. 'COUNT', 'SUM' or 'DISTINCT') to apply onto field.
                                                Modifiers are applied right to left
-                                               (so [mod1, mod2, mod3] is applied as mod1(mod2(mod3(field))) )
+                                               (so [mod1, mod2, mod3] is applied as mod1(mod2(mod3(field))) ).
+                                               'ASC' and 'DESC' set the direction in an ORDER BY
             comparison_operator - str - operator to apply with field value, e.g. '='
             field_value - list<relevant data type> - field will be compared to these values;
                                                      list since some comparisons (e.g. between) require multiples
         """
+        if not isinstance(table_name, str) or not isinstance(field_name, str):
+            raise SqlAlchemyDslError('table_name and field_name must be strings')
+        if not isinstance(field_name_modifiers, (list, tuple)) or \
+                not all(isinstance(m, str) for m in field_name_modifiers):
+            raise SqlAlchemyDslError('field_name_modifiers must be a list of strings')
+        if comparison_operator is not None and not isinstance(comparison_operator, str):
+            raise SqlAlchemyDslError('comparison_operator must be a string')
+        if not isinstance(field_value, (list, tuple)):
+            raise SqlAlchemyDslError('field_value must be a list')
         self._table_name = table_name
         self._field_name = field_name
         self._field_name_modifiers = field_name_modifiers
         self._comparison_operator = comparison_operator
         self._field_value = field_value
-        # dictionary to map strings to sqlalchemy functions
-        self._field_modifiers = {'COUNT': sa.func.count,
-                                 'DISTINCT': sa.func.distinct}
-        # dictionary to map strings to sqlalchemy functions
-        self._comparisons = {'=': lambda x, v: x == v,
-                             '==': lambda x, v: x == v,
-                             '>': lambda x, v: x > v,
-                             '>=': lambda x, v: x >= v,
-                             '<': lambda x, v: x < v,
-                             '<=': lambda x, v: x <= v,
-                             '!=': lambda x, v: x != v,
-                             'BETWEEN': sa.between,
-                             'CONTAINS': lambda x, s: x.contains(s),
-                             'LIKE': lambda x, s: x.like(s),
-                             'IN': lambda x, v_list: x.in_(v_list)}
 
     def from_json(j):
         """ returns a 'Criterion' from the supplied json """
@@ -93,22 +157,204 @@ class Criterion:
         """ metadata - 'sqlalchemy.sql.schema.MetaData' - metadata for the SQL database on which the query will be run
             returns an SQLAlchemy statement
         """
-        stmt = metadata.tables[self._table_name].columns[self._field_name]
+        if self._table_name not in metadata.tables:
+            raise SqlAlchemyDslError('nonexistant table: '+str(self._table_name))
+        table = metadata.tables[self._table_name]
+        if self._field_name not in table.columns:
+            raise SqlAlchemyDslError('nonexistant field: '+str(self._table_name)+'.'+str(self._field_name))
+        stmt = table.columns[self._field_name]
         for modifier in self._field_name_modifiers[::-1]:
+            if modifier not in self._field_modifiers:
+                raise SqlAlchemyDslError('unknown field modifier: '+str(modifier))
             stmt = self._field_modifiers[modifier](stmt)
         if self._comparison_operator:
-            stmt = self._comparisons[self._comparison_operator](stmt, *self._field_value)
+            if self._comparison_operator not in self._comparisons:
+                raise SqlAlchemyDslError('unknown comparison operator: '+str(self._comparison_operator))
+            try:
+                stmt = self._comparisons[self._comparison_operator](stmt, *self._field_value)
+            except TypeError:
+                raise SqlAlchemyDslError('wrong number of values for '+self._comparison_operator+': '+
+                                         str(len(self._field_value)))
         return stmt
 
 
+class JoinPlanner:
+    """ finds how to join the tables of a clause, from the foreign keys in the reflected metadata plus any
+        explicit join hints. Tables are treated as nodes of a graph with an edge for each foreign key, and the
+        tables of a clause are connected one at a time along the shortest path from those already joined,
+        passing through intermediate tables where needed (e.g. artists - albums - tracks).
+    """
+
+    def __init__(self, metadata):
+        """ metadata - 'sqlalchemy.sql.schema.MetaData' - metadata for the SQL database """
+        self._metadata = metadata
+        self._edges = {}  # table name -> {table name: join condition, or None if ambiguous}
+        for table in metadata.tables.values():
+            for fk in table.foreign_key_constraints:
+                other = fk.referred_table
+                if other is table:
+                    continue  # self references would need an alias
+                condition = sa.and_(*[el.parent == el.column for el in fk.elements])
+                for a, b in [(table.name, other.name), (other.name, table.name)]:
+                    neighbours = self._edges.setdefault(a, {})
+                    neighbours[b] = None if b in neighbours else condition
+
+    def _get_column(self, criterion):
+        if not isinstance(criterion, Criterion) or criterion._field_name_modifiers or criterion._comparison_operator:
+            raise SqlAlchemyDslError('a JOIN hint is a pair of plain Criterion, one per table')
+        return criterion.get_sqlalchemy_statement(self._metadata)
+
+    def get_from_clause(self, table_names, hints=[]):
+        """ table_names - list<str> - tables referenced by the clause; the first one starts the join
+            hints - list<[Criterion, Criterion]> - pairs of columns to join on, used in place of
+                                                   (or where there are no) foreign keys between their tables
+            returns a table or join to select from
+        """
+        edges = {k: dict(v) for k, v in self._edges.items()}
+        required = list(table_names)
+        for hint in hints:
+            if not isinstance(hint, (list, tuple)) or len(hint) != 2:
+                raise SqlAlchemyDslError('a JOIN hint is a pair of plain Criterion, one per table')
+            left, right = self._get_column(hint[0]), self._get_column(hint[1])
+            a, b = left.table.name, right.table.name
+            if a == b:
+                raise SqlAlchemyDslError('a JOIN hint must join two different tables')
+            edges.setdefault(a, {})[b] = left == right
+            edges.setdefault(b, {})[a] = left == right
+            required += [t for t in (a, b) if t not in required]
+        for name in required:
+            if name not in self._metadata.tables:
+                raise SqlAlchemyDslError('nonexistant table: '+str(name))
+
+        tables = self._metadata.tables
+        joined = [required[0]]
+        from_clause = tables[required[0]]
+        for target in required[1:]:
+            if target in joined:
+                continue
+            # breadth first search outwards from every table joined so far
+            previous = {name: None for name in joined}
+            frontier = list(joined)
+            while target not in previous and frontier:
+                next_frontier = []
+                for name in frontier:
+                    for neighbour in sorted(edges.get(name, {})):
+                        if neighbour not in previous:
+                            previous[neighbour] = name
+                            next_frontier.append(neighbour)
+                frontier = next_frontier
+            if target not in previous:
+                raise SqlAlchemyDslError('no join path from '+', '.join(joined)+' to '+target+'; add a JOIN hint')
+            path = [target]
+            while previous[path[-1]] is not None:
+                path.append(previous[path[-1]])
+            for a, b in zip(path[::-1], path[-2::-1]):
+                condition = edges[a][b]
+                if condition is None:
+                    raise SqlAlchemyDslError('several foreign keys join '+a+' and '+b+'; add a JOIN hint')
+                from_clause = from_clause.join(tables[b], condition)
+                joined.append(b)
+        return from_clause
+
+
+def _get_table_names(x, names):
+    """ appends the names of the tables referenced in x (a clause or part of one) to names, in order of appearance """
+    if isinstance(x, Criterion):
+        if x._table_name not in names:
+            names.append(x._table_name)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _get_table_names(v, names)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _get_table_names(v, names)
+    return names
+
+
+def _get_criteria(x, criteria):
+    """ appends the Criterion in x (a clause or part of one) to criteria, in order of appearance """
+    if isinstance(x, Criterion):
+        criteria.append(x)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _get_criteria(v, criteria)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _get_criteria(v, criteria)
+    return criteria
+
+
+def _get_expression_key(criterion):
+    """ identifies what a Criterion computes: its table, field and modifiers, leaving out any comparison """
+    return criterion._table_name, criterion._field_name, tuple(criterion._field_name_modifiers)
+
+
+def _is_bind_parameter(v):
+    return isinstance(v, sa.sql.expression.BindParameter)
+
+
+def _same(a, b, compare_values=True):
+    """ whether two parts of clauses are the same; a bind parameter (see parametrize_clause) stands for any value """
+    if isinstance(a, Criterion) and isinstance(b, Criterion):
+        if _get_expression_key(a) != _get_expression_key(b) or a._comparison_operator != b._comparison_operator:
+            return False
+        if len(a._field_value) != len(b._field_value):
+            return False
+        return not compare_values or all(_is_bind_parameter(v) or _is_bind_parameter(w) or v == w
+                                         for v, w in zip(a._field_value, b._field_value))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_same(a[k], b[k], compare_values) for k in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(_same(v, w, compare_values) for v, w in zip(a, b))
+    return type(a) == type(b) and a == b
+
+
+def _get_and_items(conjunction):
+    """ returns the conditions a 'WHERE' or 'HAVING' conjunction requires all of """
+    if conjunction is None:
+        return []
+    if isinstance(conjunction, dict) and list(conjunction.keys()) == ['AND']:
+        return list(conjunction['AND'])
+    return [conjunction]
+
+
+def get_summary_columns(clause):
+    """ clause - dict - grouped SQL query dressed as a dictionary, the definition of a summary table
+        returns the list of Criterion a summary table of clause keeps, one per column: those selected, then the
+        grouped ones not selected. The summary table's columns are named 'c0', 'c1', ... in this order.
+    """
+    columns = list(clause['SELECT'])
+    keys = [_get_expression_key(x) for x in columns]
+    for x in clause.get('GROUP BY', []):
+        if _get_expression_key(x) not in keys:
+            columns.append(x)
+            keys.append(_get_expression_key(x))
+    return columns
+
+
+class _NoMatch(Exception):
+    pass
+
+
 class ClauseDictionaryToStatement:
     """ takes a specified dictionary containing Criterion, and generates a SQLAlchemy statement """
 
-    def __init__(self, metadata):
+    # dictionary to map strings to sqlalchemy functions
+    _conjunctions = {'AND': sa.and_,
+                     'OR': sa.or_}
+    # clause keys a summary table can answer
+    _summary_keys = {'SELECT', 'WHERE', 'GROUP BY', 'HAVING', 'ORDER BY', 'LIMIT', 'JOIN'}
+
+    def __init__(self, metadata, summaries=[]):
+        """ metadata - 'sqlalchemy.sql.schema.MetaData' - metadata for the SQL database
+            summaries - list - summary tables that clauses are rewritten to read from where they can answer them,
+                               each an object with get_clause() (the grouped clause whose result the table holds)
+                               and get_table_name() (see SummaryTable); the caller vouches that they are up to date.
+                               Bind parameters in a clause (see parametrize_clause) match any value, so callers
+                               that parametrize should pass only the summary get_summary chose for the literal clause
+        """
         self._metadata = metadata
-        # dictionary to map strings to sqlalchemy functions
-        self._conjunctions = {'AND': sa.and_,
-                              'OR': sa.or_}
+        self._summaries = summaries
 
     def get_json(self, clause):
         d = {'CLAUSE': clause}
@@ -140,10 +386,181 @@ class ClauseDictionaryToStatement:
         expanded_conjunction = self._conjunctions[default_wrapper_conjuction](*conjuctions)
         return expanded_conjunction
 
+    def get_limit(self, clause):
+        """ returns the clause's 'LIMIT' as an int, or None if it has none """
+        limit = clause.get('LIMIT')
+        if limit is None:
+            return None
+        if isinstance(limit, bool) or not isinstance(limit, int) or limit < 0:
+            raise SqlAlchemyDslError('LIMIT must be a non-negative integer, got: '+str(limit))
+        return limit
+
+    def _rewrite_for_summary(self, clause, summary):
+        """ returns clause rewritten to read from the table of summary, or raises _NoMatch if the summary cannot
+            answer it. It can when clause groups by the same columns of the same tables, has the summary's own
+            'WHERE' and 'HAVING' conditions among its own, and selects, filters and orders only by columns the
+            summary keeps, with any further 'WHERE' conditions only on the grouped columns.
+        """
+        definition = summary.get_clause()
+        table_name = summary.get_table_name()
+        if not set(clause.keys()) <= self._summary_keys or 'GROUP BY' not in clause or \
+                table_name not in self._metadata.tables:
+            raise _NoMatch()
+        if any(not isinstance(x, Criterion) or x._comparison_operator for x in clause['GROUP BY']):
+            raise _NoMatch()
+        if {_get_expression_key(x) for x in clause['GROUP BY']} != \
+                {_get_expression_key(x) for x in definition['GROUP BY']}:
+            raise _NoMatch()
+        if set(_get_table_names([clause['SELECT'], clause], [])) != \
+                set(_get_table_names([definition['SELECT'], definition], [])):
+            raise _NoMatch()  # e.g. a further table in the join would change the aggregates
+        if not _same(clause.get('JOIN', []), definition.get('JOIN', [])):
+            raise _NoMatch()
+
+        columns = [_get_expression_key(x) for x in get_summary_columns(definition)]
+        grouped = {_get_expression_key(x) for x in definition['GROUP BY']}
+
+        def to_summary(x, keys, modifiers=[]):
+            """ x with each Criterion moved onto the summary column that holds its expression """
+            if isinstance(x, Criterion):
+                if _get_expression_key(x) not in keys:
+                    raise _NoMatch()
+                return Criterion(table_name, 'c'+str(columns.index(_get_expression_key(x))), modifiers,
+                                 x._comparison_operator, x._field_value)
+            if isinstance(x, dict):
+                return {k: [to_summary(v, keys) for v in values] for k, values in x.items()}
+            raise _NoMatch()
+
+        def get_further_conditions(key):
+            """ the conditions in clause[key] beyond those of the definition, which the summary already applied """
+            items = _get_and_items(clause.get(key))
+            for d in _get_and_items(definition.get(key)):
+                # which condition is the definition's must not depend on values, as bind parameters match any
+                candidates = [i for i, x in enumerate(items) if _same(x, d, compare_values=False)]
+                if len(candidates) != 1 or not _same(items[candidates[0]], d):
+                    raise _NoMatch()
+                del items[candidates[0]]
+            return items
+
+        conditions = [to_summary(x, grouped) for x in get_further_conditions('WHERE')] + \
+                     [to_summary(x, columns) for x in get_further_conditions('HAVING')]
+        if any(not isinstance(x, Criterion) or x._comparison_operator for x in clause['SELECT']):
+            raise _NoMatch()
+        rewritten = {'SELECT': [to_summary(x, columns) for x in clause['SELECT']]}
+        if conditions:
+            rewritten['WHERE'] = {'AND': conditions}
+        order_bys = []
+        for x in clause.get('ORDER BY', []):
+            if not isinstance(x, Criterion):
+                raise _NoMatch()
+            modifiers = list(x._field_name_modifiers)
+            direction = modifiers[:1] if modifiers[:1] in (['ASC'], ['DESC']) else []
+            order_by = Criterion(x._table_name, x._field_name, modifiers[len(direction):], x._comparison_operator,
+                                 x._field_value)
+            order_bys.append(to_summary(order_by, columns, direction))
+        if not order_bys:
+            # rows come out of a GROUP BY in the order of the groups, and out of the summary table in any order
+            order_bys = [to_summary(x, grouped) for x in clause['GROUP BY']]
+        rewritten['ORDER BY'] = order_bys
+        if 'LIMIT' in clause:
+            rewritten['LIMIT'] = clause['LIMIT']
+        return rewritten
+
+    def get_summary(self, clause):
+        """ returns the first of the summaries that can answer clause, or None """
+        self.check_clause(clause)
+        for summary in self._summaries:
+            try:
+                self._rewrite_for_summary(clause, summary)
+                return summary
+            except _NoMatch:
+                pass
+        return None
+
+    def _get_summary_statement(self, clause, summary):
+        """ returns a statement answering clause from the table of summary, or None if the summary cannot.
+            Its columns carry the names and types of the columns clause would give, so results are the same.
+        """
+        try:
+            rewritten = self._rewrite_for_summary(clause, summary)
+        except _NoMatch:
+            return None
+        statement = self._get_table_statement(rewritten)
+        table = self._metadata.tables[summary.get_table_name()]
+        columns = []
+        for x, y in zip(clause['SELECT'], rewritten['SELECT']):
+            expression = x.get_sqlalchemy_statement(self._metadata)
+            column = sa.type_coerce(table.columns[y._field_name], expression.type)
+            # anonymous labels are numbered as they would be for the expressions themselves, e.g. 'count_1'
+            columns.append(column.label(expression.name if isinstance(expression, sa.Column)
+                                        else expression.anon_label))
+        return statement.with_only_columns(columns)
+
     def get_statement(self, clause):
-        """ clause - dict - SQL query dressed as a dictionary
-            returns an SQLAlchemy statement
+        """ clause - dict - SQL query dressed as a dictionary with keys
+                'SELECT' - list<Criterion>
+                'WHERE' - dict - conjunction of Criterion, e.g. {'AND': [Criterion, {'OR': [Criterion, ...]}]}
+                'GROUP BY' - list<Criterion>
+                'HAVING' - dict - conjunction like 'WHERE', usually of aggregated Criterion
+                'ORDER BY' - list<Criterion> - with 'ASC' or 'DESC' modifiers for the direction
+                'LIMIT' - int
+                'JOIN' - list<[Criterion, Criterion]> - join hints, see JoinPlanner
+                all but 'SELECT' are optional
+            returns an SQLAlchemy statement. When the clause references several tables they are joined on
+            their foreign keys (or the hints), rather than listed in the FROM as a cartesian product.
+            A clause that one of the summaries can answer is rewritten to read from its table instead.
         """
+        self.check_clause(clause)
+        for summary in self._summaries:
+            statement = self._get_summary_statement(clause, summary)
+            if statement is not None:
+                return statement
+        return self._get_table_statement(clause)
+
+    def check_clause(self, clause):
+        """ raises SqlAlchemyDslError if clause is not shaped as get_statement describes, rather than leave it to
+            fail somewhere in building the statement
+        """
+        if not isinstance(clause, dict):
+            raise SqlAlchemyDslError('a clause must be a dict, got: '+type(clause).__name__)
+        for key in ('SELECT', 'GROUP BY', 'ORDER BY'):
+            if key in clause and (not isinstance(clause[key], (list, tuple)) or
+                                  not all(isinstance(x, Criterion) for x in clause[key])):
+                raise SqlAlchemyDslError(key+' must be a list of Criterion')
+        for key in ('WHERE', 'HAVING'):
+            if key in clause:
+                self._check_conjunction(key, clause[key])
+        if not isinstance(clause.get('JOIN', []), (list, tuple)):
+            raise SqlAlchemyDslError('JOIN must be a list of [Criterion, Criterion] pairs')
+        self._check_directions(clause)
+
+    def _check_conjunction(self, key, x):
+        """ raises SqlAlchemyDslError unless x is a conjunction for key ('WHERE' or 'HAVING'), see get_statement """
+        if not isinstance(x, dict):
+            raise SqlAlchemyDslError(key+' must be a dict of conjunctions, e.g. {"AND": [...]}, got: '+
+                                     type(x).__name__)
+        for conjunction, items in x.items():
+            if conjunction not in self._conjunctions:
+                raise SqlAlchemyDslError('unknown conjunction in '+key+': '+str(conjunction))
+            if not isinstance(items, (list, tuple)):
+                raise SqlAlchemyDslError(key+' '+conjunction+' must be a list of Criterion or conjunctions')
+            for item in items:
+                if not isinstance(item, Criterion):
+                    self._check_conjunction(key, item)
+
+    @staticmethod
+    def _check_directions(clause):
+        """ raises SqlAlchemyDslError for an 'ASC' or 'DESC' modifier anywhere but first on an 'ORDER BY' Criterion,
+            which would otherwise give invalid SQL
+        """
+        for key, value in clause.items():
+            for x in _get_criteria(value, []):
+                modifiers = x._field_name_modifiers[1:] if key == 'ORDER BY' else x._field_name_modifiers
+                for modifier in modifiers:
+                    if modifier in ('ASC', 'DESC'):
+                        raise SqlAlchemyDslError(modifier+' is only allowed as the first modifier in an ORDER BY')
+
+    def _get_table_statement(self, clause):
         m = self._metadata
         if 'SELECT' in clause.keys():
             selects = [x.get_sqlalchemy_statement(m) for x in clause['SELECT']]
@@ -153,9 +570,22 @@ class ClauseDictionaryToStatement:
             group_bys = [x.get_sqlalchemy_statement(m) for x in clause['GROUP BY']]
         else:
             group_bys = []  # does nothing
+        if 'ORDER BY' in clause.keys():
+            order_bys = [x.get_sqlalchemy_statement(m) for x in clause['ORDER BY']]
+        else:
+            order_bys = []  # does nothing
         if 'WHERE' in clause.keys():
             wheres = self._get_expanded_conjunction(clause['WHERE'])
         else:
             wheres = True  # does nothing
-        statement = sa.select(selects).where(wheres).group_by(*group_bys)
+        statement = sa.select(selects).where(wheres).group_by(*group_bys).order_by(*order_bys)
+        table_names = _get_table_names([clause['SELECT'], clause], [])
+        if len(table_names) > 1 or clause.get('JOIN'):
+            from_clause = JoinPlanner(m).get_from_clause(table_names, clause.get('JOIN', []))
+            statement = statement.select_from(from_clause)
+        if 'HAVING' in clause.keys():
+            statement = statement.having(self._get_expanded_conjunction(clause['HAVING']))
+        limit = self.get_limit(clause)
+        if limit is not None:
+            statement = statement.limit(limit)
         return statement
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+import threading
+
+
+class StatementCache:
+    """ bounded LRU cache of compiled SQLAlchemy statements, keyed on the shape of a DSL clause
+        (see sqlalchemy_dsl.parametrize_clause). A hit skips both building the expression tree and compiling it to SQL.
+    """
+
+    def __init__(self, maxsize=256):
+        """ maxsize - int - most compiled statements held; 0 disables caching """
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._compiled = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """ returns the cached compiled statement for key, or None """
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._compiled.move_to_end(key)
+            return compiled
+
+    def put(self, key, compiled):
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._compiled[key] = compiled
+            self._compiled.move_to_end(key)
+            while len(self._compiled) > self._maxsize:
+                self._compiled.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+
+    def get_stats(self):
+        lookups = self._hits + self._misses
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._compiled),
+                'maxsize': self._maxsize,
+                'hit_rate': self._hits / lookups if lookups else 0.0}
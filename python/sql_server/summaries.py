@@ -0,0 +1,411 @@
+import sqlalchemy as sa
+from sqlalchemy.sql.util import find_tables
+import json
+import logging
+import re
+import threading
+import time
+from sql_server.sqlalchemy_dsl import ClauseDictionaryToStatement
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslJSONEncoder
+from sql_server.sqlalchemy_dsl import get_summary_columns
+
+_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+# tables the summaries keep their state in, next to the summary tables themselves
+_state_metadata = sa.MetaData()
+_state = sa.Table('sql_server_summaries', _state_metadata,
+                  sa.Column('name', sa.Text, primary_key=True),
+                  sa.Column('definition', sa.Text, nullable=False),
+                  sa.Column('changes', sa.Text, nullable=False),  # JSON of the source table changes refreshed at
+                  sa.Column('refreshed', sa.Float, nullable=False),
+                  sa.Column('seconds', sa.Float, nullable=False),
+                  sa.Column('rows', sa.Integer, nullable=False))
+_changes = sa.Table('sql_server_changes', _state_metadata,
+                    sa.Column('table_name', sa.Text, primary_key=True),
+                    sa.Column('changes', sa.Integer, nullable=False))
+
+
+class SummaryError(ValueError):
+    pass
+
+
+def _get_key(criterion):
+    return criterion._table_name, criterion._field_name, tuple(criterion._field_name_modifiers)
+
+
+def _in_groups(columns, groups):
+    """ returns the condition that the values of columns are those of one of the rows of the table groups """
+    keys = list(groups.columns)
+    # IN does not match NULLs, which only the slower IS comparisons do
+    nulls = sa.and_(sa.or_(*[c.is_(None) for c in columns]),
+                    sa.exists().where(sa.and_(*[k.is_(c) for k, c in zip(keys, columns)])))
+    return sa.or_(sa.tuple_(*columns).in_(sa.select(keys)), nulls)
+
+
+class SummaryTable:
+    """ a grouped DSL clause whose result is kept in a table of the database, 'sql_server_summary_<name>', with
+        one column for each Criterion of get_summary_columns. The table is either computed again in full when the
+        source tables change, or, for 'incremental' refreshes, only for the groups whose rows changed.
+    """
+    REFRESH_MODES = ('full', 'incremental')
+
+    def __init__(self, name, clause, refresh='full', interval=None):
+        """ name - str - letters, digits and '_'
+            clause - dict - SQL query dressed as a dictionary (see sqlalchemy_dsl) with a 'GROUP BY' and without
+                            'ORDER BY' or 'LIMIT', which the queries answered from the table apply themselves
+            refresh - str - 'full' or 'incremental'; incremental refreshes need a clause over one table that groups
+                            by plain columns
+            interval - float or None - least seconds between refreshes, e.g. to rebuild a heavy summary at most
+                                       hourly; None to refresh at every check that finds the summary out of date
+        """
+        if not isinstance(name, str) or not _NAME.match(name):
+            raise SummaryError('invalid summary name: '+repr(name))
+        if not isinstance(clause, dict) or not clause.get('SELECT') or not clause.get('GROUP BY'):
+            raise SummaryError('summary '+name+' needs a clause with SELECT and GROUP BY')
+        for k in ['ORDER BY', 'LIMIT']:
+            if k in clause:
+                raise SummaryError('summary '+name+' cannot have '+k+'; queries of the summary apply their own')
+        if refresh not in self.REFRESH_MODES:
+            raise SummaryError('unknown refresh for summary '+name+': '+str(refresh))
+        self._name = name
+        self._clause = clause
+        self._refresh = refresh
+        self._interval = interval
+        self._columns = get_summary_columns(clause)
+
+    @staticmethod
+    def from_dict(d):
+        """ returns a SummaryTable from {'name', 'CLAUSE', 'refresh' (optional), 'interval' (optional)} """
+        if not isinstance(d, dict) or 'name' not in d or 'CLAUSE' not in d:
+            raise SummaryError('a summary needs a name and a CLAUSE: '+str(d))
+        return SummaryTable(d['name'], d['CLAUSE'], d.get('refresh', 'full'), d.get('interval'))
+
+    def get_name(self):
+        return self._name
+
+    def get_clause(self):
+        return self._clause
+
+    def get_refresh(self):
+        return self._refresh
+
+    def get_interval(self):
+        return self._interval
+
+    def get_table_name(self):
+        return 'sql_server_summary_' + self._name
+
+    def get_groups_table_name(self):
+        """ name of the table where triggers note the groups changed since the last incremental refresh """
+        return 'sql_server_groups_' + self._name
+
+    def get_index_name(self):
+        """ name of the index of the table on the grouped columns """
+        return 'sql_server_index_' + self._name
+
+    def get_definition(self):
+        """ returns a string that changes whenever the contents of the table would """
+        return json.dumps({'CLAUSE': self._clause, 'refresh': self._refresh}, cls=SqlAlchemyDslJSONEncoder,
+                          sort_keys=True)
+
+    def get_table(self):
+        """ returns the summary table as an sqlalchemy.Table """
+        return sa.Table(self.get_table_name(), sa.MetaData(),
+                        *[sa.Column('c'+str(i)) for i in range(len(self._columns))])
+
+    def get_groups_table(self):
+        return sa.Table(self.get_groups_table_name(), sa.MetaData(),
+                        *[sa.Column('k'+str(i)) for i in range(len(self._clause['GROUP BY']))])
+
+    def get_statement(self, metadata):
+        """ returns the statement computing the contents of the table, its columns in the table's order """
+        try:
+            return ClauseDictionaryToStatement(metadata).get_statement(dict(self._clause, SELECT=self._columns))
+        except SqlAlchemyDslError as e:
+            raise SummaryError('summary '+self._name+': '+str(e))
+
+    def get_source_tables(self, metadata):
+        """ returns the names of the tables the clause reads, including those it only joins through """
+        names = []
+        for table in find_tables(self.get_statement(metadata), include_joins=False):
+            if table.name not in names:
+                names.append(table.name)
+        if self._refresh == 'incremental':
+            keys = [_get_key(x) for x in self._clause['GROUP BY']]
+            if len(names) != 1 or any(modifiers or table_name != names[0] for table_name, _, modifiers in keys):
+                raise SummaryError('incremental refresh of summary '+self._name+' needs a clause over one table, '
+                                   'grouped by plain columns')
+        return names
+
+    def get_column_definitions(self, metadata, dialect):
+        """ returns the columns for CREATE TABLE; those holding a plain column get its type, and so its affinity """
+        definitions = []
+        for i, x in enumerate(self._columns):
+            expression = x.get_sqlalchemy_statement(metadata)
+            type_name = expression.type.compile(dialect=dialect) if isinstance(expression, sa.Column) else ''
+            definitions.append(('c'+str(i)+' '+type_name).strip())
+        return definitions
+
+    def get_group_positions(self):
+        """ returns the index of the table column holding each 'GROUP BY' Criterion """
+        keys = [_get_key(x) for x in self._columns]
+        return [keys.index(_get_key(x)) for x in self._clause['GROUP BY']]
+
+
+class SummaryManager:
+    """ keeps the summary tables of an SQLite database up to date, and tells which of them hold the current result
+        of their clause, so that queries can be answered from them (see ClauseDictionaryToStatement).
+        Changes to the source tables are counted by triggers, so they are seen whichever connection or process makes
+        them; a summary is up to date while the counts of its source tables are those it was last refreshed at.
+        Incremental summaries also have triggers note the groups of the rows inserted, updated or deleted, and a
+        refresh computes just those groups again. Every writer to the source tables pays for the triggers.
+        A background thread checks each check_interval seconds and refreshes the summaries that are out of date;
+        until it has, queries read the source tables. Refreshes take the database's write lock, so that several
+        processes sharing the file refresh each summary once.
+    """
+
+    def __init__(self, engine, schema_catalog, version_monitor, summaries=[], check_interval=10.0):
+        """ engine - 'sqlalchemy.engine.Engine' - engine for the database, which must be SQLite
+            schema_catalog - SchemaCatalog - cached schema of the database
+            version_monitor - DataVersionMonitor - tells when the database may have changed
+            summaries - list<SummaryTable>
+            check_interval - float or None - seconds between checks for summaries to refresh; None for no background
+                                             refreshes (refresh() can still be called)
+        """
+        names = [s.get_name() for s in summaries]
+        if len(set(names)) != len(names):
+            raise SummaryError('summary names must be unique')
+        self._engine = engine
+        self._schema_catalog = schema_catalog
+        self._version_monitor = version_monitor
+        self._summaries = list(summaries)
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # one refresh at a time in this process
+        self._fresh_key = None
+        self._fresh = []
+        self._last_attempts = {}  # name -> time.monotonic() of the last refresh
+        self._refreshes = {name: 0 for name in names}
+        self._errors = {name: None for name in names}
+        self._checker = None
+        self._stopped = threading.Event()
+
+    def get_summaries(self):
+        return list(self._summaries)
+
+    def _read_state(self, conn):
+        """ returns ({source table: changes}, {summary name: state row as a dict}) """
+        counts = dict(conn.execute(sa.select([_changes.c.table_name, _changes.c.changes])).fetchall())
+        states = {row['name']: dict(row) for row in conn.execute(sa.select([_state])).fetchall()}
+        return counts, states
+
+    def _is_fresh(self, summary, counts, states):
+        state = states.get(summary.get_name())
+        if state is None or state['definition'] != summary.get_definition():
+            return False
+        return all(counts.get(table) == n for table, n in json.loads(state['changes']).items())
+
+    def get_fresh(self):
+        """ returns the summaries whose tables hold the current result of their clause. The answer is kept until the
+            data version (see DataVersionMonitor) or the schema moves on, so asking again costs no query.
+        """
+        if not self._summaries:
+            return []
+        self._start_checker()
+        version = self._version_monitor.get_version()
+        metadata = self._schema_catalog.get_metadata()
+        key = (version, self._schema_catalog.get_generation())
+        with self._lock:
+            if version is not None and key == self._fresh_key:
+                return self._fresh
+        fresh = []
+        if _state.name in metadata.tables and _changes.name in metadata.tables:
+            with self._engine.connect() as conn:
+                counts, states = self._read_state(conn)
+            fresh = [s for s in self._summaries
+                     if s.get_table_name() in metadata.tables and self._is_fresh(s, counts, states)]
+        with self._lock:
+            self._fresh_key, self._fresh = key, fresh
+        return fresh
+
+    def _install(self, conn, summary, sources, state):
+        """ creates the state tables and the triggers the summary relies on, where they are missing
+            returns True if the summary must be computed in full, as changes may have gone unnoted
+        """
+        quote = self._engine.dialect.identifier_preparer.quote
+        _state_metadata.create_all(conn)
+        triggers = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger';")}
+        for table_name in sources:
+            conn.execute(_changes.insert().prefix_with('OR IGNORE').values(table_name=table_name, changes=0))
+            for event in ['INSERT', 'UPDATE', 'DELETE']:
+                trigger = 'sql_server_changes_' + table_name + '_' + event.lower()
+                if trigger not in triggers:
+                    conn.execute('CREATE TRIGGER {} AFTER {} ON {} BEGIN UPDATE {} SET changes = changes + 1 '
+                                 "WHERE table_name = '{}'; END;".format(quote(trigger), event, quote(table_name),
+                                                                        _changes.name, table_name.replace("'", "''")))
+                    # changes made before the trigger existed were not counted; count one to cover them
+                    conn.execute(_changes.update().where(_changes.c.table_name == table_name)
+                                 .values(changes=_changes.c.changes + 1))
+        if summary.get_refresh() != 'incremental':
+            return False
+        rebuild = state is None or state['definition'] != summary.get_definition()
+        groups = summary.get_groups_table()
+        if rebuild:
+            for event in ['insert', 'update', 'delete']:
+                conn.execute('DROP TRIGGER IF EXISTS {};'.format(quote(groups.name + '_' + event)))
+                triggers.discard(groups.name + '_' + event)
+            groups.drop(conn, checkfirst=True)
+        conn.execute('CREATE TABLE IF NOT EXISTS {} ({});'.format(quote(groups.name),
+                                                                  ', '.join(c.name for c in groups.columns)))
+        columns = [quote(x._field_name) for x in summary.get_clause()['GROUP BY']]
+        for event, rows in [('INSERT', ['NEW']), ('UPDATE', ['OLD', 'NEW']), ('DELETE', ['OLD'])]:
+            trigger = groups.name + '_' + event.lower()
+            if trigger not in triggers:
+                inserts = ' '.join('INSERT INTO {} VALUES ({});'.format(quote(groups.name),
+                                                                        ', '.join(row+'.'+c for c in columns))
+                                   for row in rows)
+                conn.execute('CREATE TRIGGER {} AFTER {} ON {} BEGIN {} END;'.format(
+                    quote(trigger), event, quote(sources[0]), inserts))
+                rebuild = True
+        return rebuild
+
+    def _refresh(self, summary, force):
+        """ refreshes summary if it is out of date (or force); returns (whether it was refreshed, whether tables
+            were created)
+        """
+        metadata = self._schema_catalog.get_metadata()
+        statement = summary.get_statement(metadata)
+        sources = summary.get_source_tables(metadata)
+        quote = self._engine.dialect.identifier_preparer.quote
+        start = time.perf_counter()
+        with self._engine.connect() as conn:
+            with conn.begin():
+                # takes the write lock now, so that no change lands between reading the counts and the source tables
+                conn.execute('BEGIN IMMEDIATE;')
+                state = None
+                if _state.name in set(self._engine.dialect.get_table_names(conn)):
+                    state = self._read_state(conn)[1].get(summary.get_name())
+                rebuild = self._install(conn, summary, sources, state)
+                counts, states = self._read_state(conn)
+                if not force and not rebuild and self._is_fresh(summary, counts, states):
+                    return False, False
+                table = summary.get_table()
+                created = state is None or state['definition'] != summary.get_definition()
+                if created:
+                    conn.execute('DROP TABLE IF EXISTS {};'.format(quote(table.name)))
+                    conn.execute('CREATE TABLE {} ({});'.format(
+                        quote(table.name), ', '.join(summary.get_column_definitions(metadata, self._engine.dialect))))
+                    conn.execute('CREATE INDEX {} ON {} ({});'.format(
+                        quote(summary.get_index_name()), quote(table.name),
+                        ', '.join('c'+str(p) for p in summary.get_group_positions())))
+                names = [c.name for c in table.columns]
+                if force or rebuild or summary.get_refresh() == 'full':
+                    conn.execute(table.delete())
+                    conn.execute(table.insert().from_select(names, statement))
+                else:
+                    groups = summary.get_groups_table()
+                    positions = summary.get_group_positions()
+                    sources_columns = [x.get_sqlalchemy_statement(metadata) for x in summary.get_clause()['GROUP BY']]
+                    conn.execute(table.delete().where(_in_groups([list(table.columns)[p] for p in positions], groups)))
+                    conn.execute(table.insert().from_select(names, statement.where(_in_groups(sources_columns,
+                                                                                              groups))))
+                if summary.get_refresh() == 'incremental':
+                    conn.execute(summary.get_groups_table().delete())
+                rows = conn.execute(sa.select([sa.func.count()]).select_from(table)).scalar()
+                conn.execute(_state.delete().where(_state.c.name == summary.get_name()))
+                conn.execute(_state.insert().values(name=summary.get_name(), definition=summary.get_definition(),
+                                                    changes=json.dumps({t: counts[t] for t in sources}),
+                                                    refreshed=time.time(), seconds=time.perf_counter() - start,
+                                                    rows=rows))
+        return True, created
+
+    def refresh(self, names=None, force=False):
+        """ names - list<str> or None - summaries to refresh; None for all of them
+            force - bool - compute the summaries in full even if they are up to date
+            returns the names of the summaries that were refreshed, leaving out those that were up to date
+        """
+        if names is None:
+            summaries = self._summaries
+        else:
+            unknown = set(names) - {s.get_name() for s in self._summaries}
+            if unknown:
+                raise SummaryError('unknown summaries: '+', '.join(sorted(unknown)))
+            summaries = [s for s in self._summaries if s.get_name() in names]
+        refreshed, created = [], False
+        with self._refresh_lock:
+            try:
+                for summary in summaries:
+                    name = summary.get_name()
+                    self._last_attempts[name] = time.monotonic()
+                    try:
+                        done, was_created = self._refresh(summary, force)
+                    except Exception as e:
+                        self._errors[name] = str(e)
+                        raise
+                    self._errors[name] = None
+                    if done:
+                        refreshed.append(name)
+                        self._refreshes[name] += 1
+                        logging.info('summary '+name+' refreshed')
+                    created = created or was_created
+            finally:
+                if created:
+                    self._schema_catalog.refresh()
+                with self._lock:
+                    self._fresh_key = None
+        return refreshed
+
+    def _refresh_due(self):
+        """ refreshes the summaries that are out of date and whose interval has passed """
+        fresh = self.get_fresh()
+        for summary in self._summaries:
+            name = summary.get_name()
+            last = self._last_attempts.get(name)
+            if summary in fresh or (last is not None and summary.get_interval() is not None and
+                                    time.monotonic() - last < summary.get_interval()):
+                continue
+            error = self._errors[name]
+            try:
+                self.refresh([name])
+            except Exception:
+                if self._errors[name] != error:  # logs each error once, rather than at every check
+                    logging.exception('refresh of summary '+name+' failed')
+
+    def _run_checks(self):
+        while not self._stopped.wait(self._check_interval):
+            self._refresh_due()
+
+    def _start_checker(self):
+        # started by the first get_fresh rather than in the constructor, so that no thread exists before a fork
+        if self._check_interval is None or self._checker is not None:
+            return
+        with self._lock:
+            if self._checker is None:
+                self._checker = threading.Thread(target=self._run_checks, name='sql_server_summary_refresh',
+                                                 daemon=True)
+                self._checker.start()
+
+    def close(self):
+        """ stops the background refreshes """
+        self._stopped.set()
+
+    def get_stats(self):
+        """ returns a list with {'name', 'table', 'refresh', 'fresh', 'rows', 'refreshed', 'seconds', 'refreshes',
+            'error'} for each summary, where 'rows', 'refreshed' (a timestamp) and 'seconds' describe its last
+            refresh by any process, and 'refreshes' and 'error' (of the last attempt) those by this one
+        """
+        fresh = self.get_fresh()
+        states = {}
+        if _state.name in self._schema_catalog.get_metadata().tables:
+            with self._engine.connect() as conn:
+                states = self._read_state(conn)[1]
+        stats = []
+        for summary in self._summaries:
+            name = summary.get_name()
+            state = states.get(name, {})
+            stats.append({'name': name, 'table': summary.get_table_name(), 'refresh': summary.get_refresh(),
+                          'fresh': summary in fresh, 'rows': state.get('rows'), 'refreshed': state.get('refreshed'),
+                          'seconds': state.get('seconds'), 'refreshes': self._refreshes[name],
+                          'error': self._errors[name]})
+        return stats
@@ -0,0 +1,112 @@
+import threading
+
+
+class TableCounter:
+    """ answers row counts for tables, either exactly or as an estimate.
+        'exact' - the result of SELECT COUNT(*) is cached per table together with the data version it was
+                  read at, and reused until the data version moves (see DataVersionMonitor)
+        'estimate' - the row count recorded by ANALYZE in sqlite_stat1; no table scan is needed.
+                     Tables without statistics fall back to 'exact'
+        Each answer is returned together with the source that produced it: 'cache', 'count' or 'sqlite_stat1'.
+    """
+    MODES = ('exact', 'estimate')
+    MAX_FUSED_COUNTS = 200  # COUNT(*) terms per UNION ALL; SQLite caps compound selects at 500 terms
+
+    def __init__(self, engine, schema_catalog, version_monitor):
+        """ engine - 'sqlalchemy.engine.Engine'
+            schema_catalog - 'SchemaCatalog' - used to check for sqlite_stat1
+            version_monitor - 'DataVersionMonitor' - used to invalidate cached counts
+        """
+        self._engine = engine
+        self._schema_catalog = schema_catalog
+        self._version_monitor = version_monitor
+        self._lock = threading.Lock()
+        self._counts = {}  # table name -> (count, data version)
+        self._stat1 = None  # (dict table name -> estimated rows, data version)
+        self._hits = 0
+        self._misses = 0
+        self._estimates = 0
+
+    def _get_exact(self, tables, connectable, cache):
+        """ returns dict table name -> (count, source) for tables, counting those not cached in fused statements """
+        if not tables:
+            return {}
+        version = self._version_monitor.get_version() if cache else None
+        results = {}
+        missing = []
+        with self._lock:
+            for table in tables:
+                cached = self._counts.get(table)
+                if version is not None and cached is not None and cached[1] == version:
+                    self._hits += 1
+                    results[table] = (cached[0], 'cache')
+                else:
+                    self._misses += 1
+                    missing.append(table)
+        # the version is read before counting, so a commit racing with the count invalidates the entries
+        for i in range(0, len(missing), self.MAX_FUSED_COUNTS):
+            chunk = missing[i:i + self.MAX_FUSED_COUNTS]
+            statement = ' UNION ALL '.join('SELECT {} AS i, COUNT(*) AS n FROM "{}"'.format(j, table)
+                                           for j, table in enumerate(chunk))
+            for j, count in connectable.execute(statement + ';'):
+                results[chunk[j]] = (count, 'count')
+        if version is not None and missing:
+            with self._lock:
+                for table in missing:
+                    self._counts[table] = (results[table][0], version)
+        return results
+
+    def _get_stat1(self, connectable, cache):
+        """ returns dict of table name -> estimated row count from sqlite_stat1 """
+        version = self._version_monitor.get_version() if cache else None
+        with self._lock:
+            if version is not None and self._stat1 is not None and self._stat1[1] == version:
+                return self._stat1[0]
+        estimates = {}
+        # the catalog describes the primary: it may revalidate on a connection to the primary that is already held,
+        # but not on one to a replica, which may lag
+        on_primary = connectable.engine is self._engine
+        if self._schema_catalog.has_table('sqlite_stat1', connectable if on_primary else None):
+            for tbl, stat in connectable.execute('SELECT tbl, stat FROM sqlite_stat1;'):
+                # the first integer of stat is the number of rows in the table (or index)
+                rows = int(stat.split()[0]) if stat else 0
+                estimates[tbl] = max(rows, estimates.get(tbl, 0))
+        with self._lock:
+            self._stat1 = (estimates, version)
+        return estimates
+
+    def get_counts(self, tables, mode='exact', connectable=None, cache=True):
+        """ tables - list<str> - names of existing tables
+            mode - str - one of MODES
+            connectable - engine or connection to run on; defaults to the engine
+            cache - bool - False to neither use nor keep cached answers, e.g. when connectable is to a replica,
+                           which the data version of the engine does not describe
+            returns dict table name -> (count, source).
+            Exact counts missing from the cache are fused into UNION ALL statements, one round trip for all.
+        """
+        connectable = connectable if connectable is not None else self._engine
+        tables = list(dict.fromkeys(tables))
+        results = {}
+        if mode == 'estimate':
+            estimates = self._get_stat1(connectable, cache)
+            for table in tables:
+                if table in estimates:
+                    results[table] = (estimates[table], 'sqlite_stat1')
+            with self._lock:
+                self._estimates += len(results)
+        results.update(self._get_exact([t for t in tables if t not in results], connectable, cache))
+        return results
+
+    def get_count(self, table, mode='exact', connectable=None, cache=True):
+        """ returns (count, source) for a single table; see get_counts """
+        return self.get_counts([table], mode, connectable, cache)[table]
+
+    def invalidate(self):
+        with self._lock:
+            self._counts = {}
+            self._stat1 = None
+
+    def get_stats(self):
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'estimates': self._estimates}
@@ -0,0 +1,145 @@
+from cheroot.wsgi import Server as WSGIServer
+import logging
+import os
+import signal
+import socket
+import time
+
+
+class SharedSocketServer(WSGIServer):
+    """ cheroot server that accepts connections on a listening socket it is given, rather than binding its own,
+        so that several worker processes can serve the same port
+    """
+
+    def __init__(self, listen_socket, *args, **kwargs):
+        """ listen_socket - socket.socket - bound socket, shared with the other workers
+            args, kwargs - passed on to cheroot.wsgi.Server
+        """
+        self._listen_socket = listen_socket
+        WSGIServer.__init__(self, *args, **kwargs)
+
+    def bind(self, family, type, proto=0):
+        self.socket = self._listen_socket
+        self.bind_addr = self.resolve_real_bind_addr(self.socket)
+        return self.socket
+
+
+class WorkerSupervisor:
+    """ pre-fork supervisor: binds the listening socket, forks num_workers processes that each serve on it
+        with their own app and database connections, and replaces any worker that exits. A worker that dies
+        soon after it started is replaced after a growing delay, so a worker that cannot start does not
+        spin; the other workers are still reaped and replaced while it waits. SIGTERM or SIGINT stop the workers
+        (with SIGTERM) and then the supervisor. Unix only.
+    """
+    # a worker that lived at least this many seconds resets its slot's restart delay
+    STABLE_SECONDS = 10.0
+    # how often exited workers are looked for while restarts are waiting on their delay
+    POLL_SECONDS = 0.1
+
+    def __init__(self, run_worker, num_workers, bind_addr, restart_delay=1.0, max_restart_delay=30.0):
+        """ run_worker - callable(listen_socket) - serves requests on the socket until the process gets SIGTERM;
+                                                   runs in each worker process
+            num_workers - int - number of worker processes
+            bind_addr - (host, port) - address to listen on
+            restart_delay, max_restart_delay - float - seconds before a worker that died young is replaced;
+                                                       the delay doubles each time, up to max_restart_delay
+        """
+        self._run_worker = run_worker
+        self._num_workers = num_workers
+        self._bind_addr = bind_addr
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._workers = {}  # pid -> (slot, start time)
+        self._delays = [restart_delay] * num_workers
+        self._restarts_due = {}  # slot -> time.monotonic() at which to replace its worker
+        self._stopping = False
+        self._socket = None
+        self.restarts = 0
+
+    def _bind(self):
+        host, port = self._bind_addr
+        family, socktype, proto, _, address = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM,
+                                                                 0, socket.AI_PASSIVE)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(socket.SOMAXCONN)
+        sock.set_inheritable(True)
+        return sock
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor decides when workers stop
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self._run_worker(self._socket)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                logging.exception('worker '+str(os.getpid())+' failed')
+                code = 1
+            finally:
+                os._exit(code)
+        self._workers[pid] = (slot, time.monotonic())
+        logging.info('worker '+str(pid)+' started in slot '+str(slot))
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self, pid, status):
+        """ forgets an exited worker, and schedules its replacement unless the supervisor is stopping """
+        slot, started = self._workers.pop(pid)
+        logging.info('worker '+str(pid)+' exited with status '+str(status))
+        if self._stopping:
+            return
+        if time.monotonic() - started >= self.STABLE_SECONDS:
+            self._delays[slot] = self._restart_delay
+        delay = self._delays[slot]
+        self._delays[slot] = min(delay * 2, self._max_restart_delay)
+        self._restarts_due[slot] = time.monotonic() + delay
+
+    def run(self):
+        """ starts the workers and supervises them until SIGTERM or SIGINT """
+        self._socket = self._bind()
+        logging.info('supervisor '+str(os.getpid())+' listening on '+str(self._socket.getsockname()[:2]))
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        try:
+            for slot in range(self._num_workers):
+                self._spawn(slot)
+            while self._workers or (self._restarts_due and not self._stopping):
+                if self._stopping:
+                    self._restarts_due.clear()
+                now = time.monotonic()
+                for slot, due in sorted(self._restarts_due.items()):
+                    if due <= now:
+                        del self._restarts_due[slot]
+                        self.restarts += 1
+                        self._spawn(slot)
+                if self._restarts_due:
+                    # restarts are waiting; poll rather than block, so that they are not held up
+                    try:
+                        pid, status = os.waitpid(-1, os.WNOHANG)
+                    except ChildProcessError:
+                        pid, status = 0, 0
+                    if pid == 0:
+                        time.sleep(max(min(min(self._restarts_due.values()) - now, self.POLL_SECONDS), 0))
+                        continue
+                else:
+                    try:
+                        pid, status = os.wait()
+                    except ChildProcessError:
+                        break
+                if pid in self._workers:
+                    self._reap(pid, status)
+        finally:
+            self._handle_stop(None, None)
+            self._socket.close()
+            logging.info('supervisor stopped')
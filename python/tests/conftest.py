@@ -0,0 +1,12 @@
+from pytest import fixture
+import os.path
+import shutil
+
+
+@fixture
+def chinook_copy(tmp_path):
+    """ path of a copy of tests/data/chinook.db, for tests that change the database or its file """
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    test_file = str(tmp_path / 'chinook.db')
+    shutil.copy(os.path.join(this_dir, 'data', 'chinook.db'), test_file)
+    return test_file
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import threading
+from sql_server.asgi_app import AsgiAdapter
+from sql_server.server import get_asgi_app
+from sql_server.sqlalchemy_dsl import Criterion
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslJSONEncoder
+
+
+def get_scope(method, path, headers=[]):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'http_version': '1.1',
+            'headers': headers, 'server': ('127.0.0.1', 8000), 'client': ('127.0.0.1', 50000)}
+
+
+async def call(asgi_app, scope, body=b''):
+    """ runs one request through asgi_app and returns (status, headers, body chunks) """
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    done = asyncio.Event()
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    done.set()
+    assert sent[0]['type'] == 'http.response.start'
+    return sent[0]['status'], dict(sent[0]['headers']), [m['body'] for m in sent[1:]]
+
+
+def test_routes():
+    _, asgi_app, _ = get_asgi_app([])
+    status, _, chunks = asyncio.run(call(asgi_app, get_scope('GET', '/debug_message')))
+    assert status == 200
+    assert b''.join(chunks) == b'SqlWrapper debug message'
+
+    body = json.dumps({'table_name': 'employees'}).encode()
+    status, headers, chunks = asyncio.run(call(asgi_app, get_scope('POST', '/get_table_count',
+                                                                   [(b'content-type', b'application/json')]), body))
+    assert status == 200
+    assert headers[b'content-type'] == b'application/json'
+    assert json.loads(b''.join(chunks))['count'] == 8
+
+    clause = {'SELECT': [Criterion('tracks', 'TrackId')]}
+    body = json.dumps({'CLAUSE': clause, 'batch_size': 100}, cls=SqlAlchemyDslJSONEncoder).encode()
+    status, _, chunks = asyncio.run(call(asgi_app, get_scope('POST', '/query'), body))
+    assert status == 200
+    assert len(chunks) > 30  # streamed as one chunk per batch
+    assert len(json.loads(b''.join(chunks))['rows']) == 3503
+
+    status, _, _ = asyncio.run(call(asgi_app, get_scope('GET', '/no_such_route')))
+    assert status == 404
+
+
+def test_admission_control():
+    release = threading.Event()
+
+    def slow_wsgi_app(environ, start_response):
+        release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+
+    asgi_app = AsgiAdapter(slow_wsgi_app, max_workers=1, max_pending=1)
+
+    async def run():
+        first = asyncio.ensure_future(call(asgi_app, get_scope('GET', '/')))
+        second = asyncio.ensure_future(call(asgi_app, get_scope('GET', '/')))
+        await asyncio.sleep(0.1)
+        rejected = await call(asgi_app, get_scope('GET', '/'))
+        release.set()
+        return rejected, await first, await second
+
+    rejected, first, second = asyncio.run(run())
+    assert rejected[0] == 503
+    assert rejected[1][b'retry-after'] == b'1'
+    assert first[0] == 200 and second[0] == 200
+    assert asgi_app.get_stats()['rejected'] == 1
+
+
+def test_disconnect_cancels():
+    produced = []
+
+    def endless_wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+
+        def body():
+            while len(produced) < 1000:
+                produced.append(1)
+                yield b'x'
+        return body()
+
+    asgi_app = AsgiAdapter(endless_wsgi_app, max_workers=1, queued_chunks=1)
+
+    async def run():
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        disconnected = asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                disconnected.set()  # client goes away after the first chunk
+                await asyncio.sleep(0.05)
+
+        await asgi_app(get_scope('GET', '/'), receive, send)
+
+    asyncio.run(run())
+    assert len(produced) < 10
@@ -0,0 +1,49 @@
+import os.path
+import sqlite3
+from benchmarks.bench_server import compare
+from benchmarks.bench_server import make_scaled_copy
+from benchmarks.bench_server import percentile
+from benchmarks.bench_server import run_benchmarks
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_compare():
+    baseline = {'a': {'p50_ms': 10.0, 'p99_ms': 20.0, 'throughput_rps': 100.0, 'errors': 0}}
+    same = {'a': {'p50_ms': 11.0, 'p99_ms': 21.0, 'throughput_rps': 90.0, 'errors': 0},
+            'new': {'p50_ms': 1.0, 'p99_ms': 1.0, 'throughput_rps': 1.0, 'errors': 0}}
+    assert compare(same, baseline, 0.2) == []
+    slower = {'a': {'p50_ms': 10.0, 'p99_ms': 30.0, 'throughput_rps': 70.0, 'errors': 1}}
+    regressions = compare(slower, baseline, 0.2)
+    assert len(regressions) == 3
+    assert regressions[0].startswith('a p99_ms')
+
+
+def test_make_scaled_copy(tmp_path):
+    dst = str(tmp_path / 'scaled.db')
+    make_scaled_copy(dst, 5000)
+    with sqlite3.connect(dst) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM invoice_items;').fetchone()[0] == 5000
+        assert conn.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = 'invoice_items';").fetchone()[0].startswith('5000')
+    mtime = os.path.getmtime(dst)
+    make_scaled_copy(dst, 5000)  # big enough already, so reused
+    assert os.path.getmtime(dst) == mtime
+
+
+def test_run_benchmarks(tmp_path):
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    db_file = os.path.join(this_dir, 'data', 'chinook.db')
+    results = run_benchmarks({'chinook': db_file}, ['get_table_names', 'query_point'], [2], 0.2,
+                             0, [], str(tmp_path / 'log.txt'))
+    assert sorted(results) == ['chinook/get_table_names/c2', 'chinook/query_point/c2']
+    for summary in results.values():
+        assert summary['errors'] == 0
+        assert summary['requests'] > 0
+        assert summary['p50_ms'] <= summary['p99_ms']
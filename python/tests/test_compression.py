@@ -0,0 +1,52 @@
+from sql_server.compression import Compressor
+from sql_server.compression import choose_encoding
+from sql_server.compression import get_available_encodings
+from werkzeug.datastructures import Accept
+from pytest import raises
+import gzip
+import zlib
+
+
+def test_choose_encoding():
+    accept = Accept([('gzip', 1), ('deflate', 1)])
+    assert choose_encoding(accept) == 'gzip'
+    assert choose_encoding(Accept([('gzip', 0.5), ('*', 0.1)]), ['gzip']) == 'gzip'
+    assert choose_encoding(Accept([('br', 1)])) is None
+    assert choose_encoding(Accept([])) is None
+    assert choose_encoding(accept, []) is None
+    # zstd is only offered where the zstandard package is installed
+    assert get_available_encodings(['gzip', 'zstd'])[0] == 'gzip'
+    assert 'gzip' in get_available_encodings()
+
+
+def test_gzip():
+    data = b'{"rows": [' + b', '.join(b'[1, "a"]' for _ in range(1000)) + b']}'
+    compressed = Compressor('gzip').compress(data)
+    assert len(compressed) < len(data) / 10
+    assert gzip.decompress(compressed) == data
+    assert Compressor('gzip').compress(data) == compressed  # no timestamp in the header
+
+    closed = []
+
+    def chunks():
+        try:
+            yield '{"rows": ['
+            yield b''
+            yield '[1, "a"]]}'
+        finally:
+            closed.append(True)
+
+    # each chunk can be decompressed as soon as it arrives
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pieces = [decompressor.decompress(c) for c in Compressor('gzip').iter_compressed(chunks())]
+    assert pieces[0] == b'{"rows": ['
+    assert b''.join(pieces) == b'{"rows": [[1, "a"]]}'
+    assert closed
+
+    stream = Compressor('gzip', 1).iter_compressed(chunks())
+    next(stream)
+    stream.close()
+    assert len(closed) == 2
+
+    with raises(ValueError):
+        Compressor('br')
@@ -0,0 +1,34 @@
+from sql_server.databases import DatabaseRegistry
+from sql_server.databases import UnknownDatabaseError
+from pytest import raises
+
+
+class FakeSqlWrapper:
+    def __init__(self):
+        self.guard = None
+
+    def set_query_guard(self, guard):
+        self.guard = guard
+
+
+def test_registry():
+    registry = DatabaseRegistry()
+    assert registry.get_default_name() is None
+    with raises(UnknownDatabaseError):
+        registry.get()
+    main, sales = FakeSqlWrapper(), FakeSqlWrapper()
+    registry.add('main', main)
+    registry.add('sales-2020.v1', sales)
+    assert registry.get() is main
+    assert registry.get('sales-2020.v1') is sales
+    assert registry.get_names() == ['main', 'sales-2020.v1']
+    assert registry.items() == [('main', main), ('sales-2020.v1', sales)]
+    with raises(UnknownDatabaseError):
+        registry.get('other')
+    with raises(ValueError):
+        registry.add('main', FakeSqlWrapper())
+    with raises(ValueError):
+        registry.add('../main', FakeSqlWrapper())
+
+    registry.set_query_guard('guard')
+    assert main.guard == 'guard' and sales.guard == 'guard'
@@ -0,0 +1,110 @@
+from sql_server.exports import ExportManager
+from sql_server.exports import ExportError
+from sql_server.sql_wrapper import SqlWrapper
+from sql_server.sqlalchemy_dsl import Criterion
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
+from sql_server.query_limits import LimitExceededError
+from pytest import raises
+import pyarrow.parquet
+import csv
+import gzip
+import os.path
+import threading
+import time
+
+
+def get_sql_wrapper():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    return SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')], {})
+
+
+def wait_for(exports, job_id):
+    deadline = time.monotonic() + 20
+    while exports.get_status(job_id)['finished'] is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return exports.get_status(job_id)
+
+
+def test_export(tmp_path):
+    s = get_sql_wrapper()
+    exports = ExportManager(str(tmp_path), batch_size=1000)
+    clause = {'SELECT': [Criterion('tracks', 'TrackId'), Criterion('tracks', 'Name'), Criterion('tracks', 'Composer')]}
+
+    status = exports.submit(s, clause, 'csv', database='default')
+    assert status['state'] in ('queued', 'running')
+    status = wait_for(exports, status['job_id'])
+    assert status['state'] == 'done'
+    assert status['rows'] == 3503
+    path, mimetype, name = exports.get_file(status['job_id'])
+    assert status['bytes'] == os.path.getsize(path)
+    assert name == 'export-' + status['job_id'] + '.csv.gz'
+    with gzip.open(path, 'rt', newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['TrackId', 'Name', 'Composer']
+    assert rows[1] == ['1', 'For Those About To Rock (We Salute You)', 'Angus Young, Malcolm Young, Brian Johnson']
+    assert len(rows) == 3504
+
+    status = wait_for(exports, exports.submit(s, clause, 'parquet', row_limit=10)['job_id'])
+    table = pyarrow.parquet.read_table(exports.get_file(status['job_id'])[0])
+    assert table.column_names == ['TrackId', 'Name', 'Composer']
+    assert table.num_rows == status['rows'] == 10
+    assert table.column('TrackId').to_pylist()[:3] == [1, 2, 3]
+
+    # no rows still gives a file with the columns
+    empty = {'SELECT': [Criterion('tracks', 'Name')],
+             'WHERE': {'AND': [Criterion('tracks', 'TrackId', comparison_operator='<', field_value=[0])]}}
+    status = wait_for(exports, exports.submit(s, empty, 'parquet')['job_id'])
+    assert pyarrow.parquet.read_table(exports.get_file(status['job_id'])[0]).column_names == ['Name']
+
+    assert [j['format'] for j in exports.list_jobs()] == ['csv', 'parquet', 'parquet']
+    exports.remove(status['job_id'])
+    assert not os.path.exists(path.replace('.csv.gz', '')) and len(exports.list_jobs()) == 2
+    with raises(KeyError):
+        exports.get_status(status['job_id'])
+    with raises(ExportError):
+        exports.submit(s, clause, 'xlsx')
+    with raises(SqlAlchemyDslError):
+        exports.submit(s, {'SELECT': [Criterion('no_table', 'Name')]})
+    exports.shutdown()
+
+
+class BlockingSqlWrapper:
+    """ stands in for SqlWrapper with rows that arrive as the test releases them """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.guard = None
+
+    def get_statement(self, clause):
+        pass
+
+    def set_query_guard(self, guard):
+        self.guard = guard
+
+    def iter_clause_rows(self, clause, row_limit, batch_size):
+        yield ['id']
+        while not self.release.wait(0.01):
+            yield [(1,)]
+
+
+def test_cancel_and_limits(tmp_path):
+    exports = ExportManager(str(tmp_path), max_workers=1, max_pending=2, ttl=0.0)
+    s = BlockingSqlWrapper()
+    running = exports.submit(s, {}, 'csv')['job_id']
+    queued = exports.submit(s, {}, 'csv')['job_id']
+    with raises(LimitExceededError):
+        exports.submit(s, {}, 'csv')
+    while exports.get_status(running)['rows'] == 0:
+        time.sleep(0.01)
+    assert s.guard is not None  # the export's statement can be interrupted
+
+    exports.remove(queued)
+    with raises(KeyError):
+        exports.get_status(queued)
+    exports.remove(running)
+    status = wait_for(exports, running)
+    assert status['state'] == 'cancelled'
+    assert os.listdir(str(tmp_path)) == []  # the partial file is gone
+    # finished jobs are forgotten after the ttl
+    assert exports.list_jobs() == []
+    exports.shutdown()
@@ -1,12 +1,20 @@
 from sql_server.flask_app import create_app
+from sql_server.sqlalchemy_dsl import Criterion
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslJSONEncoder
+from pytest import raises
 import os
 import json
+import gzip
+import pyarrow
+import sqlalchemy
+import sqlalchemy.exc
+import sqlite3
 
 
-def get_test_client():
+def get_test_client(app_config_dict={}):
     this_dir = os.path.dirname(os.path.abspath(__file__))
     sql_data_source = 'sqlite:///' + os.path.join(this_dir, 'data', 'chinook.db')
-    flask_app = create_app([sql_data_source], {})
+    flask_app = create_app([sql_data_source], {}, {}, app_config_dict)
     return flask_app.test_client()
 
 
@@ -30,10 +38,412 @@ def test_get_table_count():
     json_in = json.dumps({'table_name': 'employees'})
     rv = test_client.post('/get_table_count', data=json_in, content_type='application/json')
     content = json.loads(rv.get_data())
-    assert content == {'count': 8, 'table_name': 'employees'}
+    assert content == {'count': 8, 'table_name': 'employees', 'mode': 'exact', 'source': 'count'}
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json')
+    content = json.loads(rv.get_data())
+    assert content == {'count': 8, 'table_name': 'employees', 'mode': 'exact', 'source': 'cache'}
+
+    json_in = json.dumps({'table_name': 'tracks', 'mode': 'estimate'})
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json')
+    content = json.loads(rv.get_data())
+    assert content == {'count': 3503, 'table_name': 'tracks', 'mode': 'estimate', 'source': 'sqlite_stat1'}
+
+    json_in = json.dumps({'table_name': 'tracks', 'mode': 'guess'})
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json')
+    assert rv.status_code == 500
+    content = json.loads(rv.get_data())
+    assert content == {'error': 'unknown count mode: guess'}
 
     json_in = json.dumps({'table_name': 'non_existant_table'})
     rv = test_client.post('/get_table_count', data=json_in, content_type='application/json')
     assert rv.status_code == 500
     content = json.loads(rv.get_data())
     assert content == {'error': 'nonexistant table: non_existant_table'}
+
+
+def test_get_cache_stats():
+    test_client = get_test_client()
+    test_client.get('/get_table_names')
+    test_client.get('/get_table_names')
+    rv = test_client.get('/get_cache_stats')
+    content = json.loads(rv.get_data())
+    assert content['schema_catalog']['misses'] == 1
+    assert content['schema_catalog']['hits'] == 3  # the ETag of each response is checked against the catalog too
+    assert content['schema_catalog']['refreshes'] == 1
+
+
+def test_query():
+    test_client = get_test_client({'QUERY_ROW_LIMIT': 300})
+    clause = {'SELECT': [Criterion('media_types', 'MediaTypeId'), Criterion('media_types', 'Name')],
+              'WHERE': {'AND': [Criterion('media_types', 'MediaTypeId', comparison_operator='IN', field_value=[(2, 3)])]}}
+    json_in = json.dumps({'CLAUSE': clause}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json')
+    assert rv.is_streamed
+    content = json.loads(rv.get_data())
+    assert content == {'columns': ['MediaTypeId', 'Name'],
+                       'rows': [[2, 'Protected AAC audio file'], [3, 'Protected MPEG-4 video file']]}
+
+    # several batches, capped by the configured row limit
+    clause = {'SELECT': [Criterion('tracks', 'TrackId')]}
+    json_in = json.dumps({'CLAUSE': clause, 'batch_size': 7, 'row_limit': 1000}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json')
+    content = json.loads(rv.get_data())
+    assert len(content['rows']) == 300
+
+    json_in = json.dumps({'CLAUSE': clause, 'row_limit': 5}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json')
+    assert len(json.loads(rv.get_data())['rows']) == 5
+
+    json_in = json.dumps({'CLAUSE': {'SELECT': [Criterion('no_table', 'TrackId')]}}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json')
+    assert rv.status_code == 400
+    assert json.loads(rv.get_data()) == {'error': 'nonexistant table: no_table'}
+
+    rv = test_client.post('/query', data=json.dumps({'clause': {}}), content_type='application/json')
+    assert rv.status_code == 400
+
+    track_id = Criterion('tracks', 'TrackId')
+    for clause in [{'SELECT': [track_id], 'WHERE': [track_id]},
+                   {'SELECT': [track_id], 'WHERE': {'XOR': [track_id]}},
+                   {'SELECT': [track_id], 'WHERE': {'AND': [Criterion('tracks', 'TrackId', [], 'BETWEEN', [1])]}},
+                   {'SELECT': [track_id, 'TrackId']},
+                   {'SELECT': [track_id], 'ORDER BY': [['TrackId']]}]:
+        for page_size in [None, 10]:
+            json_in = json.dumps({'CLAUSE': clause, 'page_size': page_size}, cls=SqlAlchemyDslJSONEncoder)
+            rv = test_client.post('/query', data=json_in, content_type='application/json')
+            assert rv.status_code == 400
+            assert 'error' in json.loads(rv.get_data())
+
+
+def test_arrow_responses():
+    test_client = get_test_client()
+    arrow_headers = {'Accept': 'application/vnd.apache.arrow.stream'}
+    rv = test_client.get('/get_table_names', headers=arrow_headers)
+    assert rv.mimetype == 'application/vnd.apache.arrow.stream'
+    table = pyarrow.ipc.open_stream(rv.get_data()).read_all()
+    assert table.column('table_names').to_pylist()[:2] == ['albums', 'artists']
+
+    json_in = json.dumps({'table_name': 'employees'})
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json', headers=arrow_headers)
+    table = pyarrow.ipc.open_stream(rv.get_data()).read_all()
+    assert table.to_pydict() == {'table_name': ['employees'], 'count': [8], 'mode': ['exact'], 'source': ['count']}
+
+    clause = {'SELECT': [Criterion('invoice_items', 'InvoiceLineId'), Criterion('invoice_items', 'UnitPrice')]}
+    json_in = json.dumps({'CLAUSE': clause, 'batch_size': 500}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json', headers=arrow_headers)
+    table = pyarrow.ipc.open_stream(rv.get_data()).read_all()
+    assert table.num_rows == 2240
+    assert table.schema.names == ['InvoiceLineId', 'UnitPrice']
+    assert str(table.schema.field('UnitPrice').type) == 'double'
+
+    # the first employee reports to no one, so the first batch of ReportsTo is all null
+    clause = {'SELECT': [Criterion('employees', 'EmployeeId'), Criterion('employees', 'ReportsTo')]}
+    json_in = json.dumps({'CLAUSE': clause, 'batch_size': 1}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json', headers=arrow_headers)
+    table = pyarrow.ipc.open_stream(rv.get_data()).read_all()
+    assert str(table.schema.field('ReportsTo').type) == 'int64'
+    assert table.column('ReportsTo').to_pylist()[:3] == [None, 1, 1]
+
+
+def test_batch():
+    test_client = get_test_client({'QUERY_ROW_LIMIT': 3})
+    clause = {'SELECT': [Criterion('genres', 'Name')],
+              'WHERE': {'AND': [Criterion('genres', 'GenreId', comparison_operator='<', field_value=[3])]}}
+    operations = [{'op': 'count', 'table_name': 'employees'},
+                  {'op': 'count', 'table_name': 'tracks', 'mode': 'estimate'},
+                  {'op': 'query', 'CLAUSE': clause},
+                  {'op': 'count', 'table_name': 'albums'},
+                  {'op': 'count', 'table_name': 'non_existant_table'},
+                  {'op': 'query', 'CLAUSE': {'SELECT': [Criterion('tracks', 'TrackId')]}, 'row_limit': 100},
+                  {'op': 'drop'}]
+    json_in = json.dumps({'operations': operations}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/batch', data=json_in, content_type='application/json')
+    results = json.loads(rv.get_data())['results']
+    assert results[0] == {'table_name': 'employees', 'count': 8, 'mode': 'exact', 'source': 'count'}
+    assert results[1] == {'table_name': 'tracks', 'count': 3503, 'mode': 'estimate', 'source': 'sqlite_stat1'}
+    assert results[2] == {'columns': ['Name'], 'rows': [['Rock'], ['Jazz']]}
+    assert results[3] == {'table_name': 'albums', 'count': 347, 'mode': 'exact', 'source': 'count'}
+    assert results[4] == {'error': 'nonexistant table: non_existant_table'}
+    assert len(results[5]['rows']) == 3  # capped by QUERY_ROW_LIMIT
+    assert results[6] == {'error': 'unknown batch operation: drop'}
+
+    rv = test_client.post('/batch', data=json_in, content_type='application/json')
+    results = json.loads(rv.get_data())['results']
+    assert results[0]['source'] == 'cache'
+
+    rv = test_client.post('/batch', data=json.dumps({'operations': 'count'}), content_type='application/json')
+    assert rv.status_code == 400
+
+
+def test_metrics():
+    test_client = get_test_client()
+    json_in = json.dumps({'table_name': 'employees'})
+    test_client.post('/get_table_count', data=json_in, content_type='application/json')
+    clause = {'SELECT': [Criterion('tracks', 'TrackId')]}
+    json_in = json.dumps({'CLAUSE': clause, 'batch_size': 1000}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json')
+    rv.get_data()
+    rv.close()  # a streamed response is timed until the server closes it
+    rv = test_client.get('/metrics')
+    assert rv.mimetype == 'text/plain'
+    lines = rv.get_data(as_text=True).splitlines()
+    assert 'sql_server_request_seconds_count{route="/get_table_count",method="POST",status="200"} 1' in lines
+    assert 'sql_server_request_seconds_count{route="/query",method="POST",status="200"} 1' in lines
+    assert 'sql_server_db_seconds_count{route="/query"} 1' in lines
+    assert 'sql_server_serialization_seconds_count{route="/query"} 1' in lines
+    assert 'sql_server_rows_total{route="/query"} 3503' in lines
+    assert 'sql_server_pool_checkout_seconds_count 2' in lines
+    assert 'sql_server_cache{cache="table_counts",stat="misses"} 1' in lines
+    assert any(line.startswith('sql_server_statements_total{route="/get_table_count"}') for line in lines)
+
+    # a statement that raises leaves nothing behind on its pooled connection
+    with test_client.application.config['sql_wrapper'].get_engine().connect() as conn:
+        with raises(sqlalchemy.exc.OperationalError):
+            conn.execute('SELECT * FROM no_such_table;')
+        assert conn.execute('SELECT 1;').scalar() == 1
+        assert not [k for k in conn.info if k.startswith('sql_server')]
+
+
+def test_query_pages():
+    test_client = get_test_client()
+    clause = {'SELECT': [Criterion('invoice_items', 'InvoiceLineId')],
+              'ORDER BY': [Criterion('invoice_items', 'InvoiceId', ['DESC'])]}
+    ids, page_token = [], None
+    while True:
+        json_in = json.dumps({'CLAUSE': clause, 'page_size': 1000, 'page_token': page_token},
+                             cls=SqlAlchemyDslJSONEncoder)
+        rv = test_client.post('/query', data=json_in, content_type='application/json')
+        content = json.loads(rv.get_data())
+        ids.extend(row[0] for row in content['rows'])
+        page_token = content['next_page_token']
+        if page_token is None:
+            break
+    assert len(ids) == 2240
+    assert len(set(ids)) == 2240
+
+    json_in = json.dumps({'CLAUSE': clause, 'page_size': 1000}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json',
+                          headers={'Accept': 'application/vnd.apache.arrow.stream'})
+    assert pyarrow.ipc.open_stream(rv.get_data()).read_all().num_rows == 1000
+    assert rv.headers['X-Next-Page-Token'] == page_token_after_first(test_client, clause)
+
+    json_in = json.dumps({'CLAUSE': clause, 'page_size': 10, 'page_token': 'bad'}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json')
+    assert rv.status_code == 400
+
+
+def page_token_after_first(test_client, clause):
+    json_in = json.dumps({'CLAUSE': clause, 'page_size': 1000}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json')
+    return json.loads(rv.get_data())['next_page_token']
+
+
+def test_explain_and_index_advice():
+    test_client = get_test_client()
+    clause = {'SELECT': [Criterion('tracks', 'Name')],
+              'WHERE': {'AND': [Criterion('tracks', 'Composer', comparison_operator='=', field_value=['AC/DC'])]}}
+    json_in = json.dumps({'CLAUSE': clause}, cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/explain', data=json_in, content_type='application/json')
+    content = json.loads(rv.get_data())
+    assert content['plan'][0]['detail'] == 'SCAN tracks'
+    assert content['full_scans'] == ['tracks']
+    assert content['sql'].startswith('SELECT tracks."Name"')
+
+    test_client.post('/query', data=json_in, content_type='application/json').get_data()
+    content = json.loads(test_client.get('/index_advice').get_data())
+    assert [r['columns'] for r in content['recommendations']] == [['Composer']]
+    assert not content['applied']
+    # admin changes are off by default, and the test database is never changed
+    rv = test_client.post('/index_advice', data=json.dumps({'apply': True}), content_type='application/json')
+    assert rv.status_code == 403
+
+
+def test_limits():
+    test_client = get_test_client({'MAX_CLIENT_QUERIES': 1, 'MAX_CONCURRENT_QUERIES': 2})
+    clause = {'SELECT': [Criterion('tracks', 'Name')]}
+    json_in = json.dumps({'CLAUSE': clause}, cls=SqlAlchemyDslJSONEncoder)
+    streaming = test_client.post('/query', data=json_in, content_type='application/json',
+                                 headers={'X-Client-Id': 'a'})  # holds its slot until closed
+    rv = test_client.get('/get_table_names', headers={'X-Client-Id': 'a'})
+    assert rv.status_code == 429
+    assert rv.headers['Retry-After'] == '1'
+    assert test_client.get('/get_table_names', headers={'X-Client-Id': 'b'}).status_code == 200
+    other = test_client.post('/query', data=json_in, content_type='application/json', headers={'X-Client-Id': 'b'})
+    assert test_client.get('/get_table_names', headers={'X-Client-Id': 'c'}).status_code == 503
+    assert test_client.get('/debug_message', headers={'X-Client-Id': 'a'}).status_code == 200  # not limited
+    streaming.close()
+    other.close()
+    assert test_client.get('/get_table_names', headers={'X-Client-Id': 'a'}).status_code == 200
+
+    # an X-Statement-Timeout of 0 interrupts the statement at its first progress check, here while sorting
+    json_in = json.dumps({'CLAUSE': dict(clause, **{'ORDER BY': [Criterion('tracks', 'Name')]})},
+                         cls=SqlAlchemyDslJSONEncoder)
+    rv = test_client.post('/query', data=json_in, content_type='application/json',
+                          headers={'X-Statement-Timeout': '0'})
+    assert rv.status_code == 504
+    assert json.loads(rv.get_data()) == {'error': 'statement timeout'}
+    rv = test_client.post('/query', data=json_in, content_type='application/json',
+                          headers={'X-Statement-Timeout': 'soon'})
+    assert rv.status_code == 400
+    assert len(json.loads(test_client.post('/query', data=json_in, content_type='application/json').get_data())['rows']) == 3503
+
+
+def test_compression():
+    test_client = get_test_client({'COMPRESSION_ENCODINGS': ['gzip']})
+    clause = {'SELECT': [Criterion('tracks', 'Name')]}
+    json_in = json.dumps({'CLAUSE': clause}, cls=SqlAlchemyDslJSONEncoder)
+    plain = test_client.post('/query', data=json_in, content_type='application/json').get_data()
+    rv = test_client.post('/query', data=json_in, content_type='application/json',
+                          headers={'Accept-Encoding': 'gzip, deflate'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in rv.headers['Vary']
+    assert gzip.decompress(rv.get_data()) == plain
+
+    # small responses are not worth compressing
+    rv = test_client.get('/get_table_names', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in rv.headers
+    test_client = get_test_client({'COMPRESSION_MIN_BYTES': 0, 'COMPRESSION_ENCODINGS': ['gzip']})
+    rv = test_client.get('/get_table_names', headers={'Accept-Encoding': 'gzip'})
+    assert json.loads(gzip.decompress(rv.get_data()))['table_names'][0] == 'albums'
+    test_client = get_test_client({'COMPRESSION_MIN_BYTES': 0, 'COMPRESSION_ENCODINGS': []})
+    assert 'Content-Encoding' not in test_client.get('/get_table_names', headers={'Accept-Encoding': 'gzip'}).headers
+
+
+def test_etags(chinook_copy):
+    flask_app = create_app(['sqlite:///' + chinook_copy], {})
+    test_client = flask_app.test_client()
+    statements = []
+    sqlalchemy.event.listen(flask_app.config['sql_wrapper'].get_engine(), 'before_cursor_execute',
+                            lambda *args: statements.append(args[2]))
+
+    rv = test_client.get('/get_table_names')
+    etag = rv.headers['ETag']
+    assert rv.get_etag() == (etag.strip('"'), False)  # strong
+    del statements[:]
+    rv = test_client.get('/get_table_names', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.get_data() == b''
+    assert rv.headers['ETag'] == etag
+    assert statements == []  # answered without running a query
+
+    json_in = json.dumps({'table_name': 'genres'})
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json')
+    count_etag = rv.headers['ETag']
+    assert count_etag != etag
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json',
+                          headers={'If-None-Match': count_etag})
+    assert rv.status_code == 304
+    rv = test_client.post('/get_table_count', data=json.dumps({'table_name': 'tracks'}),
+                          content_type='application/json', headers={'If-None-Match': count_etag})
+    assert rv.status_code == 200
+    # a different representation has a different tag
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json',
+                          headers={'If-None-Match': count_etag, 'Accept': 'application/vnd.apache.arrow.stream'})
+    assert rv.status_code == 200
+
+    # a change to the data, here from another connection, changes the tags
+    conn = sqlite3.connect(chinook_copy)
+    conn.execute("INSERT INTO genres (Name) VALUES ('Test Genre');")
+    conn.commit()
+    conn.close()
+    rv = test_client.post('/get_table_count', data=json_in, content_type='application/json',
+                          headers={'If-None-Match': count_etag})
+    assert rv.status_code == 200
+    assert json.loads(rv.get_data())['count'] == 26
+    assert rv.headers['ETag'] != count_etag
+    assert test_client.get('/get_table_names', headers={'If-None-Match': etag}).status_code == 200
+
+    # not for endpoints that are not cacheable, nor with ETAGS off
+    assert 'ETag' not in test_client.get('/get_cache_stats').headers
+    test_client = create_app(['sqlite:///' + chinook_copy], {}, {}, {'ETAGS': False}).test_client()
+    assert 'ETag' not in test_client.get('/get_table_names').headers
+
+
+def test_databases(tmp_path):
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    test_file = os.path.join(this_dir, 'data', 'chinook.db')
+    other_file = str(tmp_path / 'other.db')
+    conn = sqlite3.connect(other_file)
+    conn.execute('CREATE TABLE things (id INTEGER PRIMARY KEY, name TEXT);')
+    conn.execute("INSERT INTO things (name) VALUES ('a'), ('b');")
+    conn.commit()
+    conn.close()
+    replica = 'sqlite:///file:' + test_file + '?mode=ro&uri=true'
+    flask_app = create_app(['sqlite:///' + test_file], {}, {'replica_args_lists': [[replica]]}, {},
+                           {'other': {'engine_args_list': ['sqlite:///' + other_file]}})
+    test_client = flask_app.test_client()
+
+    assert 'albums' in json.loads(test_client.get('/get_table_names').get_data())['table_names']
+    rv = test_client.get('/get_table_names', headers={'X-Database': 'other'})
+    assert json.loads(rv.get_data()) == {'table_names': ['things']}
+    rv = test_client.post('/get_table_count?database=other', data=json.dumps({'table_name': 'things'}),
+                          content_type='application/json')
+    assert json.loads(rv.get_data())['count'] == 2
+    rv = test_client.get('/get_table_names', headers={'X-Database': 'nope'})
+    assert rv.status_code == 404
+    assert json.loads(rv.get_data()) == {'error': 'unknown database: nope'}
+
+    test_client.post('/get_table_count', data=json.dumps({'table_name': 'genres'}), content_type='application/json')
+    content = json.loads(test_client.get('/databases').get_data())
+    assert [(d['name'], d['default']) for d in content['databases']] == [('default', True), ('other', False)]
+    assert [r['connections'] for r in content['databases'][0]['replicas']] == [1]  # reads went to the replica
+    assert content['databases'][1]['replicas'] == []
+    metrics = test_client.get('/metrics').get_data(as_text=True)
+    assert 'sql_server_cache{cache="other:schema_catalog",stat="refreshes"} 1' in metrics.splitlines()
+
+
+def test_exports(tmp_path):
+    test_client = get_test_client({'EXPORT_DIR': str(tmp_path)})
+    clause = {'SELECT': [Criterion('genres', 'GenreId'), Criterion('genres', 'Name')]}
+    rv = test_client.post('/exports', data=json.dumps({'CLAUSE': clause, 'format': 'csv'}, cls=SqlAlchemyDslJSONEncoder),
+                          content_type='application/json')
+    assert rv.status_code == 202
+    job_id = json.loads(rv.get_data())['job_id']
+    assert rv.headers['Location'].endswith('/exports/' + job_id)
+
+    content = json.loads(test_client.get('/exports/' + job_id).get_data())
+    while content['finished'] is None:
+        content = json.loads(test_client.get('/exports/' + job_id).get_data())
+    assert content['state'] == 'done'
+    assert content['rows'] == 25
+    rv = test_client.get('/exports/' + job_id + '/download')
+    assert rv.status_code == 200
+    assert rv.headers['Content-Type'] == 'application/gzip'
+    assert 'export-' + job_id + '.csv.gz' in rv.headers['Content-Disposition']
+    lines = gzip.decompress(rv.get_data()).decode('utf-8').splitlines()
+    assert lines[:2] == ['GenreId,Name', '1,Rock']
+    rv.close()
+    assert [e['job_id'] for e in json.loads(test_client.get('/exports').get_data())['exports']] == [job_id]
+
+    rv = test_client.post('/exports', data=json.dumps({'CLAUSE': clause, 'format': 'xlsx'}, cls=SqlAlchemyDslJSONEncoder),
+                          content_type='application/json')
+    assert rv.status_code == 400
+    assert test_client.get('/exports/nope').status_code == 404
+    assert test_client.get('/exports/nope/download').status_code == 404
+    assert json.loads(test_client.delete('/exports/' + job_id).get_data())['removed']
+    assert test_client.get('/exports/' + job_id + '/download').status_code == 404
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_summaries(chinook_copy):
+    clause = {'SELECT': [Criterion('genres', 'Name'), Criterion('tracks', 'TrackId', ['COUNT'])],
+              'GROUP BY': [Criterion('genres', 'Name')]}
+    flask_app = create_app(['sqlite:///' + chinook_copy], {},
+                           {'summaries': [{'name': 'by_genre', 'CLAUSE': clause}], 'summary_check_interval': None})
+    test_client = flask_app.test_client()
+    query = json.dumps({'CLAUSE': clause}, cls=SqlAlchemyDslJSONEncoder)
+    before = test_client.post('/query', data=query, content_type='application/json').get_data()
+
+    assert [(s['name'], s['fresh']) for s in json.loads(test_client.get('/summaries').get_data())['summaries']] == \
+        [('by_genre', False)]
+    rv = test_client.post('/summaries/refresh', data=json.dumps({}), content_type='application/json')
+    assert json.loads(rv.get_data()) == {'refreshed': ['by_genre']}
+    assert json.loads(test_client.get('/summaries').get_data())['summaries'][0]['fresh']
+    rv = test_client.post('/explain', data=query, content_type='application/json')
+    assert 'FROM sql_server_summary_by_genre' in json.loads(rv.get_data())['sql']
+    assert test_client.post('/query', data=query, content_type='application/json').get_data() == before
+
+    rv = test_client.post('/summaries/refresh', data=json.dumps({'force': True}), content_type='application/json')
+    assert rv.status_code == 403
+    rv = test_client.post('/summaries/refresh', data=json.dumps({'names': ['nope']}), content_type='application/json')
+    assert rv.status_code == 400
@@ -0,0 +1,63 @@
+from sql_server.index_advisor import IndexAdvisor
+from sql_server.index_advisor import get_plan_tree
+from sql_server.index_advisor import get_full_scans
+from sql_server.sql_wrapper import SqlWrapper
+from sql_server.sqlalchemy_dsl import Criterion
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
+from pytest import raises
+import sqlalchemy.exc
+
+
+def test_plan_tree():
+    rows = [(2, 0, 0, 'SCAN t'), (5, 0, 0, 'CORRELATED SCALAR SUBQUERY 1'), (9, 5, 0, 'SCAN "u" AS x'),
+            (12, 5, 0, 'SCAN v USING COVERING INDEX ix_v')]
+    plan = get_plan_tree(rows)
+    assert [node['detail'] for node in plan] == ['SCAN t', 'CORRELATED SCALAR SUBQUERY 1']
+    assert len(plan[1]['children']) == 2
+    assert get_full_scans(plan) == ['t', 'u']
+
+
+def test_log():
+    advisor = IndexAdvisor(max_clauses=2)
+    advisor.record('a', {}, {'p0': 1})
+    advisor.record('b', {}, {})
+    advisor.record('a', {}, {'p0': 2})
+    advisor.record('c', {}, {})
+    assert advisor.get_logged_clauses() == [('a', {}, {'p0': 2}, 2), ('c', {}, {}, 1)]
+
+
+    def explain(shape, clause, params):  # e.g. the schema has changed since the clause was logged
+        raise sqlalchemy.exc.OperationalError('EXPLAIN', {}, Exception('no such table'))
+
+    assert advisor.get_recommendations(sqlalchemy.MetaData(), explain, str) == []
+
+
+def test_advice(chinook_copy):
+    s = SqlWrapper(['sqlite:///'+chinook_copy], {})
+    clause = {'SELECT': [Criterion('tracks', 'Name')],
+              'WHERE': {'AND': [Criterion('tracks', 'Milliseconds', comparison_operator='>', field_value=[1000]),
+                                Criterion('tracks', 'Composer', comparison_operator='=', field_value=['AC/DC'])]}}
+    join_clause = {'SELECT': [Criterion('albums', 'Title'), Criterion('artists', 'Name')],
+                   'WHERE': {'OR': [Criterion('artists', 'Name', comparison_operator='=', field_value=['AC/DC'])]}}
+    explained = s.explain_clause(clause)
+    assert explained['full_scans'] == ['tracks']
+    assert s.get_index_advice() == []  # nothing has been run yet
+
+    for c in [clause, clause, join_clause]:
+        list(s.iter_clause_rows(c))
+    # a clause that does not compile is not logged, and so cannot break the advice
+    malformed = {'SELECT': [Criterion('tracks', 'Name')],
+                 'WHERE': [Criterion('tracks', 'Composer', comparison_operator='=', field_value=['AC/DC'])]}
+    with raises(SqlAlchemyDslError):
+        list(s.iter_clause_rows(malformed))
+    advice = s.get_index_advice()
+    assert [(r['table'], r['columns'], r['runs']) for r in advice] == [('tracks', ['Composer', 'Milliseconds'], 2),
+                                                                        ('artists', ['Name'], 1)]
+    assert advice[0]['sql'] == 'CREATE INDEX IF NOT EXISTS "ix_tracks_Composer_Milliseconds" ' +\
+        'ON tracks ("Composer", "Milliseconds");'
+
+    assert s.apply_index_advice() == advice
+    assert s.explain_clause(clause)['full_scans'] == []
+    assert s.explain_clause(join_clause)['full_scans'] == []
+    assert s.get_index_advice() == []
+    assert sum(len(b) for b in list(s.iter_clause_rows(clause))[1:]) == 8
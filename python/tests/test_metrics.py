@@ -0,0 +1,32 @@
+from sql_server.metrics import Counter
+from sql_server.metrics import Histogram
+from sql_server.metrics import Gauge
+from sql_server.metrics import MetricsRegistry
+
+
+def test_render():
+    registry = MetricsRegistry()
+    c = registry.register(Counter('test_total', 'a counter', ['route']))
+    h = registry.register(Histogram('test_seconds', 'a histogram', ['route'], buckets=(0.1, 1.0)))
+    registry.register(Gauge('test_gauge', 'a gauge', ['name'], lambda: [(('a"b',), 1.5)]))
+    c.inc(2, ('/x',))
+    c.inc(1, ('/x',))
+    h.observe(0.05, ('/x',))
+    h.observe(0.5, ('/x',))
+    h.observe(5, ('/x',))
+    assert c.get(('/x',)) == 3
+    assert h.get_count(('/x',)) == 3
+    assert registry.render() == '\n'.join([
+        '# HELP test_total a counter',
+        '# TYPE test_total counter',
+        'test_total{route="/x"} 3',
+        '# HELP test_seconds a histogram',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{route="/x",le="0.1"} 1',
+        'test_seconds_bucket{route="/x",le="1.0"} 2',
+        'test_seconds_bucket{route="/x",le="+Inf"} 3',
+        'test_seconds_sum{route="/x"} 5.55',
+        'test_seconds_count{route="/x"} 3',
+        '# HELP test_gauge a gauge',
+        '# TYPE test_gauge gauge',
+        'test_gauge{name="a\\"b"} 1.5']) + '\n'
@@ -0,0 +1,75 @@
+from sql_server.pagination import KeysetPagination
+from sql_server.sqlalchemy_dsl import Criterion
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
+from sql_server.sqlalchemy_dsl import parametrize_clause
+from pytest import raises
+import sqlalchemy
+import datetime
+import decimal
+import os.path
+
+
+def get_engine_and_metadata():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    engine = sqlalchemy.create_engine('sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db'))
+    metadata = sqlalchemy.MetaData()
+    metadata.reflect(engine)
+    return engine, metadata
+
+
+def get_pagination(metadata, clause):
+    return KeysetPagination(metadata, clause, parametrize_clause(clause)[0])
+
+
+def test_tokens():
+    _, metadata = get_engine_and_metadata()
+    clause = {'SELECT': [Criterion('invoices', 'Total')],
+              'ORDER BY': [Criterion('invoices', 'CustomerId'), Criterion('invoices', 'InvoiceDate')]}
+    pagination = get_pagination(metadata, clause)
+    assert pagination.get_key_count() == 3  # then InvoiceId to break ties
+    values = [decimal.Decimal('1.98'), datetime.datetime(2009, 1, 2, 3, 4, 5), None]
+    assert pagination.read_token(pagination.make_token(values)) == values
+
+    other = get_pagination(metadata, {'SELECT': [Criterion('invoices', 'BillingCity')]})
+    with raises(SqlAlchemyDslError):
+        other.read_token(pagination.make_token([1, 2, 3]))
+    with raises(SqlAlchemyDslError):
+        pagination.read_token('not a token')
+
+
+def test_validation():
+    _, metadata = get_engine_and_metadata()
+    with raises(SqlAlchemyDslError):  # not indexed
+        get_pagination(metadata, {'SELECT': [Criterion('tracks', 'Name')], 'ORDER BY': [Criterion('tracks', 'Name')]})
+    with raises(SqlAlchemyDslError):  # not a plain column
+        get_pagination(metadata, {'SELECT': [Criterion('tracks', 'Name')],
+                                  'ORDER BY': [Criterion('tracks', 'AlbumId', ['COUNT'])]})
+    with raises(SqlAlchemyDslError):
+        get_pagination(metadata, {'SELECT': [Criterion('tracks', 'Name'), Criterion('albums', 'Title')]})
+    with raises(SqlAlchemyDslError):
+        get_pagination(metadata, {'SELECT': [Criterion('tracks', 'Name')],
+                                  'GROUP BY': [Criterion('tracks', 'Name')]})
+
+
+def test_seek():
+    engine, metadata = get_engine_and_metadata()
+    for direction in ['ASC', 'DESC']:
+        # ReportsTo is NULL for one employee, which sorts first ascending and last descending
+        clause = {'SELECT': [Criterion('employees', 'EmployeeId')],
+                  'ORDER BY': [Criterion('employees', 'ReportsTo', [direction])]}
+        pagination = get_pagination(metadata, clause)
+        select = sqlalchemy.select([metadata.tables['employees'].columns['EmployeeId']])
+        with engine.connect() as conn:
+            expected = conn.execute(pagination.get_statement(select, None, 100)).fetchall()
+            seen = []
+            key_values = None
+            while True:
+                statement = pagination.get_statement(select, pagination.get_null_mask(key_values), 2)
+                params = {'k'+str(i): v for i, v in enumerate(key_values or []) if v is not None}
+                rows = conn.execute(statement, params).fetchall()
+                seen.extend(rows[:2])
+                if len(rows) <= 2:
+                    break
+                key_values = pagination.read_token(pagination.make_token(list(rows[1])[1:]))
+        assert seen == expected
+        assert len(seen) == 8
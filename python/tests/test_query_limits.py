@@ -0,0 +1,69 @@
+from sql_server.query_limits import ConcurrencyLimiter
+from sql_server.query_limits import LimitExceededError
+from sql_server.query_limits import QueryGuard
+from sql_server.query_limits import QueryInterruptedError
+from sql_server.sql_wrapper import SqlWrapper
+from pytest import raises
+import os.path
+import threading
+import time
+
+SLOW_SQL = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT COUNT(*) FROM c, tracks;'
+
+
+def test_guard():
+    assert not QueryGuard().check()
+    guard = QueryGuard(timeout=0.01)
+    assert not guard.check()
+    time.sleep(0.02)
+    assert guard.check()
+    assert guard.reason == 'timeout'
+
+    cancelled = threading.Event()
+    guard = QueryGuard(cancelled=cancelled)
+    cancelled.set()
+    assert guard.check()
+    assert guard.reason == 'cancelled'
+
+
+def test_interrupt():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    s = SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')], {})
+    s.set_query_guard(QueryGuard(timeout=0.1))
+    start = time.monotonic()
+    with raises(QueryInterruptedError) as e:
+        with s._connect() as conn:
+            conn.execute(SLOW_SQL).fetchall()
+    assert e.value.reason == 'timeout'
+    assert time.monotonic() - start < 5
+
+    cancelled = threading.Event()
+    s.set_query_guard(QueryGuard(cancelled=cancelled))
+    threading.Timer(0.1, cancelled.set).start()
+    with raises(QueryInterruptedError) as e:
+        with s._connect() as conn:
+            conn.execute(SLOW_SQL).fetchall()
+    assert e.value.reason == 'cancelled'
+
+    s.set_query_guard(None)
+    assert s.get_table_count('tracks') == 3503
+
+
+def test_limiter():
+    limiter = ConcurrencyLimiter(max_concurrent=2, max_per_client=1)
+    limiter.acquire('a')
+    with raises(LimitExceededError) as e:
+        limiter.acquire('a')
+    assert e.value.status_code == 429
+    limiter.acquire('b')
+    with raises(LimitExceededError) as e:
+        limiter.acquire('c')
+    assert e.value.status_code == 503
+    limiter.release('a')
+    limiter.acquire('c')
+    assert limiter.get_stats() == {'in_flight': 2, 'clients': 2, 'rejected_429': 1, 'rejected_503': 1}
+
+    limiter = ConcurrencyLimiter(max_concurrent=1, queue_timeout=1.0)
+    limiter.acquire('a')
+    threading.Timer(0.05, limiter.release, ('a',)).start()
+    limiter.acquire('a')  # waits for the slot rather than being rejected
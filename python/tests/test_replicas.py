@@ -0,0 +1,43 @@
+from sql_server.replicas import ReplicaSet
+import sqlalchemy
+import sqlalchemy.pool
+import os.path
+
+
+def get_read_only_engine(path):
+    return sqlalchemy.create_engine('sqlite:///file:' + path + '?mode=ro&uri=true',
+                                    poolclass=sqlalchemy.pool.QueuePool, connect_args={'check_same_thread': False})
+
+
+def test_replica_set(tmp_path):
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    test_file = os.path.join(this_dir, 'data', 'chinook.db')
+    missing = get_read_only_engine(str(tmp_path / 'missing.db'))
+    replicas = ReplicaSet([get_read_only_engine(test_file), missing, get_read_only_engine(test_file)], None)
+
+    # connections go to the replica with the fewest in use; one that cannot connect is left out
+    conns = [replicas.connect() for _ in range(4)]
+    assert [s['connections'] for s in replicas.get_stats()] == [2, 0, 2]
+    assert [s['in_use'] for s in replicas.get_stats()] == [2, 0, 2]
+    assert [s['healthy'] for s in replicas.get_stats()] == [True, False, True]
+    assert replicas.get_stats()[1]['failures'] == 1
+    assert conns[0].execute('SELECT COUNT(*) FROM genres;').scalar() == 25
+    conns[0].close()
+    conns[1].close()
+    assert replicas.get_stats()[0]['in_use'] == 1
+    conns.append(replicas.connect())
+    assert sorted(s['in_use'] for s in replicas.get_stats()) == [0, 1, 2]
+    for conn in conns[2:]:
+        conn.close()
+
+    # the health check brings a replica back once it works again
+    assert replicas.check() == [True, False, True]
+    os.symlink(test_file, str(tmp_path / 'missing.db'))
+    assert replicas.check() == [True, True, True]
+    assert replicas.connect() is not None
+
+    replicas = ReplicaSet([missing], None)
+    os.remove(str(tmp_path / 'missing.db'))
+    missing.dispose()
+    assert replicas.connect() is None
+    replicas.close()
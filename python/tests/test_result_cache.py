@@ -0,0 +1,123 @@
+import threading
+import time
+from sql_server.result_cache import ResultCache
+from sql_server.result_cache import estimate_bytes
+from sql_server.query_limits import QueryInterruptedError
+
+
+class Version:
+    def __init__(self):
+        self.value = 1
+
+    def __call__(self):
+        return self.value
+
+
+def test_lookup_and_store():
+    version = Version()
+    cache = ResultCache(version)
+    hit, _, v = cache.lookup('a')
+    assert not hit
+    cache.store('a', [(1, 'x')], v)
+    assert cache.lookup('a')[:2] == (True, [(1, 'x')])
+
+    version.value = 2  # data changed; everything cached is dropped
+    assert not cache.lookup('a')[0]
+    cache.store('a', [(2, 'y')], v)  # computed against the old version, so not stored
+    assert not cache.lookup('a')[0]
+    stats = cache.get_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 3
+    assert stats['invalidations'] == 1
+    assert stats['entries'] == 0
+
+
+def test_byte_budget_and_ttl():
+    row = [(1, 'x' * 100)]
+    cache = ResultCache(Version(), max_bytes=estimate_bytes(row) * 4)
+    for key in 'abcd':
+        cache.store(key, row, 1)
+    cache.lookup('a')  # 'b' is now the least recently used
+    cache.store('e', row, 1)
+    assert [cache.lookup(k)[0] for k in 'abcde'] == [True, False, True, True, True]
+    assert cache.get_stats()['evictions'] == 1
+    cache.store('big', row * 2, 1)  # over a quarter of the budget
+    assert not cache.lookup('big')[0]
+
+    cache = ResultCache(Version(), ttl=0.01)
+    cache.store('a', row, 1)
+    time.sleep(0.02)
+    assert not cache.lookup('a')[0]
+
+    cache = ResultCache(lambda: None)  # no version means nothing can be cached
+    cache.store('a', row, None)
+    assert not cache.lookup('a')[0]
+
+
+def test_coalescing():
+    cache = ResultCache(Version())
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+                 for _ in range(3)]
+    for t in followers:
+        t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+    assert len(calls) == 1
+    assert sorted(results) == [('result', 'coalesced')] * 3 + [('result', 'computed')]
+    assert cache.get_or_compute('k', compute) == ('result', 'cache')
+    assert cache.get_stats()['coalesced'] == 3
+
+
+def test_coalescing_after_interrupt():
+    # a caller that waited on one whose own QueryGuard stopped the query runs it itself
+    cache = ResultCache(Version())
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def interrupted():
+        calls.append('leader')
+        started.set()
+        release.wait(5)
+        raise QueryInterruptedError('timeout')
+
+    def compute():
+        calls.append('follower')
+        return 'result'
+
+    errors, results = [], []
+
+    def lead():
+        try:
+            cache.get_or_compute('k', interrupted)
+        except QueryInterruptedError as e:
+            errors.append(e.reason)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    for t in [leader, follower]:
+        t.join()
+    assert errors == ['timeout']
+    assert results == [('result', 'computed')]
+    assert calls == ['leader', 'follower']
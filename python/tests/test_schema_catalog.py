@@ -0,0 +1,42 @@
+import sqlalchemy
+import os.path
+from sql_server.schema_catalog import SchemaCatalog
+
+
+def get_test_file():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(this_dir, 'data', 'chinook.db')
+
+
+def test_catalog_caches():
+    engine = sqlalchemy.create_engine('sqlite:///'+get_test_file())
+    catalog = SchemaCatalog(engine, ttl=None)
+    assert catalog.get_stats() == {'hits': 0, 'misses': 0, 'refreshes': 0, 'schema_version': None}
+    assert catalog.get_table_names() == sorted(engine.table_names())
+    assert catalog.has_table('employees')
+    assert not catalog.has_table('non_existant_table')
+    assert catalog.get_columns('media_types') == ['MediaTypeId', 'Name']
+    assert catalog.get_columns('non_existant_table') is None
+    assert 'albums' in catalog.get_metadata().tables
+    stats = catalog.get_stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 5
+    assert stats['refreshes'] == 1
+    assert stats['schema_version'] is not None
+
+
+def test_catalog_schema_change(chinook_copy):
+    engine = sqlalchemy.create_engine('sqlite:///'+chinook_copy)
+    catalog = SchemaCatalog(engine, ttl=0)
+    assert not catalog.has_table('new_table')
+    assert catalog.has_table('albums')  # revalidated, but schema unchanged
+    assert catalog.get_stats()['refreshes'] == 1
+
+    engine.execute('CREATE TABLE new_table (id INTEGER PRIMARY KEY, name TEXT);')
+    assert catalog.has_table('new_table')
+    assert catalog.get_columns('new_table') == ['id', 'name']
+    assert catalog.get_stats()['refreshes'] == 2
+    assert catalog.get_generation() == 2
+
+    catalog.refresh()
+    assert catalog.get_stats()['refreshes'] == 3
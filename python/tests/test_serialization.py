@@ -0,0 +1,54 @@
+import decimal
+import pyarrow
+import sqlalchemy.types
+from werkzeug.datastructures import MIMEAccept
+from sql_server.serialization import iter_arrow_stream
+from sql_server.serialization import get_arrow_bytes
+from sql_server.serialization import get_response_mimetype
+from sql_server.serialization import JSON_MIMETYPE
+from sql_server.serialization import ARROW_STREAM_MIMETYPE
+
+
+def test_get_response_mimetype():
+    assert get_response_mimetype(MIMEAccept([])) == JSON_MIMETYPE
+    assert get_response_mimetype(MIMEAccept([('*/*', 1)])) == JSON_MIMETYPE
+    assert get_response_mimetype(MIMEAccept([(ARROW_STREAM_MIMETYPE, 1)])) == ARROW_STREAM_MIMETYPE
+    assert get_response_mimetype(MIMEAccept([(ARROW_STREAM_MIMETYPE, 1), (JSON_MIMETYPE, 0.5)])) == \
+        ARROW_STREAM_MIMETYPE
+
+
+def test_arrow_stream():
+    batches = [[(1, 'a', decimal.Decimal('0.99'), None)],
+               [(2, None, decimal.Decimal('10.99'), 'x'), (3, 'c', None, None)]]
+    data = b''.join(iter_arrow_stream(['id', 'name', 'price', 'note'], batches))
+    table = pyarrow.ipc.open_stream(data).read_all()
+    assert table.schema.names == ['id', 'name', 'price', 'note']
+    assert str(table.schema.field('price').type) == 'double'
+    assert table.to_pydict() == {'id': [1, 2, 3],
+                                 'name': ['a', None, 'c'],
+                                 'price': [0.99, 10.99, None],
+                                 'note': [None, 'x', None]}
+
+    table = pyarrow.ipc.open_stream(get_arrow_bytes(['id'], [])).read_all()
+    assert table.schema.names == ['id']
+    assert table.num_rows == 0
+
+
+def test_arrow_stream_types():
+    # a first batch of nulls says nothing about the column; the SQL types fix the schema before any rows
+    batches = [[(1, None, None)], [(2, 1, 'x')], [(3, 2, None)]]
+    sql_types = [sqlalchemy.types.Integer(), sqlalchemy.types.Integer(), sqlalchemy.types.NullType()]
+    table = pyarrow.ipc.open_stream(b''.join(iter_arrow_stream(['id', 'parent', 'note'], batches, sql_types))).read_all()
+    assert [str(t) for t in table.schema.types] == ['int64', 'int64', 'string']
+    assert table.to_pydict() == {'id': [1, 2, 3], 'parent': [None, 1, 2], 'note': [None, 'x', None]}
+
+    # SQLite keeps any value in any column; later batches are cast to the schema fixed by the first
+    batches = [[(None, 'a')], [(7, 2)], [(2.0, 'c'), ('9', b'd'), ('x', 1.5)]]
+    table = pyarrow.ipc.open_stream(b''.join(iter_arrow_stream(['n', 's'], batches))).read_all()
+    assert table.to_pydict() == {'n': [None, '7', '2.0', '9', 'x'], 's': ['a', '2', 'c', 'd', '1.5']}
+    batches = [[(1,)], [(2.0,), ('3',), ('x',), (2.5,)]]
+    table = pyarrow.ipc.open_stream(b''.join(iter_arrow_stream(['n'], batches, [sqlalchemy.types.Integer()]))).read_all()
+    assert table.column('n').to_pylist() == [1, 2, 3, None, None]
+
+    table = pyarrow.ipc.open_stream(get_arrow_bytes(['id'], [], [sqlalchemy.types.Integer()])).read_all()
+    assert str(table.schema.field('id').type) == 'int64'
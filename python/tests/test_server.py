@@ -1,6 +1,22 @@
 import requests
 from multiprocessing.pool import ThreadPool
 from sql_server.server import get_server
+from sql_server.server import _parse_args
+from sql_server.server import _get_engine_kwargs
+from sql_server.server import _get_num_threads
+from sql_server.server import _get_sql_source
+from sql_server.server import _get_sqlite_pragmas
+from sql_server.server import _get_databases
+from sql_server.server import _get_summaries
+from sql_server.sqlalchemy_dsl import Criterion
+from sql_server.sqlalchemy_dsl import SqlAlchemyDslJSONEncoder
+from pytest import raises
+import sqlalchemy.pool
+import os.path
+import json
+import subprocess
+import sys
+import time
 
 
 def test_app_debug_message():
@@ -20,3 +36,107 @@ def test_server_debug_message():
     rv = async_result.get()
     assert rv.text == 'SqlWrapper debug message'
     s.stop()
+
+
+def test_pool_args():
+    args = _parse_args([])
+    assert _get_engine_kwargs(args) == {'poolclass': sqlalchemy.pool.QueuePool,
+                                        'pool_size': 10,
+                                        'max_overflow': 4,
+                                        'connect_args': {'check_same_thread': False}}
+    assert _get_num_threads(args) == 10  # the overflow is left for exports, summary refreshes and the warm-up
+    assert _get_engine_kwargs(_parse_args(['--export_workers', '5']))['max_overflow'] == 7
+
+    args = _parse_args(['--pool_size', '4', '--max_overflow', '2', '--check_same_thread'])
+    assert _get_engine_kwargs(args)['connect_args'] == {'check_same_thread': True}
+    assert _get_engine_kwargs(args)['max_overflow'] == 2
+    assert _get_num_threads(args) == 4
+    assert _get_num_threads(_parse_args(['--pool_size', '4', '--threads', '8'])) == 8
+
+    args = _parse_args(['--pool_class', 'NullPool', '--sql_source', 'postgresql://localhost/db'])
+    assert _get_engine_kwargs(args) == {'poolclass': sqlalchemy.pool.NullPool}
+    assert _get_engine_kwargs(_parse_args(['--pool_class', 'default']))['connect_args'] == {'check_same_thread': False}
+
+    _, s, _ = get_server(['--pool_size', '3'])
+    assert s.requests.min == 3
+
+
+def test_worker_args():
+    args = _parse_args(['--sql_source', 'sqlite:////data/my db.sqlite'])
+    assert _get_sql_source(args) == 'sqlite:////data/my db.sqlite'
+    assert _get_sqlite_pragmas(args)['journal_mode'] is None
+    args = _parse_args(['--sql_source', 'sqlite:////data/my db.sqlite', '--read_only'])
+    assert _get_sql_source(args) == 'sqlite:///file:/data/my%20db.sqlite?mode=ro&uri=true'
+    # several worker processes share the file, whose journal mode is left as it is unless one is given
+    with raises(ValueError):
+        _get_sqlite_pragmas(_parse_args(['--sql_source', 'sqlite:////data/my.db', '--workers', '4']))
+    args = _parse_args(['--sql_source', 'sqlite:////data/my.db', '--workers', '4', '--journal_mode', 'WAL'])
+    assert _get_sqlite_pragmas(args)['journal_mode'] == 'WAL'
+    args = _parse_args(['--sql_source', 'sqlite:////data/my.db', '--workers', '4', '--read_only'])
+    assert _get_sqlite_pragmas(args)['journal_mode'] is None
+
+
+def test_lazy_imports():
+    # importing the entry point loads none of the heavy dependencies; they are imported as the server starts
+    python_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    out = subprocess.check_output([sys.executable, '-c',
+                                   'import sys, sql_server.server; '
+                                   'print([m for m in ("flask", "sqlalchemy", "cheroot", "pyarrow") if m in sys.modules])'],
+                                  cwd=python_dir)
+    assert out.strip() == b'[]'
+
+
+def test_startup_profile():
+    _, _, a = get_server(['--startup_profile'])
+    assert a.test_client().get('/get_table_names').status_code == 200
+    profile = a.config['startup_profile']
+    deadline = time.monotonic() + 10
+    while 'warm_up' not in [p['phase'] for p in profile.get_phases()] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    phases = {p['phase']: p for p in profile.get_phases()}
+    assert set(phases) == {'import_server', 'import_app', 'create_app', 'warm_up', 'first_request'}
+    assert phases['import_app']['since_start'] <= phases['create_app']['since_start']
+    assert all(p['seconds'] >= 0 for p in phases.values())
+
+    _, _, a = get_server(['--no_warm_up'])
+    assert a.config['startup_profile'].get_phases() == []
+
+
+def test_database_args():
+    args = _parse_args(['--database', 'sales=sqlite:////data/sales.db', '--database', 'pg=postgresql://host/db',
+                        '--replica', 'sqlite:////copies/main.db', '--replica', 'sales=sqlite:////copies/sales.db',
+                        '--replica', 'pg=postgresql://replica/db', '--read_only'])
+    replicas, databases = _get_databases(args)
+    assert replicas == [['sqlite:///file:/copies/main.db?mode=ro&uri=true']]
+    assert databases['sales'] == {'engine_args_list': ['sqlite:///file:/data/sales.db?mode=ro&uri=true'],
+                                  'engine_kwargs_dict': _get_engine_kwargs(args),
+                                  'replica_args_lists': [['sqlite:///file:/copies/sales.db?mode=ro&uri=true']]}
+    assert databases['pg']['engine_args_list'] == ['postgresql://host/db']
+    assert 'connect_args' not in databases['pg']['engine_kwargs_dict']
+    assert databases['pg']['replica_args_lists'] == [['postgresql://replica/db']]
+    # a replica URI that is already read-only is kept as it is
+    args = _parse_args(['--replica', 'sqlite:///file:/copies/main.db?mode=ro&uri=true'])
+    assert _get_databases(args)[0] == [['sqlite:///file:/copies/main.db?mode=ro&uri=true']]
+
+    for bad in [['--database', 'sqlite:////data/sales.db'], ['--database', 'default=sqlite:////data/sales.db'],
+                ['--replica', 'sales=sqlite:////copies/sales.db']]:
+        with raises(ValueError):
+            _get_databases(_parse_args(bad))
+
+
+def test_summary_args(tmp_path):
+    summaries = [{'name': 'by_genre', 'CLAUSE': {'SELECT': [Criterion('tracks', 'GenreId')],
+                                                 'GROUP BY': [Criterion('tracks', 'GenreId')]}},
+                 {'name': 'by_day', 'CLAUSE': {}, 'refresh': 'incremental', 'database': 'sales'}]
+    path = str(tmp_path / 'summaries.json')
+    with open(path, 'w') as f:
+        json.dump(summaries, f, cls=SqlAlchemyDslJSONEncoder)
+    args = _parse_args(['--database', 'sales=sqlite:////data/sales.db', '--summaries', path])
+    _, databases = _get_databases(args)
+    default = _get_summaries(args, databases)
+    assert [s['name'] for s in default] == ['by_genre']
+    assert default[0]['CLAUSE']['SELECT'][0].get_dict() == Criterion('tracks', 'GenreId').get_dict()
+    assert databases['sales']['summaries'] == [{'name': 'by_day', 'CLAUSE': {}, 'refresh': 'incremental'}]
+    assert _get_summaries(_parse_args([]), {}) == []
+    with raises(ValueError):  # no database called sales
+        _get_summaries(_parse_args(['--summaries', path]), {})
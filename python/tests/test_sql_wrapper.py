@@ -1,4 +1,8 @@
 from sql_server.sql_wrapper import SqlWrapper
+from sql_server.sql_wrapper import SqlWrapperException
+from sql_server.sqlalchemy_dsl import Criterion
+from pytest import raises
+import sqlalchemy.pool
 import os.path
 
 
@@ -22,3 +26,165 @@ def test_get():
                                    'sqlite_sequence',
                                    'sqlite_stat1',
                                    'tracks']
+    assert s.get_cache_stats()['schema_catalog']['refreshes'] == 1
+    assert set(s.get_metadata().tables.keys()) == set(s.get_table_names())
+
+
+def test_sqlite_pragmas(chinook_copy):
+    pragmas = {'busy_timeout': 1234, 'journal_mode': 'WAL', 'mmap_size': 1048576, 'cache_size': -4000}
+    s = SqlWrapper(['sqlite:///'+chinook_copy],
+                   {'poolclass': sqlalchemy.pool.QueuePool, 'connect_args': {'check_same_thread': False}},
+                   sqlite_pragmas=pragmas)
+    with s._engine.connect() as conn:
+        for k, v in pragmas.items():
+            assert conn.execute('PRAGMA '+k+';').scalar() == (v.lower() if k == 'journal_mode' else v)
+    assert s.get_table_count('employees') == 8
+
+    with raises(SqlWrapperException):
+        SqlWrapper(['sqlite:///'+chinook_copy], {}, sqlite_pragmas={'foreign_keys': 1})
+    with raises(SqlWrapperException):
+        SqlWrapper(['sqlite:///'+chinook_copy], {}, sqlite_pragmas={'journal_mode': 'WAL; DROP TABLE albums'})
+
+
+def test_iter_clause_rows():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    s = SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')], {})
+    batches = s.iter_clause_rows({'SELECT': [Criterion('genres', 'GenreId')]}, row_limit=10, batch_size=4)
+    assert next(batches) == ['GenreId']
+    assert [len(b) for b in batches] == [4, 4, 2]
+
+    batches = s.iter_clause_rows({'SELECT': [Criterion('genres', 'Name')]}, batch_size=4)
+    assert next(batches) == ['Name']
+    assert next(batches) == [('Rock',), ('Jazz',), ('Metal',), ('Alternative & Punk',)]
+    batches.close()
+
+
+def test_statement_cache():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    s = SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')], {})
+    for genre_id, name in [(1, 'Rock'), (2, 'Jazz'), (3, 'Metal')]:
+        clause = {'SELECT': [Criterion('genres', 'Name')],
+                  'WHERE': {'AND': [Criterion('genres', 'GenreId', comparison_operator='=', field_value=[genre_id])]}}
+        batches = s.iter_clause_rows(clause)
+        assert next(batches) == ['Name']
+        assert list(batches) == [[(name,)]]
+    stats = s.get_cache_stats()['statement_cache']
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['size'] == 1
+
+
+def test_result_cache(chinook_copy):
+    s = SqlWrapper(['sqlite:///'+chinook_copy], {})
+    clause = {'SELECT': [Criterion('genres', 'Name')],
+              'WHERE': {'AND': [Criterion('genres', 'GenreId', comparison_operator='>', field_value=[23])]}}
+    assert list(s.iter_clause_rows(clause, batch_size=1)) == [['Name'], [('Classical',)], [('Opera',)]]
+    assert list(s.iter_clause_rows(clause, batch_size=1)) == [['Name'], [('Classical',)], [('Opera',)]]
+    stats = s.get_cache_stats()['result_cache']
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+    s.get_engine().execute("INSERT INTO genres (Name) VALUES ('Test Genre');")
+    assert list(s.iter_clause_rows(clause)) == [['Name'], [('Classical',), ('Opera',), ('Test Genre',)]]
+    assert s.run_batch([{'op': 'query', 'CLAUSE': clause}])[0]['rows'] == [['Classical'], ['Opera'], ['Test Genre']]
+    stats = s.get_cache_stats()['result_cache']
+    assert (stats['hits'], stats['misses'], stats['invalidations']) == (2, 2, 1)
+
+
+def test_iter_clause_page():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    s = SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')], {})
+    clause = {'SELECT': [Criterion('tracks', 'TrackId'), Criterion('tracks', 'Name')],
+              'WHERE': {'AND': [Criterion('tracks', 'GenreId', comparison_operator='=', field_value=[1])]},
+              'ORDER BY': [Criterion('tracks', 'AlbumId', ['DESC'])]}
+    rows, page_token, pages = [], None, 0
+    while True:
+        items = list(s.iter_clause_page(clause, 300, page_token, batch_size=128))
+        assert items[0] == ['TrackId', 'Name']
+        assert all(len(batch) <= 128 for batch in items[1:-1])
+        rows.extend(row for batch in items[1:-1] for row in batch)
+        page_token = items[-1]
+        pages += 1
+        if page_token is None:
+            break
+    assert pages == 5
+    with s.get_engine().connect() as conn:
+        expected = conn.execute('SELECT TrackId, Name FROM tracks WHERE GenreId = 1 '
+                                'ORDER BY AlbumId DESC, TrackId;').fetchall()
+    assert rows == [tuple(row) for row in expected]
+
+
+def test_clause_limit():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    s = SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')], {})
+    clause = {'SELECT': [Criterion('tracks', 'TrackId')], 'LIMIT': 20}
+    assert sum(len(b) for b in list(s.iter_clause_rows(clause, row_limit=100))[1:]) == 20
+    assert sum(len(b) for b in list(s.iter_clause_rows(clause, row_limit=5))[1:]) == 5
+    assert sum(len(b) for b in list(s.iter_clause_rows(clause))[1:]) == 20
+
+
+def test_warm_up():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    s = SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')], {'poolclass': sqlalchemy.pool.QueuePool})
+    # creating the wrapper neither connects nor reflects; warm_up does both ahead of the first request
+    assert s.get_engine().pool.checkedin() == 0
+    assert s.get_cache_stats()['schema_catalog']['refreshes'] == 0
+    s.warm_up()
+    assert s.get_engine().pool.checkedin() == 1
+    assert s.get_cache_stats()['schema_catalog']['refreshes'] == 1
+    assert s.get_table_count('employees') == 8
+    assert s.get_cache_stats()['schema_catalog']['refreshes'] == 1
+
+
+def test_run_batch_one_connection():
+    # with schema_ttl=0 every schema lookup revalidates; none of them may wait on the connection the batch holds
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    s = SqlWrapper(['sqlite:///'+os.path.join(this_dir, 'data', 'chinook.db')],
+                   {'poolclass': sqlalchemy.pool.QueuePool, 'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 2},
+                   schema_ttl=0)
+    clause = {'SELECT': [Criterion('genres', 'Name')], 'LIMIT': 2}
+    results = s.run_batch([{'op': 'count', 'table_name': 'employees'},
+                           {'op': 'count', 'table_name': 'tracks', 'mode': 'estimate'},
+                           {'op': 'query', 'CLAUSE': clause},
+                           {'op': 'query', 'CLAUSE': {}},
+                           {'op': 'query', 'CLAUSE': dict(clause, WHERE=[Criterion('genres', 'GenreId')])},
+                           {'op': 'query', 'CLAUSE': dict(clause, WHERE={'XOR': []})},
+                           {'op': 'query', 'CLAUSE': [clause]},
+                           {'op': 'query', 'CLAUSE': clause, 'row_limit': 'all'}])
+    assert results[0]['count'] == 8
+    assert results[1]['source'] == 'sqlite_stat1'
+    assert results[2]['rows'] == [['Rock'], ['Jazz']]
+    # each malformed query gets its own error, and the rest of the batch is answered
+    assert all(list(r) == ['error'] for r in results[3:])
+    assert s.get_engine().pool.checkedout() == 0
+
+
+def test_replicas(chinook_copy):
+    replica = 'sqlite:///file:' + chinook_copy + '?mode=ro&uri=true'
+    s = SqlWrapper(['sqlite:///'+chinook_copy], {'poolclass': sqlalchemy.pool.QueuePool},
+                   replica_args_lists=[[replica], [replica]], health_check_interval=None, schema_ttl=0)
+    assert len(s.get_engines()) == 3
+    # reads are spread over the replicas
+    assert s.get_table_count('employees') == 8
+    assert s.get_table_count('genres') == 25
+    assert [r['connections'] for r in s.get_replica_stats()] == [1, 1]
+    # writes go to the primary, whose changes the read-only replicas of the same file see
+    clause = {'SELECT': [Criterion('tracks', 'Name')],
+              'WHERE': {'AND': [Criterion('tracks', 'Composer', comparison_operator='=', field_value=['AC/DC'])]}}
+    list(s.iter_clause_rows(clause))
+    assert [r['columns'] for r in s.apply_index_advice()] == [['Composer']]
+    assert s.explain_clause(clause)['full_scans'] == []
+    assert [r['healthy'] for r in s.get_replica_stats()] == [True, True]
+    # a replica may lag the primary, so nothing read from one is cached or validated under the primary's version
+    assert s.get_table_count_with_source('employees') == (8, 'count')
+    assert s.get_cache_stats()['result_cache']['entries'] == 0
+    assert s.get_data_version() is None
+    # the schema catalog describes the primary, and is never revalidated on a replica's connection
+    replica_statements = []
+    for engine in s.get_engines()[1:]:
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                lambda conn, cursor, statement, *args: replica_statements.append(statement))
+    assert s.get_table_count_with_source('tracks', 'estimate') == (3503, 'sqlite_stat1')
+    assert replica_statements == ['SELECT tbl, stat FROM sqlite_stat1;']
+
+    with raises(SqlWrapperException):
+        SqlWrapper(['sqlite:///'+chinook_copy], {}, replica_args_lists=[['postgresql://localhost/db']])
@@ -6,6 +6,8 @@ from sql_server.sqlalchemy_dsl import ClauseDictionaryToStatement
 from sql_server.sqlalchemy_dsl import SqlAlchemyDslError
 from sql_server.sqlalchemy_dsl import SqlAlchemyDslJSONEncoder
 from sql_server.sqlalchemy_dsl import get_clause_from_json
+from sql_server.sqlalchemy_dsl import get_summary_columns
+from sql_server.sqlalchemy_dsl import parametrize_clause
 from pytest import raises
 
 
@@ -130,10 +132,48 @@ def test_simple_criterion():
                      'Protected MPEG-4 video file',
                      'Purchased AAC audio file'}
 
+    clause = {'SELECT': [Criterion('media_types', 'Name')],
+              'ORDER BY': [Criterion('media_types', 'Name', ['DESC']), Criterion('media_types', 'MediaTypeId')]
+              }
+    s = ClauseDictionaryToStatement(metadata).get_statement(clause)
+    assert sql_from_stmt(s) == 'SELECT media_types."Name" \nFROM media_types \nWHERE true ' +\
+        'ORDER BY media_types."Name" DESC, media_types."MediaTypeId"'
+    with engine.connect() as conn:
+        assert conn.execute(s).fetchall()[0][0] == 'Purchased AAC audio file'
+
     clause = {}
     with raises(SqlAlchemyDslError):
         s = ClauseDictionaryToStatement(metadata).get_statement(clause)
 
+    # a direction only makes sense on the outside of an ORDER BY
+    for clause in [{'SELECT': [Criterion('media_types', 'Name', ['DESC'])]},
+                   {'SELECT': [Criterion('media_types', 'Name')],
+                    'WHERE': {'AND': [Criterion('media_types', 'MediaTypeId', ['ASC'], '=', [1])]}},
+                   {'SELECT': [Criterion('media_types', 'Name')],
+                    'ORDER BY': [Criterion('media_types', 'MediaTypeId', ['COUNT', 'DESC'])]}]:
+        with raises(SqlAlchemyDslError):
+            ClauseDictionaryToStatement(metadata).get_statement(clause)
+
+
+
+def test_malformed_clauses():
+    engine, metadata = get_engine_and_metadata()
+    name = Criterion('media_types', 'Name')
+    for clause in [{'SELECT': [name], 'WHERE': [name]},
+                   {'SELECT': [name], 'WHERE': {'XOR': [name]}},
+                   {'SELECT': [name], 'WHERE': {'AND': [{'OR': name}]}},
+                   {'SELECT': [name], 'WHERE': {'AND': [Criterion('media_types', 'MediaTypeId', [], 'BETWEEN', [1])]}},
+                   {'SELECT': [name, 'Name']},
+                   {'SELECT': [name], 'ORDER BY': [{'Criterion': name}]},
+                   {'SELECT': [name], 'GROUP BY': name},
+                   [name]]:
+        with raises(SqlAlchemyDslError):
+            ClauseDictionaryToStatement(metadata).get_statement(clause)
+    with raises(SqlAlchemyDslError):
+        Criterion('media_types', 'Name', 'DESC')
+    with raises(SqlAlchemyDslError):
+        Criterion('media_types', 'Name', [], '=', 'x')
+
 
 def test_json():
     engine, metadata = get_engine_and_metadata()
@@ -192,3 +232,173 @@ def test_nested_query():
         clause)) == 'SELECT media_types."Name" \n' +\
         'FROM media_types \n' + \
         'WHERE media_types."MediaTypeId" IN (2, 3, 5) AND (media_types."MediaTypeId" > 1 OR media_types."MediaTypeId" < 3) AND media_types."MediaTypeId" = 3'
+
+
+def test_parametrize_clause():
+    engine, metadata = get_engine_and_metadata()
+
+    def get_clause(ids, name):
+        return {'SELECT': [Criterion('media_types', 'Name')],
+                'WHERE': {'AND': [Criterion('media_types', 'MediaTypeId', comparison_operator='IN', field_value=[ids]),
+                                  Criterion('media_types', 'Name', comparison_operator='LIKE', field_value=[name])]}
+                }
+
+    shape, parametrized_clause, params = parametrize_clause(get_clause((2, 3, 5), '%AAC%'))
+    assert params == {'p0': [2, 3, 5], 'p1': '%AAC%'}
+    other_shape, _, other_params = parametrize_clause(get_clause([1], 'MPEG%'))
+    assert other_shape == shape
+    assert other_params == {'p0': [1], 'p1': 'MPEG%'}
+    assert parametrize_clause({'SELECT': [Criterion('media_types', 'Name')]})[0] != shape
+
+    s = ClauseDictionaryToStatement(metadata).get_statement(parametrized_clause)
+    assert str(s) == 'SELECT media_types."Name" \n' +\
+        'FROM media_types \n' +\
+        'WHERE media_types."MediaTypeId" IN ([EXPANDING_p0]) AND media_types."Name" LIKE :p1'
+    compiled = s.compile(dialect=engine.dialect)
+    with engine.connect() as conn:
+        names = {x[0] for x in conn.execute(compiled, params).fetchall()}
+        assert names == {'Protected AAC audio file', 'AAC audio file'}
+        assert conn.execute(compiled, other_params).fetchall() == [('MPEG audio file',)]
+
+    with raises(SqlAlchemyDslError):
+        parametrize_clause({'WHERE': {'AND': [Criterion('media_types', 'MediaTypeId', comparison_operator='IN',
+                                                        field_value=[3])]}})
+
+    # None is compared with IS NULL and IS NOT NULL, rather than bound
+    for operator, sql, expected in [('=', 'IS NULL', 49), ('!=', 'IS NOT NULL', 10)]:
+        clause = {'SELECT': [Criterion('customers', 'CustomerId')],
+                  'WHERE': {'AND': [Criterion('customers', 'Company', [], operator, [None])]}}
+        shape, parametrized_clause, params = parametrize_clause(clause)
+        assert params == {}
+        assert shape != parametrize_clause({'SELECT': [Criterion('customers', 'CustomerId')],
+                                            'WHERE': {'AND': [Criterion('customers', 'Company', [], operator,
+                                                                        ['x'])]}})[0]
+        s = ClauseDictionaryToStatement(metadata).get_statement(parametrized_clause)
+        assert str(s).endswith('customers."Company" ' + sql)
+        with engine.connect() as conn:
+            assert len(conn.execute(s.compile(dialect=engine.dialect), params).fetchall()) == expected
+
+
+def test_aggregates():
+    engine, metadata = get_engine_and_metadata()
+    clause = {'SELECT': [Criterion('invoice_items', 'InvoiceId'),
+                         Criterion('invoice_items', 'UnitPrice', ['SUM']),
+                         Criterion('invoice_items', 'UnitPrice', ['AVG']),
+                         Criterion('invoice_items', 'TrackId', ['MIN']),
+                         Criterion('invoice_items', 'TrackId', ['MAX'])],
+              'GROUP BY': [Criterion('invoice_items', 'InvoiceId')],
+              'HAVING': {'AND': [Criterion('invoice_items', 'UnitPrice', ['SUM'], '>', [15])]},
+              'ORDER BY': [Criterion('invoice_items', 'UnitPrice', ['DESC', 'SUM']),
+                           Criterion('invoice_items', 'InvoiceId')],
+              'LIMIT': 3}
+    # round trip through JSON
+    clause = get_clause_from_json(json.dumps(clause, cls=SqlAlchemyDslJSONEncoder))
+    s = ClauseDictionaryToStatement(metadata).get_statement(clause)
+    assert sql_from_stmt(s) == 'SELECT invoice_items."InvoiceId", sum(invoice_items."UnitPrice") AS sum_1, ' +\
+        'avg(invoice_items."UnitPrice") AS avg_1, min(invoice_items."TrackId") AS min_1, ' +\
+        'max(invoice_items."TrackId") AS max_1 \nFROM invoice_items \nWHERE true GROUP BY invoice_items."InvoiceId" \n' +\
+        'HAVING sum(invoice_items."UnitPrice") > 15 ' +\
+        'ORDER BY sum(invoice_items."UnitPrice") DESC, invoice_items."InvoiceId"\n LIMIT 3'
+    with engine.connect() as conn:
+        rows = conn.execute(s).fetchall()
+        expected = conn.execute('SELECT InvoiceId, SUM(UnitPrice), AVG(UnitPrice), MIN(TrackId), MAX(TrackId) '
+                                'FROM invoice_items GROUP BY InvoiceId HAVING SUM(UnitPrice) > 15 '
+                                'ORDER BY SUM(UnitPrice) DESC, InvoiceId LIMIT 3;').fetchall()
+    assert len(rows) == 3
+    assert [(r[0], round(float(r[1]), 2), r[3], r[4]) for r in rows] == \
+        [(r[0], round(r[1], 2), r[3], r[4]) for r in expected]
+
+    with raises(SqlAlchemyDslError):
+        ClauseDictionaryToStatement(metadata).get_statement({'SELECT': clause['SELECT'], 'LIMIT': 'ten'})
+
+
+def test_joins():
+    engine, metadata = get_engine_and_metadata()
+    clause = {'SELECT': [Criterion('albums', 'Title'), Criterion('artists', 'Name')],
+              'WHERE': {'AND': [Criterion('artists', 'Name', comparison_operator='=', field_value=['AC/DC'])]}}
+    s = ClauseDictionaryToStatement(metadata).get_statement(clause)
+    assert sql_from_stmt(s) == 'SELECT albums."Title", artists."Name" \n' +\
+        'FROM albums JOIN artists ON albums."ArtistId" = artists."ArtistId" \nWHERE artists."Name" = \'AC/DC\''
+    with engine.connect() as conn:
+        assert len(conn.execute(s).fetchall()) == 2
+
+    # genres and invoice_items are joined through tracks
+    clause = {'SELECT': [Criterion('genres', 'Name'), Criterion('invoice_items', 'Quantity', ['SUM'])],
+              'GROUP BY': [Criterion('genres', 'Name')],
+              'ORDER BY': [Criterion('invoice_items', 'Quantity', ['DESC', 'SUM'])],
+              'LIMIT': 1}
+    s = ClauseDictionaryToStatement(metadata).get_statement(clause)
+    assert 'FROM genres JOIN tracks ON tracks."GenreId" = genres."GenreId" ' +\
+        'JOIN invoice_items ON invoice_items."TrackId" = tracks."TrackId"' in sql_from_stmt(s)
+    with engine.connect() as conn:
+        assert conn.execute(s).fetchall() == [('Rock', 835)]
+
+    # hints join tables without a foreign key between them
+    clause = {'SELECT': [Criterion('customers', 'CustomerId'), Criterion('employees', 'EmployeeId')],
+              'JOIN': [[Criterion('customers', 'City'), Criterion('employees', 'City')]]}
+    s = ClauseDictionaryToStatement(metadata).get_statement(clause)
+    assert 'FROM customers JOIN employees ON customers."City" = employees."City"' in sql_from_stmt(s)
+    clause = get_clause_from_json(json.dumps(clause, cls=SqlAlchemyDslJSONEncoder))
+    assert sql_from_stmt(ClauseDictionaryToStatement(metadata).get_statement(clause)) == sql_from_stmt(s)
+
+    with raises(SqlAlchemyDslError):  # no foreign keys lead to sqlite_stat1
+        ClauseDictionaryToStatement(metadata).get_statement(
+            {'SELECT': [Criterion('albums', 'Title'), Criterion('sqlite_stat1', 'tbl')]})
+    with raises(SqlAlchemyDslError):
+        ClauseDictionaryToStatement(metadata).get_statement(
+            {'SELECT': [Criterion('albums', 'Title')], 'JOIN': [[Criterion('albums', 'Title')]]})
+
+
+class Summary:
+    """ stands in for a SummaryTable """
+
+    def __init__(self, clause, table_name):
+        self._clause = clause
+        self._table_name = table_name
+
+    def get_clause(self):
+        return self._clause
+
+    def get_table_name(self):
+        return self._table_name
+
+
+def test_summaries():
+    engine, metadata = get_engine_and_metadata()
+    definition = {'SELECT': [Criterion('genres', 'Name'), Criterion('invoice_items', 'Quantity', ['SUM'])],
+                  'WHERE': {'AND': [Criterion('invoice_items', 'UnitPrice', comparison_operator='<', field_value=[2])]},
+                  'GROUP BY': [Criterion('genres', 'Name'), Criterion('genres', 'GenreId')]}
+    assert [x.get_dict() for x in get_summary_columns(definition)] == \
+        [x.get_dict() for x in definition['SELECT'] + [Criterion('genres', 'GenreId')]]
+    sqlalchemy.Table('summary', metadata, *[sqlalchemy.Column('c'+str(i)) for i in range(3)])
+    summary = Summary(definition, 'summary')
+    to_statement = ClauseDictionaryToStatement(metadata, [summary])
+
+    # the definition itself, and the same with further conditions, another order and a limit
+    assert sql_from_stmt(to_statement.get_statement(definition)) == \
+        'SELECT summary.c0 AS "Name", summary.c1 AS sum_1 \nFROM summary \nWHERE true ORDER BY summary.c0, summary.c2'
+    clause = dict(definition, WHERE={'AND': definition['WHERE']['AND'] +
+                                     [Criterion('genres', 'GenreId', comparison_operator='IN', field_value=[[1, 2]])]},
+                  HAVING={'AND': [Criterion('invoice_items', 'Quantity', ['SUM'], '>', [10])]},
+                  SELECT=[Criterion('invoice_items', 'Quantity', ['SUM'])],
+                  **{'ORDER BY': [Criterion('invoice_items', 'Quantity', ['DESC', 'SUM'])], 'LIMIT': 5})
+    assert to_statement.get_summary(clause) is summary
+    assert sql_from_stmt(to_statement.get_statement(clause)) == \
+        'SELECT summary.c1 AS sum_1 \nFROM summary \nWHERE summary.c2 IN (1, 2) AND summary.c1 > 10 ' +\
+        'ORDER BY summary.c1 DESC\n LIMIT 5'
+    # parametrized, the definition's values match any (see SqlWrapper for the literal clause choosing the summary)
+    _, parametrized_clause, params = parametrize_clause(clause)
+    assert 'FROM summary' in str(to_statement.get_statement(parametrized_clause))
+
+    # clauses the summary cannot answer are built as usual
+    for x in [dict(definition, WHERE={'AND': [Criterion('invoice_items', 'UnitPrice', comparison_operator='<',
+                                                        field_value=[3])]}),
+              dict(definition, WHERE={'AND': definition['WHERE']['AND'] +
+                                      [Criterion('invoice_items', 'Quantity', comparison_operator='>', field_value=[1])]}),
+              {k: v for k, v in definition.items() if k != 'WHERE'},
+              dict(definition, **{'GROUP BY': [Criterion('genres', 'Name')]}),
+              dict(definition, SELECT=[Criterion('invoice_items', 'Quantity', ['MAX'])]),
+              dict(definition, SELECT=definition['SELECT'] + [Criterion('tracks', 'Name')]),
+              dict(definition, **{'ORDER BY': [Criterion('tracks', 'Name')]})]:
+        assert to_statement.get_summary(x) is None
+        assert 'FROM summary' not in sql_from_stmt(to_statement.get_statement(x))
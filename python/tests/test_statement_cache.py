@@ -0,0 +1,23 @@
+from sql_server.statement_cache import StatementCache
+
+
+def test_lru():
+    cache = StatementCache(maxsize=2)
+    assert cache.get('a') is None
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # evicts 'b', the least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert cache.get_stats() == {'hits': 2, 'misses': 2, 'size': 2, 'maxsize': 2, 'hit_rate': 0.5}
+
+    cache.clear()
+    assert cache.get('a') is None
+
+
+def test_disabled():
+    cache = StatementCache(maxsize=0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert cache.get_stats()['size'] == 0
@@ -0,0 +1,120 @@
+from sql_server.summaries import SummaryTable
+from sql_server.summaries import SummaryError
+from sql_server.sql_wrapper import SqlWrapper
+from sql_server.sqlalchemy_dsl import Criterion
+from pytest import raises
+from decimal import Decimal
+import sqlite3
+import time
+
+BY_GENRE = {'SELECT': [Criterion('genres', 'Name'), Criterion('invoice_items', 'Quantity', ['SUM']),
+                       Criterion('invoice_items', 'UnitPrice', ['TOTAL'])],
+            'GROUP BY': [Criterion('genres', 'Name')]}
+BY_ALBUM = {'SELECT': [Criterion('tracks', 'AlbumId'), Criterion('tracks', 'TrackId', ['COUNT']),
+                       Criterion('tracks', 'UnitPrice', ['SUM']), Criterion('tracks', 'Milliseconds', ['MAX'])],
+            'WHERE': {'AND': [Criterion('tracks', 'Milliseconds', comparison_operator='>', field_value=[100000])]},
+            'GROUP BY': [Criterion('tracks', 'AlbumId')]}
+
+
+def get_sql_wrapper(test_file, summaries=[]):
+    return SqlWrapper(['sqlite:///' + test_file], {}, result_cache_bytes=0, summaries=summaries,
+                      summary_check_interval=None)
+
+
+def get_rows(sql_wrapper, clause):
+    batches = sql_wrapper.iter_clause_rows(clause)
+    return next(batches), [row for batch in batches for row in batch]
+
+
+def test_summary_table():
+    summary = SummaryTable.from_dict({'name': 'by_album', 'CLAUSE': BY_ALBUM, 'refresh': 'incremental'})
+    assert summary.get_table_name() == 'sql_server_summary_by_album'
+    assert summary.get_group_positions() == [0]
+    for name, clause, refresh in [('by album', BY_ALBUM, 'full'),
+                                  ('no_group', {'SELECT': BY_ALBUM['SELECT']}, 'full'),
+                                  ('ordered', dict(BY_ALBUM, LIMIT=5), 'full'),
+                                  ('by_album', BY_ALBUM, 'sometimes')]:
+        with raises(SummaryError):
+            SummaryTable(name, clause, refresh)
+    with raises(SummaryError):
+        SummaryTable.from_dict({'CLAUSE': BY_ALBUM})
+
+
+def test_refresh_and_rewrite(chinook_copy):
+    plain = get_sql_wrapper(chinook_copy)
+    s = get_sql_wrapper(chinook_copy, [{'name': 'by_genre', 'CLAUSE': BY_GENRE},
+                                    {'name': 'by_album', 'CLAUSE': BY_ALBUM, 'refresh': 'incremental'}])
+    assert 'FROM sql_server_summary' not in s.explain_clause(BY_GENRE)['sql']  # not built yet
+    assert s.refresh_summaries() == ['by_genre', 'by_album']
+    assert s.refresh_summaries() == []
+    assert [(x['name'], x['fresh'], x['rows']) for x in s.get_summary_stats()] == \
+        [('by_genre', True, 24), ('by_album', True, 345)]
+
+    # clauses the summaries answer give the same columns, rows and order as the source tables do
+    filtered = dict(BY_ALBUM, SELECT=[Criterion('tracks', 'UnitPrice', ['SUM']), Criterion('tracks', 'AlbumId')],
+                    WHERE={'AND': BY_ALBUM['WHERE']['AND'] +
+                           [Criterion('tracks', 'AlbumId', comparison_operator='<', field_value=[50])]},
+                    HAVING={'AND': [Criterion('tracks', 'TrackId', ['COUNT'], '>=', [15])]},
+                    **{'ORDER BY': [Criterion('tracks', 'Milliseconds', ['DESC', 'MAX'])], 'LIMIT': 3})
+    for clause in [BY_GENRE, BY_ALBUM, filtered]:
+        assert 'FROM sql_server_summary' in s.explain_clause(clause)['sql']
+        assert get_rows(s, clause) == get_rows(plain, clause)
+    assert get_rows(s, filtered)[1][0][1] == 21
+    assert s.run_batch([{'op': 'query', 'CLAUSE': BY_GENRE}]) == plain.run_batch([{'op': 'query', 'CLAUSE': BY_GENRE}])
+    # values differing from the summary's own are not answered from it, though the clause has the same shape
+    other = dict(BY_ALBUM, WHERE={'AND': [Criterion('tracks', 'Milliseconds', comparison_operator='>',
+                                                    field_value=[200000])]})
+    assert 'FROM sql_server_summary' not in s.explain_clause(other)['sql']
+    assert get_rows(s, other) == get_rows(plain, other)
+
+    # writes from another connection leave the summaries out of date, and clauses go to the source tables
+    conn = sqlite3.connect(chinook_copy)
+    conn.execute('UPDATE tracks SET Milliseconds = Milliseconds + 1000 WHERE AlbumId = 1;')
+    conn.execute('DELETE FROM invoice_items WHERE TrackId IN (SELECT TrackId FROM tracks WHERE AlbumId = 2);')
+    conn.execute('DELETE FROM tracks WHERE AlbumId = 2;')
+    conn.execute("INSERT INTO tracks (Name, MediaTypeId, Milliseconds, UnitPrice) VALUES ('x', 1, 200000, 1.5);")
+    conn.commit()
+    assert [x['fresh'] for x in s.get_summary_stats()] == [False, False]
+    for clause in [BY_GENRE, BY_ALBUM]:
+        assert 'FROM sql_server_summary' not in s.explain_clause(clause)['sql']
+        assert get_rows(s, clause) == get_rows(plain, clause)
+    # the incremental summary recomputes the changed albums only, including the one of no album
+    assert conn.execute('SELECT DISTINCT k0 FROM sql_server_groups_by_album ORDER BY k0;').fetchall() == \
+        [(None,), (1,), (2,)]
+    assert s.refresh_summaries() == ['by_genre', 'by_album']
+    assert conn.execute('SELECT count(*) FROM sql_server_groups_by_album;').fetchone() == (0,)
+    for clause in [BY_GENRE, BY_ALBUM, filtered]:
+        assert 'FROM sql_server_summary' in s.explain_clause(clause)['sql']
+        assert get_rows(s, clause) == get_rows(plain, clause)
+    assert get_rows(s, BY_ALBUM)[1][:2] == [(None, 1, Decimal('1.50'), 200000), (1, 10, Decimal('9.90'), 344719)]
+    conn.close()
+
+    # another process sees the summaries' state in the database
+    t = get_sql_wrapper(chinook_copy, [{'name': 'by_genre', 'CLAUSE': BY_GENRE}])
+    assert t.refresh_summaries() == []
+    assert 'FROM sql_server_summary' in t.explain_clause(BY_GENRE)['sql']
+    # and a changed definition builds the table again
+    t = get_sql_wrapper(chinook_copy, [{'name': 'by_genre', 'CLAUSE': dict(BY_GENRE, SELECT=BY_GENRE['SELECT'][:2])}])
+    assert 'FROM sql_server_summary' not in t.explain_clause(BY_GENRE)['sql']
+    assert t.refresh_summaries() == ['by_genre']
+    assert [x['rows'] for x in t.get_summary_stats()] == [24]
+    with raises(SummaryError):
+        t.refresh_summaries(['nope'])
+
+
+def test_scheduled_refresh(chinook_copy):
+    s = SqlWrapper(['sqlite:///' + chinook_copy], {}, summaries=[{'name': 'by_album', 'CLAUSE': BY_ALBUM}],
+                   summary_check_interval=0.05)
+    s.warm_up()  # builds the summaries
+    assert [x['fresh'] for x in s.get_summary_stats()] == [True]
+    conn = sqlite3.connect(chinook_copy)
+    conn.execute('DELETE FROM tracks WHERE TrackId = 1;')
+    conn.commit()
+    conn.close()
+    assert [x['fresh'] for x in s.get_summary_stats()] == [False]
+    deadline = time.monotonic() + 10
+    while not s.get_summary_stats()[0]['fresh'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [(x['fresh'], x['refreshes']) for x in s.get_summary_stats()] == [(True, 2)]
+    assert get_rows(s, BY_ALBUM)[1][0] == (1, 9, Decimal('8.91'), 270863)
+    s._summaries.close()
@@ -0,0 +1,66 @@
+import sqlalchemy
+from sql_server.schema_catalog import SchemaCatalog
+from sql_server.data_version import DataVersionMonitor
+from sql_server.table_counts import TableCounter
+
+
+def get_counter(db_file):
+    engine = sqlalchemy.create_engine('sqlite:///'+db_file)
+    monitor = DataVersionMonitor(engine)
+    return engine, monitor, TableCounter(engine, SchemaCatalog(engine), monitor)
+
+
+def test_exact_counts_are_cached(chinook_copy):
+    engine, monitor, counter = get_counter(chinook_copy)
+    assert monitor.is_supported()
+    assert counter.get_count('employees') == (8, 'count')
+    assert counter.get_count('employees') == (8, 'cache')
+    assert counter.get_stats() == {'hits': 1, 'misses': 1, 'estimates': 0}
+
+    # a commit from another connection moves data_version and invalidates the cached count
+    engine.execute("INSERT INTO genres (Name) VALUES ('Test Genre');")
+    assert counter.get_count('genres') == (26, 'count')
+    engine.execute("DELETE FROM employees WHERE EmployeeId = 8;")
+    assert counter.get_count('employees') == (7, 'count')
+    assert counter.get_count('employees') == (7, 'cache')
+
+    # local change counter
+    monitor.bump()
+    assert counter.get_count('employees') == (7, 'count')
+
+
+def test_estimated_counts(chinook_copy):
+    _, _, counter = get_counter(chinook_copy)
+    assert counter.get_count('tracks', 'estimate') == (3503, 'sqlite_stat1')
+    assert counter.get_count('artists', 'estimate') == (275, 'sqlite_stat1')
+    # no statistics for sqlite_sequence, so falls back to counting
+    assert counter.get_count('sqlite_sequence', 'estimate') == (10, 'count')
+    assert counter.get_stats()['estimates'] == 2
+
+
+def test_unsupported_monitor():
+    engine = sqlalchemy.create_engine('sqlite://')
+    monitor = DataVersionMonitor(engine)
+    assert not monitor.is_supported()
+    assert monitor.get_version() is None
+
+
+def test_fused_counts(chinook_copy):
+    engine, _, counter = get_counter(chinook_copy)
+    assert counter.get_count('albums') == (347, 'count')
+    statements = []
+    sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                            lambda conn, cursor, statement, *args: statements.append(statement))
+    counts = counter.get_counts(['artists', 'sqlite_sequence', 'tracks', 'artists'], 'estimate')
+    assert counts == {'artists': (275, 'sqlite_stat1'),
+                      'sqlite_sequence': (10, 'count'),
+                      'tracks': (3503, 'sqlite_stat1')}
+    counter.MAX_FUSED_COUNTS = 2
+    counts = counter.get_counts(['media_types', 'playlists', 'employees', 'albums'])
+    assert counts == {'media_types': (5, 'count'),
+                      'playlists': (18, 'count'),
+                      'employees': (8, 'count'),
+                      'albums': (347, 'cache')}
+    count_statements = [s for s in statements if 'COUNT(*)' in s]
+    assert len(count_statements) == 3
+    assert len([s for s in count_statements if 'UNION ALL' in s]) == 1
@@ -0,0 +1,77 @@
+import os
+import os.path
+import signal
+import subprocess
+import sys
+import time
+import requests
+from pytest import mark
+
+CHILDREN = '/proc/{pid}/task/{pid}/children'
+
+
+def get_children(pid):
+    with open(CHILDREN.format(pid=pid)) as f:
+        return [int(x) for x in f.read().split()]
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+@mark.skipif(not hasattr(os, 'fork') or not os.path.exists(CHILDREN.format(pid=os.getpid())),
+             reason='needs os.fork and /proc')
+def test_supervisor(tmp_path, chinook_copy):
+    port = 8123
+    supervisor = subprocess.Popen([sys.executable, '-m', 'sql_server.server', '--workers', '2', '--port', str(port),
+                                   '--sql_source', 'sqlite:///'+chinook_copy, '--journal_mode', 'WAL',
+                                   '--log', str(tmp_path / 'log.txt')],
+                                  cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    try:
+        url = 'http://127.0.0.1:{}/get_table_count'.format(port)
+
+        def count():
+            try:
+                return requests.post(url, json={'table_name': 'tracks'}, headers={'Connection': 'close'},
+                                     timeout=5).json()['count']
+            except requests.RequestException:
+                return None
+
+        assert wait_for(lambda: count() == 3503)
+        assert wait_for(lambda: len(get_children(supervisor.pid)) == 2)
+        workers = get_children(supervisor.pid)
+        os.kill(workers[0], signal.SIGKILL)
+        assert wait_for(lambda: len(get_children(supervisor.pid)) == 2 and workers[0] not in get_children(supervisor.pid))
+        assert all(count() == 3503 for _ in range(10))
+
+        supervisor.send_signal(signal.SIGTERM)
+        assert supervisor.wait(10) == 0
+    finally:
+        if supervisor.poll() is None:
+            supervisor.kill()
+    with open(str(tmp_path / 'log.txt')) as f:
+        log = f.read()
+    assert 'exited with status 9' in log
+    assert 'supervisor stopped' in log
+
+
+@mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_supervisor_stops_during_restart_delay():
+    # the only worker cannot start, so its restart waits 30 seconds; SIGTERM must not wait for it
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    script = ('import sys\n'
+              'from sql_server.workers import WorkerSupervisor\n'
+              'WorkerSupervisor(lambda sock: sys.exit(1), 1, ("127.0.0.1", 0), restart_delay=30.0).run()\n')
+    supervisor = subprocess.Popen([sys.executable, '-c', script], cwd=os.path.join(this_dir, '..'))
+    try:
+        time.sleep(1)
+        supervisor.send_signal(signal.SIGTERM)
+        assert supervisor.wait(5) == 0
+    finally:
+        if supervisor.poll() is None:
+            supervisor.kill()